@@ -33,6 +33,7 @@ from refabric.context_managers import sudo
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['setup', 'configure', 'start', 'stop', 'restart']
 
@@ -82,7 +83,7 @@ def configure():
         'token': blueprint.get('token', '')
     }
 
-    changes = blueprint.upload('./apm-server.yml', '/etc/apm-server/', context=context)
+    changes = manifest.upload(blueprint, './apm-server.yml', '/etc/apm-server/', context=context)
 
     if changes:
         restart()
@@ -15,6 +15,10 @@ Application Blueprint
         git_url: git@github.com:foo/bar.git[@branch]  # Git repository to clone
         # git_branch: master                          # Branch to clone, if not specified in `git_url` setting
         # git_source: ./                              # Relative path within repository added to python path (Default: src/)
+        # git_reference: /srv/git/bar.git             # Local or shared (NFS) reference repository to borrow git objects from
+        # git_reference_update: false                 # Fetch origin into the reference repository on deploy, and the source from it (Default: true)
+        # git_depth: 50                               # Shallow clone and fetch depth
+        # git_filter: blob:none                       # Partial clone filter, needs git 2.19+ (Default: full clone)
         # Do not reset these paths even if they are git-ignored
         # git_force_ignore:
         #  - /node_modules
@@ -23,6 +27,9 @@ Application Blueprint
         # use_python: false                           # Enable python support, required for virtualenv (Default: true)
         # use_virtualenv: false                       # Enable virtualenv and pip requirements, unless `use_python` is false (Default: true)
         # requirements: requirements/live.txt         # Pip requirements file to install (Default: requirements.txt)
+        # incremental_requirements: false             # Only install changed requirements when the requirements file parses (Default: true)
+        # wheelhouse: true                            # Build requirement wheels once and ship them to other hosts (Default: false)
+        # wheelhouse_path: wheelhouse                 # Local wheelhouse cache dir, relative to fabfile (Default: wheelhouse)
         # system_dependencies:                        # List of debian packages to install
         #   - build-essential  # gcc
         #   - libmemcached-dev # memcached
@@ -37,10 +44,40 @@ Application Blueprint
           provider: uwsgi                             # Set web provider
           # module: foobar.wsgi                       # Set wsgi module (Default: django.core.handlers.wsgi:WSGIHandler())
           # socket: 127.0.0.1:3031                    # Set vassal socket (Default: 0.0.0.0:3030)
+          # reload: chain                             # uWSGI web reload strategy: touch, chain or zerg (Default: touch)
+          # reload_wait: true                         # Wait for new workers after a touch reload (Default: false)
+          # reload_timeout: 120                       # Seconds to wait for reloaded workers to get ready (Default: 120)
+          # cheaper_algo: busyness                    # Scale uWSGI workers with traffic: spare, busyness or backlog
+          # cheaper: 2                                # Min workers when scaled down (Default: half the cores)
+          # cheaper_initial: 4                        # Workers at start (Default: half the workers)
+          # cheaper_step: 2                           # Workers to spawn at a time (Default: half the cores)
+          # adaptive: true                            # Size uWSGI workers, memory limits and backlog from live stats (Default: false)
+          # target_busy: 0.6                          # Adaptive sizing: busy worker ratio to size for (Default: 0.6)
+          # min_workers: 4                            # Adaptive sizing: fewest workers to size for (Default: 2 per core)
           # hosts:                                    # Optional host list restricting web provider installation
           #   - 10.0.0.10
           #   - 10.0.0.11
           #   - 10.0.0.12
+          # upstream:                                 # Options for the upstream in app.generate_nginx_conf
+          #   balance: least_conn                     # round_robin, least_conn, ip_hash or random_two, needs nginx 1.15.1+ (Default: round_robin)
+          #   keepalive: 16                           # Idle upstream connections kept per nginx worker, uwsgi over http only (Default: off)
+          #   weight: cores                           # Weight hosts by their core count (Default: equal weights)
+          #   max_fails: 3                            # Failed attempts before a host is considered unavailable (Default: nginx, 1)
+          #   fail_timeout: 10s                       # Window for max_fails and time a host is unavailable (Default: nginx, 10s)
+          #   buffer_size: 8k                         # Buffer for the response headers (Default: 8k)
+          #   buffers: 8 16k                          # Buffers for the response body (Default: 8 16k)
+          #   busy_buffers_size: 32k                  # Buffers busy sending to the client (Default: 32k)
+          # cache:                                    # Microcache anonymous GET requests in nginx, or just `cache: true`
+          #   valid: 1s                               # Time responses are cached, keep it short (Default: 1s)
+          #   path: /var/cache/nginx/foobar           # Cache dir (Default: /var/cache/nginx/<project>)
+          #   keys_zone: 10m                          # Shared memory for cache keys (Default: 10m)
+          #   max_size: 1g                            # Max size of cache dir (Default: 1g)
+          #   inactive: 10m                           # Remove entries not accessed within (Default: 10m)
+          #   lock_timeout: 5s                        # Max wait for another request populating the entry (Default: 5s)
+          #   background_update: true                 # Refresh expired entries in the background, needs nginx 1.11.10+ (Default: false)
+          #   bypass_cookies:                         # Cookies bypassing the cache, as are Authorization headers (Default: sessionid)
+          #     - sessionid
+          #   static_immutable: true                  # Serve /static/ as immutable for a year (Default: true)
 
         worker:                                       # Configure worker process
           # Set worker provider (uwsgi or supervisor)
@@ -56,12 +93,57 @@ Application Blueprint
           #   - 10.0.0.10
           #   - 10.0.0.11
           #   - 10.0.0.12
+          # restart: rolling                          # Restart queue programs a batch at a time when reloading (Default: all at once)
+          # restart_batch: 1                          # Queue programs restarted at a time in rolling restart (Default: 1)
+          # ready_timeout: 60                         # Seconds to wait for restarted workers to get ready (Default: 60)
+          # stop_timeout: 300                         # Seconds to let running tasks finish on warm shutdown (Default: 10)
+          # planner: true                             # Allocate queue concurrency and autoscale from host cores and memory (Default: false)
+          #                                           # Planner: requires Celery 4+, for --max-memory-per-child and --prefetch-multiplier
+          # pool: prefork                             # Planner: default pool; prefork, gevent or solo (Default: prefork)
+          # memory_per_child: 256                     # Planner: MB per prefork child, also its max memory (Default: 256)
+          # prefetch_multiplier: 1                    # Planner: tasks reserved per process (Default: 1)
+          # max_tasks_per_child: 1000                 # Planner: tasks before a prefork child is replaced (Default: 1000)
+          # cpu_factor: 2                             # Planner: prefork processes per core (Default: 2)
+          # gevent_concurrency: 100                   # Planner: greenlets shared by gevent queues (Default: 100)
+          # placement:                                # Place queues on worker hosts by load, run app.place_queues to update (Default: false)
+          #   path: placement.yml                     # Placement file, relative to fabfile (Default: placement.yml)
+          #   redundancy: 2                           # Hosts per queue without a hosts setting, any one can be lost (Default: 1)
+          #   target_busy: 0.7                        # Busy process ratio to place for (Default: 0.7)
+          #   load: queue-load.yml                    # Measured rate, runtime and memory per queue, overrides declared
           # queues:                                   # Optional queue definitions
           #   index:                                  # Queue name
           #     workers: 2                            # Number of queue workers
+          #     order: 1                              # Rolling restart order (Default: 0, then by name)
+          #     weight: 2                             # Planner: share of the host's processes (Default: 1)
+          #     rate: 20                              # Placement: tasks per second
+          #     runtime: 0.5                          # Placement: average task runtime in seconds
+          #     memory: 300                           # Placement: MB per worker process (Default: memory_per_child)
                 # hosts:                              # Optional host list restriction for queue
                 #   - 10.0.0.11
 
+        # rolling:                                    # Options for app.rolling_deploy and app.rolling_reload
+        #   batch_size: 25%                           # Hosts deployed in parallel per batch, count or percentage (Default: 25%)
+        #   max_failures: 0                           # Failed hosts tolerated before aborting, count or percentage (Default: 0)
+
+        # balancer:                                   # Load balancer to take hosts out of during app.rolling_reload
+        #   type: nginx                               # nginx (marks upstream servers down) or haproxy (admin socket) (Default: nginx)
+        #   hosts:                                    # Balancer hosts
+        #     - 10.0.0.5
+        #   backend: foobar                           # nginx site or haproxy backend name (Default: project)
+        #   servers:                                  # haproxy server names by host (Default: host)
+        #     10.0.0.10: web1
+        #   drain_seconds: 2                          # Seconds to let requests in flight finish (Default: 2)
+
+        # health:                                     # Health check after reload, stats socket for uwsgi if no url
+        #   url: http://127.0.0.1:8000/health/        # URL polled on the reloaded host
+        #   timeout: 60                               # Seconds to wait for host to get healthy (Default: 60)
+
+        # artifact:                                   # Options for app.deploy_artifact
+        #   build_host: 10.0.0.10                     # Host to build source and virtualenv on (Default: first host)
+        #   path: artifacts                           # Local dir to store artifacts in, relative to fabfile (Default: artifacts)
+        #   keep_releases: 5                          # Number of releases to keep on each host (Default: 5)
+        #   pool_size: 10                             # Hosts to ship the artifact to in parallel (Default: all)
+
       # Do not forget to configure the dependencies properly
       # uwsgi:
       #   version: 2.0.10
@@ -76,12 +158,15 @@ blueprint = blueprints.get(__name__)
 
 from .application.tasks import setup, configure, deploy, deployed, incoming, \
     start, stop, reload, status, configure_providers, generate_nginx_conf, \
-    install_requirements, configure_environment, configure_beat_schedule
+    install_requirements, configure_environment, configure_beat_schedule, \
+    rolling_deploy, deploy_artifact, rolling_reload, place_queues
 
 from .application.deploy import update_source
 
 __all__ = ['setup', 'configure', 'deploy', 'deployed', 'incoming',
            'start', 'stop', 'reload', 'status', 'configure_providers',
            'generate_nginx_conf', 'install_requirements', 'update_source',
-           'configure_environment', 'configure_beat_schedule']
+           'configure_environment', 'configure_beat_schedule',
+           'rolling_deploy', 'deploy_artifact', 'rolling_reload',
+           'place_queues']
 
@@ -0,0 +1,295 @@
+# coding=utf-8
+"""
+Build-once, ship-artifact deploys.
+
+Source and virtualenv are built once on a build host into a versioned release
+dir, packed into a tarball named by its sha256 digest and unpacked on every
+host next to the previous releases::
+
+    /srv/app/project/releases/<commit>/src/<repo>
+    /srv/app/project/releases/<commit>/env
+    /srv/app/project/current -> releases/<commit>
+    /srv/app/project/src -> current/src
+    /srv/app/project/env -> current/env
+
+Since the release dir has the same absolute path on every host, the virtualenv
+does not need to be relocated.
+"""
+import hashlib
+import os
+
+from fabric.context_managers import cd, settings
+from fabric.contrib import files
+from fabric.operations import get, put
+from fabric.state import env
+from fabric.utils import abort, warn
+
+from refabric.context_managers import silent
+from refabric.contrib import blueprints
+from refabric.operations import run
+from refabric.utils import info
+
+from .. import debian
+from .. import git
+from .. import trace
+
+__all__ = [
+    'build_artifact',
+    'install_artifact',
+    'activate_release',
+    'cleanup_releases',
+]
+
+blueprint = blueprints.get('blues.app')
+
+
+def releases_path():
+    from .project import project_home
+    return os.path.join(project_home(), 'releases')
+
+
+def current_release_path():
+    from .project import project_home
+    return os.path.join(project_home(), 'current')
+
+
+def local_artifacts_path():
+    path = blueprint.get('artifact.path', 'artifacts')
+    return os.path.join(os.path.dirname(env['real_fabfile']), path)
+
+
+@trace.timed()
+def build_artifact(revision):
+    """
+    Build source and virtualenv for revision into a release dir, pack it and
+    download the tarball. Runs on the build host.
+
+    :param revision: Revision to build
+    :return: tuple(release, local tarball path, sha256 digest)
+    """
+    from .deploy import update_source, install_virtualenv, \
+        install_requirements
+    from .project import sudo_project, project_home, git_repository, \
+        git_repository_path, requirements_txt, use_virtualenv, git_depth, \
+        git_filter, project_name
+
+    repository = git_repository()
+    build_root = os.path.join(project_home(), 'build')
+    build_repository_path = os.path.join(build_root, repository['name'])
+
+    with sudo_project() as project:
+        debian.mkdir(build_root, owner=project, group=project)
+        with cd(build_root):
+            _, cloned = git.clone(repository['url'],
+                                  branch=repository['branch'],
+                                  repository_path=build_repository_path,
+                                  depth=git_depth(),
+                                  filter=git_filter())
+            if cloned is None:
+                abort('Failed to clone build source, aborting!')
+
+    _, release = update_source(revision, repository_path=build_repository_path)
+    if not release:
+        abort('Failed to reset build source to {}, aborting!'.format(revision))
+
+    release_path = os.path.join(releases_path(), release)
+    release_src = os.path.join(release_path, 'src')
+    release_env = os.path.join(release_path, 'env')
+
+    with sudo_project() as project:
+        if files.exists(release_path):
+            info('Release {} already built, repacking', release)
+        else:
+            info('Building release {}', release)
+            debian.mkdir(release_src, owner=project, group=project)
+            run('cp -a {} {}'.format(build_repository_path, release_src))
+
+        # Alternates point at a reference repository only the build host has
+        release_repository_path = os.path.join(release_src, repository['name'])
+        alternates = os.path.join(release_repository_path,
+                                  '.git/objects/info/alternates')
+        if files.exists(alternates):
+            with cd(release_repository_path), silent():
+                output = run('git repack -a -d')
+            if output.failed:
+                abort('Failed to repack release {}: {}'.format(release, output))
+            debian.rm(alternates)
+
+    if use_virtualenv():
+        # Same relative requirements file, within the release source
+        requirements = os.path.join(
+            release_src, repository['name'],
+            os.path.relpath(requirements_txt(), git_repository_path()))
+
+        install_virtualenv(release_env)
+        install_requirements(requirements,
+                             path=release_env,
+                             src_path=os.path.join(release_src,
+                                                   repository['name']))
+
+    with sudo_project(), silent():
+        tarball = '/tmp/{}-{}.tar.gz'.format(project_name(), release)
+        output = run('tar -czf {} -C {} {}'.format(tarball, releases_path(), release))
+        if output.failed:
+            abort('Failed to pack release {}: {}'.format(release, output))
+        digest = run("sha256sum {} | cut -d' ' -f1".format(tarball)).strip()
+        artifact = '/tmp/{}-{}.tar.gz'.format(project_name(), digest)
+        debian.mv(tarball, artifact)
+
+    local_path = local_artifacts_path()
+    if not os.path.exists(local_path):
+        os.makedirs(local_path)
+
+    local_artifact = os.path.join(local_path, os.path.basename(artifact))
+    if not os.path.exists(local_artifact):
+        info('Downloading artifact {}', os.path.basename(artifact))
+        get(artifact, local_artifact)
+
+    # Packed by the project user, sticky /tmp
+    with sudo_project(), silent():
+        run('rm -f {}'.format(artifact))
+
+    return release, local_artifact, digest
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@trace.timed()
+def install_artifact(local_artifact, digest, release, activate=True):
+    """
+    Upload, verify and unpack an artifact, then make it the current release.
+
+    The release is unpacked next to its final path and only renamed into
+    place once complete, so that an existing release dir can be trusted.
+
+    :param local_artifact: Local tarball path
+    :param digest: Expected sha256 digest of tarball
+    :param release: Release name, the top dir within the tarball
+    :param bool activate: Make it the current release, else only unpack it
+    :return str: Installed release
+    """
+    from .project import sudo_project
+
+    if file_digest(local_artifact) != digest:
+        abort('Local artifact {} does not match digest {}'.format(
+            local_artifact, digest))
+
+    release_path = os.path.join(releases_path(), release)
+
+    with sudo_project() as project:
+        debian.mkdir(releases_path(), owner=project, group=project)
+        has_release = files.exists(release_path)
+
+    if not has_release:
+        remote_artifact = os.path.join('/tmp', os.path.basename(local_artifact))
+        put(local_artifact, remote_artifact, mode=0o644)
+
+        with silent():
+            remote_digest = run("sha256sum {} | cut -d' ' -f1".format(
+                remote_artifact)).strip()
+
+        if remote_digest != digest:
+            abort('Uploaded artifact {} does not match digest {}'.format(
+                remote_artifact, digest))
+
+        unpack_path = '{}.unpack'.format(release_path)
+        with sudo_project(), silent():
+            info('Unpacking release {}', release)
+            output = run('rm -rf {unpack} && mkdir {unpack} && '
+                         'tar -xzf {artifact} -C {unpack} && '
+                         'mv -T {unpack}/{release} {path} && rmdir {unpack}'.format(
+                             unpack=unpack_path, artifact=remote_artifact,
+                             release=release, path=release_path))
+            if output.failed:
+                run('rm -rf {}'.format(unpack_path))
+
+        with silent():
+            run('rm -f {}'.format(remote_artifact))
+
+        if output.failed:
+            abort('Failed to unpack release {}: {}'.format(release, output))
+
+    if activate:
+        activate_release(release)
+        cleanup_releases(keep=blueprint.get('artifact.keep_releases', 5))
+
+    return release
+
+
+@trace.timed()
+def activate_release(release):
+    """
+    Atomically point the current symlink at release and make sure the project
+    src and env paths resolve through it.
+
+    :param release: Release name
+    """
+    from .project import sudo_project, project_home
+
+    release_path = os.path.join(releases_path(), release)
+    current = current_release_path()
+
+    with sudo_project(), silent():
+        info('Activating release {}', release)
+        # rename(2) of a symlink is atomic, ln -sfn is not
+        output = run('ln -sfn {release} {current}.tmp && mv -Tf {current}.tmp {current}'
+                     .format(release=release_path, current=current))
+        if output.failed:
+            abort('Failed to activate release {}: {}'.format(release, output))
+
+    # A failed move must not leave a link within the old dir behind
+    with sudo_project(), settings(warn_only=False):
+        for name in ('src', 'env'):
+            path = os.path.join(project_home(), name)
+            if files.is_link(path):
+                continue
+
+            if files.exists(path):
+                # Keep the git based install around, but out of the way
+                debian.mv(path, '{}.orig'.format(path))
+
+            debian.ln(os.path.join(current, name), path)
+
+
+def is_artifact_deployed():
+    """
+    Check if current host runs a release installed by an artifact deploy.
+
+    :return bool: True if project src resolves through the current release
+    """
+    from .project import project_home
+    return files.is_link(os.path.join(project_home(), 'src'))
+
+
+def cleanup_releases(keep=5):
+    """
+    Remove all but the most recent releases, never the current one.
+
+    :param keep: Number of releases to keep
+    """
+    from .project import sudo_project
+
+    with sudo_project(), silent():
+        current = run('readlink -f {}'.format(current_release_path())).strip()
+        output = run('ls -1t {}'.format(releases_path()))
+
+    if not current or output.failed:
+        warn('Could not list releases, skipping cleanup')
+        return
+
+    # Leftovers of failed unpacks are not releases
+    stale = [os.path.join(releases_path(), name)
+             for name in output.split()[int(keep):]
+             if not name.endswith('.unpack')]
+
+    with sudo_project(), silent():
+        for path in stale:
+            if path != current:
+                info('Removing release {}', os.path.basename(path))
+                debian.rm(path, recursive=True)
@@ -0,0 +1,127 @@
+# coding=utf-8
+"""
+Load balancer draining and health checks for rolling reloads.
+
+Hosts are taken out of the nginx upstream, by marking them as down in the
+balancer's site config, or out of the haproxy backend, over its admin socket,
+while they are reloaded and put back once healthy.
+"""
+import time
+
+from fabric.state import env
+from fabric.tasks import execute
+
+from refabric.context_managers import silent
+from refabric.contrib import blueprints
+from refabric.operations import run
+from refabric.utils import info
+
+__all__ = [
+    'drain',
+    'undrain',
+    'wait_until_healthy',
+]
+
+blueprint = blueprints.get('blues.app')
+
+
+def balancer_hosts():
+    return blueprint.get('balancer.hosts', [])
+
+
+def upstream_address(host):
+    """
+    Get the upstream server address of a web host, as generated into the
+    nginx upstream.
+
+    :param host: Web host
+    :return str: host:port
+    """
+    socket = blueprint.get('web.socket', default='0.0.0.0:3030')
+    _, _, port = socket.partition(':')
+    return '{}:{}'.format(host, port)
+
+
+def set_hosts_enabled(hosts, enabled):
+    balancer = blueprint.get('balancer.type', 'nginx')
+    backend = blueprint.get('balancer.backend', blueprint.get('project'))
+
+    if balancer == 'haproxy':
+        from blues import haproxy
+        # Server names within backend, by host (Default: host)
+        names = blueprint.get('balancer.servers', {})
+        servers = [names.get(host, host) for host in hosts]
+        return execute(haproxy.set_servers_enabled, backend, servers,
+                       enabled=enabled, hosts=balancer_hosts())
+    elif balancer == 'nginx':
+        from blues import nginx
+        servers = [upstream_address(host) for host in hosts]
+        return execute(nginx.set_upstream_servers_down, backend, servers,
+                       down=not enabled, hosts=balancer_hosts())
+    else:
+        raise ValueError('Unknown balancer type: {}'.format(balancer))
+
+
+def drain(hosts):
+    """
+    Take hosts out of rotation on every balancer.
+
+    :param hosts: Web hosts
+    :return bool: True if all balancers succeeded, or there are none
+    """
+    if not balancer_hosts():
+        return True
+
+    info('Draining {} from {}', ', '.join(hosts), ', '.join(balancer_hosts()))
+    results = set_hosts_enabled(hosts, False)
+
+    # Let requests in flight finish
+    time.sleep(blueprint.get('balancer.drain_seconds', 2))
+
+    return all(result is True for result in results.values())
+
+
+def undrain(hosts):
+    """
+    Put hosts back into rotation on every balancer.
+
+    :param hosts: Web hosts
+    :return bool: True if all balancers succeeded, or there are none
+    """
+    if not balancer_hosts():
+        return True
+
+    info('Enabling {} on {}', ', '.join(hosts), ', '.join(balancer_hosts()))
+    results = set_hosts_enabled(hosts, True)
+    return all(result is True for result in results.values())
+
+
+def wait_until_healthy(timeout=None):
+    """
+    Wait until current host is ready to serve, by polling the health.url
+    setting on the host, or else the uWSGI web vassal stats socket.
+
+    :param timeout: Seconds to wait (Default: health.timeout setting or 60)
+    :return bool: True if healthy in time
+    """
+    timeout = int(timeout or blueprint.get('health.timeout', 60))
+    url = blueprint.get('health.url')
+
+    if url:
+        with silent():
+            output = run('for i in $(seq {timeout}); do '
+                         'curl -fsS -o /dev/null --max-time 2 {url} && exit 0; '
+                         'sleep 1; done; exit 1'.format(timeout=timeout, url=url),
+                         pty=False)
+        if not output.succeeded:
+            info('{} not healthy after {}s', env.host_string, timeout)
+        return output.succeeded
+
+    if blueprint.get('web.provider') == 'uwsgi':
+        from blues import uwsgi
+        from .providers.uwsgi import UWSGIProvider
+        vassal = blueprint.get('web.name', blueprint.get('project'))
+        return uwsgi.wait_for_workers(vassal, timeout=timeout,
+                                      minimum=UWSGIProvider.get_min_workers())
+
+    return True
@@ -1,17 +1,24 @@
 # coding=utf-8
 
+import base64
+import fcntl
 import os
+import pipes
 import pkg_resources
 import re
+import shlex
 
 from functools import partial
 
-from fabric.context_managers import cd
+from fabric.context_managers import cd, settings
+from fabric.contrib import files
+from fabric.operations import get, put
 from fabric.state import env
 from fabric.utils import indent, abort, warn
 from blues.application.project import git_repository_path
 
 from refabric.context_managers import sudo, silent
+from refabric.operations import run
 from refabric.utils import info
 from refabric.contrib import blueprints
 
@@ -23,6 +30,7 @@ from .. import user
 from .. import python
 from .. import virtualenv
 from .. import slack
+from .. import trace
 
 __all__ = [
     'install_project',
@@ -99,7 +107,7 @@ def install_project_structure():
     """
     from .project import static_base, use_static
 
-    with sudo():
+    with sudo(), debian.batch():
         info('Install application directory structure')
 
         create_app_root()
@@ -145,9 +153,11 @@ def install_system_dependencies():
                 debian.apt_get('install', *ppa_dependencies)
 
 
-def install_virtualenv():
+def install_virtualenv(path=None):
     """
     Create a project virtualenv.
+
+    :param path: Virtualenv path (Default: project virtualenv path)
     """
     from .project import sudo_project, virtualenv_path
 
@@ -155,9 +165,10 @@ def install_virtualenv():
         virtualenv.install()
 
     with sudo_project():
-        virtualenv.create(virtualenv_path())
+        virtualenv.create(path or virtualenv_path())
 
 
+@trace.timed()
 def maybe_install_requirements(previous_commit, current_commit, force=False, update_pip=False):
     from .project import requirements_txt, git_repository_path
 
@@ -166,6 +177,7 @@ def maybe_install_requirements(previous_commit, current_commit, force=False, upd
     installation_method = get_installation_method(installation_file)
 
     has_changed = False
+    incremental = False
 
     commit_range = '{}..{}'.format(previous_commit, current_commit)
 
@@ -180,6 +192,10 @@ def maybe_install_requirements(previous_commit, current_commit, force=False, upd
                 info('Requirements have changed, added: {}, removed: {}'.format(
                     ', '.join(added),
                     ', '.join(removed)))
+
+                # Sets are only returned when both revisions could be parsed
+                incremental = isinstance(added, set) and \
+                    blueprint.get('incremental_requirements', True)
         else:
             # Check if installation_file has changed
             commit_range = '{}..{}'.format(previous_commit, current_commit)
@@ -188,7 +204,10 @@ def maybe_install_requirements(previous_commit, current_commit, force=False, upd
                 commit_range,
                 installation_file)
 
-    if has_changed or force:
+    if incremental:
+        install_requirements_incremental(installation_file, added, removed,
+                                         update_pip=update_pip)
+    elif has_changed or force:
         install_requirements(installation_file, update_pip=update_pip)
     else:
         info(indent('(requirements not changed in {}...skipping)'),
@@ -203,7 +222,9 @@ def diff_requirements(previous_commit, current_commit, filename):
     :param current_commit:
     :param filename:
     :return: 3-tuple with (has_changed, additions, removals) where
-        has_changed is a bool, additions and removals may be sets or None.
+        has_changed is a bool, additions and removals are sets of
+        requirements if the smart diff succeeded, otherwise lists of
+        git diff stats.
     """
     try:
         return diff_requirements_smart(previous_commit,
@@ -242,6 +263,60 @@ def parse_requirements(strs):
     return pkg_resources.parse_requirements(strs)
 
 
+@trace.timed()
+def install_requirements_incremental(installation_file, added, removed,
+                                     update_pip=False):
+    """
+    Install only added/changed requirements and uninstall removed ones,
+    in project virtualenv.
+
+    :param installation_file: Requirements file, at its current revision
+    :param added: Set of added requirement specs, from diff_requirements_smart
+    :param removed: Set of removed requirement specs
+    """
+    from .project import sudo_project, virtualenv_path
+
+    filename = os.path.relpath(installation_file, git_repository_path())
+    content = git.show_file(git_repository_path(), filename)
+
+    # Map parsed specs back to their requirement lines, VCS urls can not be
+    # installed by their patched `pkg==version` spec.
+    lines = {}
+    for line in content.splitlines():
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            for requirement in parse_requirements(line):
+                lines[str(requirement)] = line
+        except ValueError:
+            continue
+
+    installs = []
+    for spec in sorted(added):
+        line = lines.get(spec, spec)
+        installs.extend(pipes.quote(arg) for arg in shlex.split(line))
+
+    added_names = {pkg_resources.Requirement.parse(spec).key for spec in added}
+    uninstalls = sorted(pkg_resources.Requirement.parse(spec).project_name
+                        for spec in removed)
+    uninstalls = [name for name in uninstalls
+                  if name.lower() not in added_names]
+
+    with sudo_project(), virtualenv.activate(virtualenv_path()), \
+            cd(git_repository_path()):
+        if update_pip:
+            python.update_pip(quiet=True)
+
+        if uninstalls:
+            info('Uninstalling removed requirements: {}', ', '.join(uninstalls))
+            python.pip('uninstall', '-y', *uninstalls, quiet=True)
+
+        if installs:
+            info('Installing changed requirements: {}', ', '.join(sorted(added)))
+            python.pip('install', *installs, quiet=True)
+
+
 def diff_requirements_smart(previous_commit, current_commit, filename,
                             strict=False):
     filename = os.path.relpath(filename, git_repository_path())
@@ -305,25 +380,44 @@ def get_installation_method(filename):
         return 'setuptools'
 
 
-def install_requirements(installation_file=None, update_pip=False):
+@trace.timed()
+def install_requirements(installation_file=None, update_pip=False,
+                         path=None, src_path=None):
     """
     Pip install requirements in project virtualenv.
+
+    :param installation_file: Requirements file (Default: project requirements)
+    :param path: Virtualenv path (Default: project virtualenv path)
+    :param src_path: Source path (Default: project repository path)
     """
-    from .project import sudo_project, virtualenv_path, requirements_txt
+    from .project import sudo_project, virtualenv_path, requirements_txt, \
+        use_wheelhouse
 
     if not installation_file:
         installation_file = requirements_txt()
 
-    src_path = git_repository_path()
-    path = virtualenv_path()
+    src_path = src_path or git_repository_path()
+    path = path or virtualenv_path()
     installation_method = get_installation_method(installation_file)
     with sudo_project(), virtualenv.activate(path), cd(src_path):
         if update_pip:
             python.update_pip(quiet=True)
 
         if installation_method == 'pip':
+            wheel_dir = install_wheelhouse(installation_file) \
+                if use_wheelhouse() else None
+
             info('Installing requirements from: {}', installation_file)
-            python.pip('install', '-r', installation_file, quiet=True)
+            if wheel_dir:
+                with settings(warn_only=True):
+                    output = python.pip('install', '-r', installation_file,
+                                        quiet=True, find_links=wheel_dir)
+                if output.failed:
+                    warn('Wheelhouse is missing requirements, installing from index')
+                    wheel_dir = None
+
+            if not wheel_dir:
+                python.pip('install', '-r', installation_file, quiet=True)
 
         elif installation_method == 'pip-sync':
             info('Syncing requirements from: {}', installation_file)
@@ -338,6 +432,132 @@ def install_requirements(installation_file=None, update_pip=False):
                              installation_file))
 
 
+# Hashes a requirements file together with its nested -r and -c files
+requirements_digest_script = """
+import hashlib, os, re, sys
+sha = hashlib.sha256()
+seen = set()
+def walk(path):
+    path = os.path.normpath(path)
+    if path in seen:
+        return
+    seen.add(path)
+    with open(path, 'rb') as f:
+        content = f.read()
+    sha.update(content)
+    for line in content.decode('utf-8').splitlines():
+        match = re.match(r'\\s*(-r|-c|--requirement|--constraint)[\\s=]+(\\S+)', line)
+        if match:
+            walk(os.path.join(os.path.dirname(path), match.group(2)))
+walk(sys.argv[1])
+print(sha.hexdigest())
+"""
+
+
+def requirements_digest(installation_file):
+    """
+    Get sha256 digest of a requirements file and all files it includes.
+
+    :param installation_file: Requirements file
+    :return str: Hex digest, or None if any file could not be read
+    """
+    with silent():
+        output = run('echo {} | base64 -d | python - {}'.format(
+            base64.b64encode(requirements_digest_script.encode('utf-8')).decode('ascii'),
+            installation_file), pty=False)
+
+    return output.strip() if output.succeeded else None
+
+
+@trace.timed()
+def install_wheelhouse(installation_file):
+    """
+    Make wheels for requirements available on current host.
+
+    Wheels are keyed by the resolved requirements hash and interpreter ABI.
+    They are built on the first host that needs them, cached locally and
+    shipped to the remaining hosts instead of being downloaded and built
+    again. Hosts of a parallel run wait on a local lock for the first build.
+
+    Must be called with the target virtualenv activated.
+
+    :param installation_file: Requirements file
+    :return str: Remote wheel dir, or None if wheels could not be built
+    """
+    from .project import sudo_project, project_home
+
+    with sudo_project():
+        digest = requirements_digest(installation_file)
+        if not digest:
+            warn('Failed to hash requirements, installing from index')
+            return None
+        key = '{}-{}'.format(digest[:16], python.abi_tag())
+
+    wheel_dir = os.path.join(project_home(), 'wheelhouse', key)
+    # Built or unpacked here, then renamed, so that wheel_dir is always complete
+    partial_dir = '{}.partial'.format(wheel_dir)
+    local_archive = os.path.join(local_wheelhouse_path(), '{}.tar.gz'.format(key))
+    remote_archive = os.path.join('/tmp', os.path.basename(local_archive))
+
+    with sudo_project() as project:
+        if files.exists(wheel_dir):
+            info('Using wheelhouse: {}', key)
+            return wheel_dir
+
+        with silent():
+            debian.rm(partial_dir, recursive=True)
+        debian.mkdir(partial_dir, owner=project, group=project)
+
+    try:
+        os.makedirs(local_wheelhouse_path())
+    except OSError:
+        pass  # Already there
+
+    with open('{}.lock'.format(local_archive), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(local_archive):
+                info('Shipping wheelhouse: {}', key)
+                put(local_archive, remote_archive, mode=0o644)
+                with sudo_project(), silent():
+                    ok = run('tar -xzf {} -C {}'.format(remote_archive,
+                                                        partial_dir)).succeeded
+
+            else:
+                with sudo_project():
+                    ok = python.build_wheels(installation_file, partial_dir)
+
+                if ok:
+                    with sudo_project(), silent():
+                        ok = run('tar -czf {} -C {} .'.format(remote_archive,
+                                                              partial_dir)).succeeded
+                if ok:
+                    get(remote_archive, '{}.tmp'.format(local_archive))
+                    os.rename('{}.tmp'.format(local_archive), local_archive)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # Uploaded by the ssh user or packed by the project user, sticky /tmp
+    with sudo(), silent():
+        run('rm -f {}'.format(remote_archive))
+
+    with sudo_project(), silent():
+        if ok:
+            ok = run('mv -T {} {}'.format(partial_dir, wheel_dir)).succeeded
+
+        if not ok:
+            warn('Failed to build or unpack wheelhouse, installing from index')
+            debian.rm(partial_dir, recursive=True)
+            return None
+
+    return wheel_dir
+
+
+def local_wheelhouse_path():
+    path = blueprint.get('wheelhouse_path', 'wheelhouse')
+    return os.path.join(os.path.dirname(env['real_fabfile']), path)
+
+
 def install_or_update_source():
     """
     Try to install source, if already installed then update.
@@ -353,44 +573,99 @@ def install_source():
 
     :return: True, if repository got cloned
     """
-    from .project import sudo_project, git_repository, git_root
+    from .project import sudo_project, git_repository, git_root, \
+        git_depth, git_filter
 
     with sudo():
         git.install()
 
+    reference = update_git_reference()
+
     with sudo_project() as project:
         path = git_root()
         debian.mkdir(path, owner=project, group=project)
         with cd(path):
             repository = git_repository()
-            path, cloned = git.clone(repository['url'], branch=repository['branch'])
+            path, cloned = git.clone(repository['url'],
+                                     branch=repository['branch'],
+                                     reference=reference,
+                                     depth=git_depth(),
+                                     filter=git_filter())
             if cloned is None:
                 abort('Failed to install source, aborting!')
 
     return cloned
 
 
-def update_source(revision=None):
+def update_git_reference(revision=None):
+    """
+    Create or update the configured git reference repository.
+
+    :param revision: Commit hash to deploy, the reference is not fetched if it
+                     already has it
+    :return str: Reference repository path, or None if not configured/usable
+    """
+    from .project import sudo_project, git_repository, git_reference, \
+        git_reference_update
+
+    reference = git_reference()
+    if not reference:
+        return None
+
+    with sudo():
+        # Shared between projects, writable by members of app-data
+        debian.mkdir(os.path.dirname(reference.rstrip('/')),
+                     group='app-data', mode=1775)
+
+    with sudo_project():
+        if git_reference_update():
+            if not git.mirror(git_repository()['url'], reference,
+                              revision=revision):
+                return None
+        elif not files.exists(reference):
+            return None
+
+    return reference
+
+
+@trace.timed()
+def update_source(revision=None, repository_path=None):
     """
     Update application repository to the specified revision,
     defaults to the projects branch if not specified.
 
+    :param repository_path: Repository path (Default: project repository path)
     :return: tuple(previous commit, current commit)
     """
-    from .project import sudo_project, git_repository_path, remote_head
+    from .project import sudo_project, git_repository_path, remote_head, \
+        git_depth, git_reference_update
+
+    if not repository_path:
+        from .artifact import is_artifact_deployed
+        if is_artifact_deployed():
+            # A reset would rewrite the current release in place
+            abort('Source is installed from an artifact release, '
+                  'deploy with app.deploy_artifact instead')
 
     if not revision:
         branch, revision = remote_head()
 
+    reference = update_git_reference(revision)
+
     with sudo_project():
         # Get current commit
-        repository_path = git_repository_path()
+        repository_path = repository_path or git_repository_path()
         previous_commit = git.get_commit(repository_path, short=True)
 
+        if reference:
+            git.set_alternates(repository_path, reference)
+
         # Update source from git (reset)
         current_commit = git.reset(repository_path=repository_path,
                                    revision=revision,
-                                   ignore=blueprint.get('git_force_ignore'))
+                                   ignore=blueprint.get('git_force_ignore'),
+                                   depth=git_depth(),
+                                   reference=reference if git_reference_update() else None)
 
         return previous_commit, current_commit
 
@@ -445,6 +720,7 @@ def _deploy_summary(title, revision):
     return summary
 
 
+@trace.timed()
 def notify_start(title, revision=None, changes=None, max_changes=8):
     """
     Send a message to slack about the start of a deployment
@@ -478,6 +754,7 @@ def notify_start(title, revision=None, changes=None, max_changes=8):
     slack.notify(None, summary)
 
 
+@trace.timed()
 def notify_finish(title, revision=None):
     """
     Send a message to slack about the end of a deployment
@@ -490,6 +767,7 @@ def notify_finish(title, revision=None):
     slack.notify(None, summary)
 
 
+@trace.timed()
 def notify_event(commits=None):
     """
     Send a message to slack about a successful deployment
@@ -519,5 +797,6 @@ def notify_event(commits=None):
         host=env['host_string']
     )
 
-    slack.notify(msg)
+    # Coalesced into one summary post per batch during rolling deploys
+    slack.notify(msg, coalesce=True)
     return msg
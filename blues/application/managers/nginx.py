@@ -7,6 +7,7 @@ from refabric.contrib import blueprints
 from .base import BaseManager
 
 from ... import nginx
+from ... import manifest
 
 blueprint = blueprints.get('blues.app')
 
@@ -35,7 +36,7 @@ class NginxManager(BaseManager):
         default_templates = nginx.blueprint.get_default_template_root()
 
         with settings(template_dirs=[default_templates]):
-            uploads = blueprint.upload(
+            uploads = manifest.upload(blueprint,
                 template,
                 os.path.join(destination,
                              '{}.conf'.format(program_name)),
@@ -9,6 +9,7 @@ from ..project import *
 
 from ... import debian
 from ... import supervisor
+from ... import manifest
 
 blueprint = blueprints.get('blues.app')
 
@@ -68,10 +69,10 @@ class SupervisorManager(BaseManager):
             destination = os.path.join(destination, name)
 
         with settings(template_dirs=[default_templates]):
-            return blueprint.upload(template, destination, context=context)
+            return manifest.upload(blueprint, template, destination, context=context)
 
-    def reload(self, program=None):
-        supervisor.reload(program)
+    def reload(self, program=None, timeout=60):
+        return supervisor.reload(program, timeout=timeout)
 
     def start(self, program=None):
         supervisor.start(program)
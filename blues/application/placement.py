@@ -0,0 +1,252 @@
+# coding=utf-8
+"""
+Placement of celery queues on worker hosts.
+
+Each queue's load, from its declared or measured task rate, average runtime
+and memory per process, is turned into a number of worker processes, which
+are packed onto the worker hosts by their cores and memory. Queues with a
+hosts setting stay pinned to those hosts, the rest are placed on
+worker.placement.redundancy hosts each, sized so that the queue keeps its
+full capacity with any one of those hosts lost (N+1).
+
+The placement is written to a file next to the fabfile, for review and to
+keep configure runs stable, and read back when configuring each host::
+
+    10.0.0.10:
+      index: 4
+      mail: 1
+    10.0.0.11:
+      index: 4
+"""
+import math
+import os
+
+import yaml
+
+from fabric.context_managers import settings
+from fabric.state import env
+from fabric.tasks import execute
+from fabric.utils import abort, warn
+
+from refabric.contrib import blueprints
+
+from .. import debian
+
+__all__ = [
+    'place_queues',
+    'get_placement',
+    'host_queues',
+]
+
+blueprint = blueprints.get('blues.app')
+
+
+def placement_settings():
+    placement = blueprint.get('worker.placement') or {}
+    return placement if isinstance(placement, dict) else {}
+
+
+def placement_path():
+    path = placement_settings().get('path', 'placement.yml')
+    return os.path.join(os.path.dirname(env['real_fabfile']), path)
+
+
+def worker_hosts():
+    return blueprint.get('worker.hosts') or env.hosts
+
+
+def host_capacity():
+    """
+    Get worker process and memory capacity of current host.
+
+    :return dict: {processes, memory}, memory in MB
+    """
+    cpu_factor = blueprint.get('worker.cpu_factor', 2)
+    memory_ratio = blueprint.get('worker.memory_ratio', 0.75)
+    return {
+        'processes': debian.nproc() * cpu_factor,
+        'memory': debian.total_memory() / 1024.0 ** 2 * memory_ratio,
+    }
+
+
+def get_capacities(hosts):
+    """
+    Get capacity of worker hosts, in parallel.
+
+    :return dict: {host: {processes, memory}, ...}, unreachable hosts are left out
+    """
+    with settings(parallel=True, warn_only=True):
+        capacities = execute(host_capacity, hosts=hosts)
+
+    return {host: capacity for host, capacity in capacities.items()
+            if isinstance(capacity, dict)}
+
+
+def load_measurements():
+    """
+    Read measured queue load from the worker.placement.load file, if any.
+
+    :return dict: {queue: {rate, runtime, memory}, ...}
+    """
+    path = placement_settings().get('load')
+    if not path:
+        return {}
+
+    path = os.path.join(os.path.dirname(env['real_fabfile']), path)
+    if not os.path.exists(path):
+        warn('Queue load file {} not found, using declared load'.format(path))
+        return {}
+
+    with open(path) as f:
+        return yaml.safe_load(f) or {}
+
+
+def get_demand(queue, target_busy, memory_per_child):
+    """
+    Get worker processes and memory a queue needs in total.
+
+    A queue keeps rate * runtime processes busy on average, by Little's law,
+    and needs that many over target_busy to keep up with bursts.
+
+    :param queue: Queue settings, {rate, runtime, memory, workers}
+    :return tuple: (processes, memory per process in MB)
+    """
+    rate = float(queue.get('rate') or 0)
+    runtime = float(queue.get('runtime') or 0)
+
+    if rate and runtime:
+        processes = int(math.ceil(rate * runtime / target_busy))
+    else:
+        processes = int(queue.get('workers', 1))
+
+    return max(1, processes), float(queue.get('memory', memory_per_child))
+
+
+def place_queues(queues, capacities, redundancy=1, measured=None):
+    """
+    Pack queue worker processes onto hosts.
+
+    Pinned queues are split over their hosts first. The rest are placed,
+    largest first, on the least utilized hosts with room to spare, each
+    replica on a different host. A replica that fits nowhere goes to the least
+    utilized host, which is then reported as overcommitted. Each replica gets
+    the demand over replicas - 1, so the others cover a lost host.
+
+    :param queues: Queue settings, {name: {rate, runtime, memory, workers, hosts}, ...}
+    :param capacities: Host capacities, {host: {processes, memory}, ...}
+    :param redundancy: Hosts per unpinned queue
+    :param measured: Measured queue load overriding the declared, {name: {rate, runtime, memory}, ...}
+    :return tuple: ({host: {queue: workers, ...}, ...}, {host: utilization, ...})
+    """
+    target_busy = float(placement_settings().get('target_busy', 0.7))
+    memory_per_child = blueprint.get('worker.memory_per_child', 256)  # MB
+    measured = measured or {}
+
+    hosts = sorted(capacities)
+    if not hosts:
+        abort('No worker hosts to place queues on')
+
+    placement = {host: {} for host in hosts}
+    used = {host: {'processes': 0, 'memory': 0.0} for host in hosts}
+
+    def utilization(host, processes=0, memory=0.0):
+        capacity = capacities[host]
+        return max((used[host]['processes'] + processes) / float(capacity['processes'] or 1),
+                   (used[host]['memory'] + memory) / float(capacity['memory'] or 1))
+
+    def assign(host, name, processes, memory):
+        placement[host][name] = processes
+        used[host]['processes'] += processes
+        used[host]['memory'] += processes * memory
+
+    demands = {}
+    for name, queue in queues.items():
+        queue = dict(queue or {}, **(measured.get(name) or {}))
+        demands[name] = get_demand(queue, target_busy, memory_per_child)
+
+    # Pinned queues first, they leave the others less room
+    unpinned = []
+    for name, queue in queues.items():
+        pinned = (queue or {}).get('hosts')
+        if not pinned:
+            unpinned.append(name)
+            continue
+
+        pinned = [host for host in pinned if host in capacities]
+        if not pinned:
+            warn('Queue {} is pinned to unknown or unreachable hosts, '
+                 'not placed'.format(name))
+            continue
+
+        processes, memory = demands[name]
+        per_host = int(math.ceil(processes / float(len(pinned))))
+        for host in pinned:
+            assign(host, name, per_host, memory)
+
+    replicas = max(1, min(int(redundancy), len(hosts)))
+    unpinned.sort(key=lambda name: (-demands[name][0] * demands[name][1], name))
+
+    for name in unpinned:
+        processes, memory = demands[name]
+        per_host = int(math.ceil(processes / float(max(1, replicas - 1))))
+
+        for _ in range(replicas):
+            candidates = [host for host in hosts if name not in placement[host]]
+            fitting = [host for host in candidates
+                       if utilization(host, per_host, per_host * memory) <= 1]
+            host = min(fitting or candidates,
+                       key=lambda host: (utilization(host, per_host, per_host * memory), host))
+            assign(host, name, per_host, memory)
+
+    return placement, {host: utilization(host) for host in hosts}
+
+
+def save_placement(placement, path=None):
+    with open(path or placement_path(), 'w') as f:
+        yaml.safe_dump(placement, f, default_flow_style=False)
+
+
+def get_placement():
+    """
+    Read the saved placement.
+
+    :return dict: {host: {queue: workers, ...}, ...}
+    """
+    path = placement_path()
+    if not os.path.exists(path):
+        abort('No queue placement at {}, run app.place_queues first'.format(path))
+
+    with open(path) as f:
+        return yaml.safe_load(f) or {}
+
+
+def host_queues(queues, host):
+    """
+    Get the settings of the queues placed on host, with their worker count.
+
+    Placed queues are marked, so that the planner sizes their concurrency
+    within the placed workers rather than keeping them as fixed.
+
+    :param queues: Queue settings, {name: {...}, ...}
+    :param host: Worker host
+    :return dict: {name: {workers, placed, ...}, ...}
+    """
+    placement = get_placement()
+    placed = placement.get(host) or {}
+
+    missing = set(queues) - set(name for assigned in placement.values()
+                                for name in assigned or {})
+    if missing:
+        warn('Queue(s) {} not placed on any host, run app.place_queues'.format(
+            ', '.join(sorted(missing))))
+
+    context = {}
+    for name, workers in placed.items():
+        if name not in queues:
+            continue
+
+        queue = dict(queues[name] or {}, workers=workers, placed=True)
+        queue.pop('hosts', None)
+        context[name] = queue
+
+    return context
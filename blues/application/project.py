@@ -13,7 +13,9 @@ from .. import git
 
 __all__ = [
     'app_root', 'project_home', 'git_root', 'use_virtualenv', 'use_pip_sync',
+    'use_wheelhouse',
     'virtualenv_path', 'git_repository', 'git_repository_path', 'python_path',
+    'git_reference', 'git_reference_update', 'git_depth', 'git_filter',
     'sudo_project', 'requirements_txt', 'use_python', 'static_base',
     'project_name', 'releases', 'remote_head', 'github_repo', 'github_link'
 ]
@@ -29,6 +31,9 @@ use_virtualenv = lambda: blueprint.get('use_virtualenv', True) and use_python()
 # install virtualenv and python dependencies
 use_pip_sync = lambda: blueprint.get('pip_sync', False) and use_python()
 
+# build requirement wheels once and share them between hosts
+use_wheelhouse = lambda: blueprint.get('wheelhouse', False) and use_virtualenv()
+
 # Should we set up /srv/www?
 use_static = lambda: blueprint.get('use_static', True)
 
@@ -48,6 +53,14 @@ git_repository = lambda: git.parse_url(blueprint.get('git_url'),
 # /srv/app/project/src/repo.git
 git_repository_path = lambda: os.path.join(git_root(),
                                            git_repository()['name'])
+# /srv/git/repo.git, shared object store used as clone --reference
+git_reference = lambda: blueprint.get('git_reference')
+# Fetch origin into the reference repository before reset
+git_reference_update = lambda: blueprint.get('git_reference_update', True)
+# Shallow clone/fetch depth
+git_depth = lambda: blueprint.get('git_depth')
+# Partial clone filter, ex blob:none
+git_filter = lambda: blueprint.get('git_filter')
 # 1.2, 1.2.3, v1.0
 git_tag_pattern = lambda: blueprint.get('release_pattern') or r'^v?\d+(\.\d+)+$'
 
@@ -1,3 +1,13 @@
+import math
+import time
+
+from fabric.state import env
+from fabric.utils import abort, warn
+
+from refabric.context_managers import sudo, silent
+from refabric.operations import run
+from refabric.utils import info
+
 from .base import ManagedProvider
 
 from ... import debian
@@ -20,6 +30,8 @@ class CeleryProvider(ManagedProvider):
         context.update({
             'workers': blueprint.get('worker.workers', debian.nproc()),
             'extensions': self.get_extensions(),
+            # Warm shutdown lets running tasks finish within this time
+            'stopwaitsecs': self.get_stop_timeout(),
         })
 
         # Override context defaults with blueprint settings
@@ -27,6 +39,16 @@ class CeleryProvider(ManagedProvider):
 
         context['fallback'] = fallback = 'queues' not in context
 
+        if not fallback:
+            context['queues'] = self.get_queues()
+
+        if not fallback and context.get('planner'):
+            gb_memory = debian.total_memory() / 1024.0 ** 3
+            context['queues'] = plan_queues(context['queues'] or {},
+                                            cores=debian.nproc(),
+                                            gb_memory=gb_memory,
+                                            host=env.host_string)
+
         # Find and add programs to group
         context['celery_group'] = context.get('extensions', [])
         if fallback:
@@ -37,7 +59,131 @@ class CeleryProvider(ManagedProvider):
         return context
 
     def reload(self):
-        self.manager.reload('celery:*')
+        """
+        Restart all celery programs at once, or with the worker.restart
+        setting set to rolling, restart queue programs a few at a time.
+        """
+        queues = self.get_queues()
+        timeout = self.get_restart_timeout()
+        if blueprint.get('worker.restart') != 'rolling' or not queues:
+            self.manager.reload('celery:*', timeout=timeout)
+            return
+
+        batch_size = int(blueprint.get('worker.restart_batch', 1))
+        programs = self.get_restart_order(queues)
+        batches = [programs[i:i + batch_size]
+                   for i in range(0, len(programs), batch_size)]
+
+        for i, batch in enumerate(batches, start=1):
+            info('Restarting celery queue(s) {}/{}: {}', i, len(batches),
+                 ', '.join(batch))
+            offsets = self.get_log_offsets(batch)
+            restarted = self.manager.reload(
+                ','.join('celery:{}'.format(program) for program in batch),
+                timeout=timeout)
+            if restarted is False or not self.wait_for_ready(batch, offsets):
+                abort('Celery queue(s) {} did not get ready, aborting rolling '
+                      'restart'.format(', '.join(batch)))
+
+        extensions = self.get_extensions()
+        if extensions:
+            self.manager.reload(
+                ','.join('celery:{}'.format(program) for program in extensions),
+                timeout=timeout)
+
+    @staticmethod
+    def get_stop_timeout():
+        return int(blueprint.get('worker.stop_timeout', 10))
+
+    def get_restart_timeout(self):
+        """
+        Get seconds a restart may take, the warm shutdown plus the startsecs
+        supervisor waits before a started program counts as running.
+
+        :return int: Seconds
+        """
+        startsecs = 10  # See supervisor/default/program.conf
+        return self.get_stop_timeout() + startsecs + 10
+
+    @staticmethod
+    def get_queues():
+        """
+        Get queue settings, only the queues placed on current host if the
+        worker.placement setting is enabled, see app.place_queues.
+
+        :return dict: {name: {...}, ...}
+        """
+        queues = blueprint.get('worker.queues') or {}
+        if queues and blueprint.get('worker.placement'):
+            from ..placement import host_queues
+            queues = host_queues(queues, env.host_string)
+
+        return queues
+
+    @staticmethod
+    def get_restart_order(queues):
+        """
+        Order queue programs by their order setting, then by name.
+
+        :return list: Queue program names
+        """
+        return sorted(queues, key=lambda name: ((queues[name] or {}).get('order', 0), name))
+
+    @staticmethod
+    def get_log_path(program):
+        return '/var/log/supervisord/{}.err.log'.format(program)
+
+    def get_log_offsets(self, programs):
+        """
+        Get current inodes and sizes of program logs, to only look at new log
+        lines.
+
+        :return dict: {program: (inode, offset), ...}
+        """
+        with sudo(), silent():
+            output = run('; '.join("stat -c '%i %s' {} 2>/dev/null || echo 0 0".format(
+                self.get_log_path(program)) for program in programs), pty=False)
+
+        stats = [int(value) for value in output.split()]
+        return dict(zip(programs, zip(stats[::2], stats[1::2])))
+
+    def wait_for_ready(self, programs, offsets, timeout=None):
+        """
+        Wait for celery to log that the restarted workers are ready.
+
+        :return bool: True if all workers are ready in time
+        """
+        timeout = int(timeout or blueprint.get('worker.ready_timeout', 60))
+        deadline = time.time() + timeout
+        pending = list(programs)
+
+        while pending:
+            with sudo(), silent():
+                output = run('; '.join(
+                    self.get_ready_command(program, *offsets.get(program, (0, 0)))
+                    for program in pending) + '; true', pty=False)
+
+            ready = output.split()
+            pending = [program for program in pending if program not in ready]
+
+            if pending and time.time() > deadline:
+                warn('Timed out waiting for celery queue(s): {}'.format(', '.join(pending)))
+                return False
+            elif pending:
+                time.sleep(1)
+
+        return True
+
+    def get_ready_command(self, program, inode, offset):
+        """
+        Get command echoing program if its log tells it is ready, reading the
+        log from the start if it has been rotated since the offset was taken.
+        """
+        return ("o={offset}; "
+                "[ \"$(stat -c %i {path} 2>/dev/null)\" = {inode} ] && "
+                "[ $(stat -c %s {path}) -ge $o ] || o=0; "
+                "tail -c +$((o + 1)) {path} | grep -q ' ready\\.' && echo {program}").format(
+            offset=offset, inode=inode, path=self.get_log_path(program), program=program)
 
     def start(self):
         self.manager.start('celery:*')
@@ -80,3 +226,114 @@ class CeleryProvider(ManagedProvider):
                 'celery.conf'))
 
         return self.updates
+
+
+def plan_queues(queues, cores, gb_memory, host=None):
+    """
+    Allocate worker processes and concurrency across the queues on a host.
+
+    Prefork queues share the host's process budget, the smallest of cores *
+    worker.cpu_factor and what fits in worker.memory_ratio of memory at
+    memory_per_child each, by their weight. Gevent queues share
+    worker.gevent_concurrency greenlets by weight in a single process each,
+    and solo queues get a single process. Queues with a fixed number of
+    workers keep it, but count against the budget, leaving the other prefork
+    queues a single process each if they use it all. Queues placed by
+    app.place_queues get their placed workers, but are planned like the rest.
+
+    The planned max_memory_per_child and prefetch_multiplier options require
+    Celery 4 or later.
+
+    :param queues: Queue settings, {name: {weight, pool, memory_per_child, prefetch_multiplier, workers, placed, hosts}, ...}
+    :param cores: Core count
+    :param gb_memory: Total memory in GB
+    :param host: Current host, queues restricted to other hosts are left as is
+    :return dict: Queue settings, with workers, autoscale, pool,
+        max_tasks_per_child, max_memory_per_child and prefetch_multiplier
+    """
+    default_pool = blueprint.get('worker.pool', 'prefork')
+    memory_per_child = blueprint.get('worker.memory_per_child', 256)  # MB
+    prefetch_multiplier = blueprint.get('worker.prefetch_multiplier', 1)
+    max_tasks_per_child = blueprint.get('worker.max_tasks_per_child', 1000)
+    memory_ratio = blueprint.get('worker.memory_ratio', 0.75)
+    cpu_factor = blueprint.get('worker.cpu_factor', 2)
+    gevent_concurrency = blueprint.get('worker.gevent_concurrency', 100)
+
+    planned = {}
+    local = {}
+    for name, queue in queues.items():
+        queue = dict(queue or {})
+        queue.setdefault('pool', default_pool)
+        queue.setdefault('weight', 1)
+        queue.setdefault('memory_per_child', memory_per_child)
+        queue.setdefault('prefetch_multiplier', prefetch_multiplier)
+        planned[name] = queue
+
+        hosts = queue.get('hosts')
+        if not hosts or host in hosts:
+            local[name] = queue
+
+    if not local:
+        return planned
+
+    # Process budget, limited by cores and by memory
+    memory_mb = gb_memory * 1024 * memory_ratio
+    average_child = sum(queue['memory_per_child'] for queue in local.values()) \
+        / float(len(local))
+    budget = int(min(cores * cpu_factor, memory_mb // average_child))
+
+    for queue in local.values():
+        if queue['pool'] != 'prefork':
+            budget -= 1
+        elif 'workers' in queue:
+            budget -= int(queue['workers'])
+
+    if budget < 0:
+        warn('Fixed and placed queue workers overcommit {} by {} process(es)'.format(
+            host or 'host', -budget))
+        budget = 0
+
+    # Placed workers are sized by the placement, not pinned by the user
+    plannable = {name: queue for name, queue in local.items()
+                 if 'workers' not in queue or queue.get('placed')}
+    prefork = {name: queue for name, queue in plannable.items()
+               if queue['pool'] == 'prefork'}
+    # Placed gevent queues keep the workers the placement accounted for
+    gevent = {name: queue for name, queue in local.items()
+              if queue['pool'] == 'gevent' and 'workers' not in queue}
+    shared = {name: queue for name, queue in prefork.items()
+              if 'workers' not in queue}
+
+    # Share the budget by weight, leftover processes to the largest remainders
+    prefork_weight = float(sum(queue['weight'] for queue in shared.values()) or 1)
+    shares = {name: budget * queue['weight'] / prefork_weight
+              for name, queue in shared.items()}
+    allocated = {name: int(share) for name, share in shares.items()}
+    leftover = max(0, budget - sum(allocated.values()))
+    for name in sorted(shares, key=lambda name: allocated[name] - shares[name])[:leftover]:
+        allocated[name] += 1
+
+    for name, queue in prefork.items():
+        if name not in shared:
+            allocated[name] = int(queue['workers'])
+
+    for name, queue in prefork.items():
+        maximum = max(1, allocated[name])
+        minimum = max(1, int(math.ceil(maximum / 4.0)))
+        queue['workers'] = maximum
+        queue['autoscale'] = '{},{}'.format(maximum, minimum) \
+            if maximum > minimum else None
+        queue['max_tasks_per_child'] = queue.get('max_tasks_per_child',
+                                                 max_tasks_per_child)
+        # Celery expects KB
+        queue['max_memory_per_child'] = int(queue['memory_per_child'] * 1024)
+
+    gevent_weight = float(sum(queue['weight'] for queue in gevent.values()) or 1)
+    for queue in gevent.values():
+        queue['workers'] = max(1, int(gevent_concurrency * queue['weight'] / gevent_weight))
+
+    for queue in local.values():
+        if queue['pool'] == 'solo':
+            queue['workers'] = 1
+
+    return planned
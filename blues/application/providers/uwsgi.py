@@ -11,6 +11,7 @@ from .base import ManagedProvider
 from ..project import *
 
 from ... import debian
+from ... import manifest
 from ...app import blueprint
 
 
@@ -61,10 +62,9 @@ class UWSGIProvider(ManagedProvider):
         context = super(UWSGIProvider, self).get_context()
 
         # Memory optimized options
-        cpu_count = blueprint.get('web.max_cores', debian.nproc())
-        total_memory = int(round(debian.total_memory() / 1024.0 / 1024.0 / 1024.0))
-        total_memory = blueprint.get('web.max_memory', default=total_memory)
-        workers = blueprint.get('web.workers', default=uwsgi.get_worker_count(cpu_count))
+        cpu_count, total_memory = self.get_resources()
+        sizing = self.get_adaptive_sizing(cpu_count, total_memory)
+        workers = blueprint.get('web.workers', default=sizing.get('workers') or uwsgi.get_worker_count(cpu_count))
         gevent = blueprint.get('web.gevent', default=0)
         info('Generating uWSGI conf based on {} core(s), {} GB memory and {} worker(s)',
              cpu_count, total_memory, workers)
@@ -81,11 +81,68 @@ class UWSGIProvider(ManagedProvider):
             'http': blueprint.get('web.http') == 'true',
         })
 
+        # Scale workers with traffic, between cheaper and workers
+        cheaper_algo = blueprint.get('web.cheaper_algo')
+        if cheaper_algo:
+            context.update(uwsgi.get_cheaper_context(cheaper_algo, cpu_count,
+                                                     total_memory, workers))
+
+        # Adaptive sizing from live stats, explicit settings still win
+        sizing.pop('workers', None)
+        context.update(sizing)
+
         # Override context defaults with blueprint settings
         context.update(blueprint.get('web'))
 
         return context
 
+    @staticmethod
+    def get_resources():
+        """
+        Get cores and memory the web vassal is sized for, limited by the
+        web.max_cores and web.max_memory settings.
+
+        :return tuple: (core count, memory in GB)
+        """
+        cpu_count = blueprint.get('web.max_cores', debian.nproc())
+        total_memory = int(round(debian.total_memory() / 1024.0 / 1024.0 / 1024.0))
+        total_memory = blueprint.get('web.max_memory', default=total_memory)
+        return cpu_count, total_memory
+
+    def get_adaptive_sizing(self, cpu_count, total_memory, sample=None):
+        """
+        Get web vassal sizing from the running vassal's live stats, if
+        web.adaptive is enabled or a stats sample is given.
+
+        :param cpu_count: Core count
+        :param total_memory: Memory in GB
+        :param sample: Stats sample, see uwsgi.sample_stats (Default: sampled now)
+        :return dict: Recommended context, empty if disabled or no stats
+        """
+        from blues import uwsgi
+
+        if sample is None:
+            web_vassal = self.get_web_vassal()
+            if not blueprint.get('web.adaptive', False) or not web_vassal:
+                return {}
+
+            vassal_name = os.path.splitext(web_vassal)[0]
+            sample = uwsgi.sample_stats(vassal_name,
+                                        samples=blueprint.get('web.adaptive_samples', 5))
+            if not sample:
+                info(indent('...no live stats for {}, using static sizing'), vassal_name)
+                return {}
+
+        # Never below the static worker count, autoscale only if asked for
+        min_workers = blueprint.get('web.min_workers',
+                                    default=uwsgi.get_worker_count(cpu_count))
+        return uwsgi.get_adaptive_sizing(
+            sample, cpu_count, total_memory,
+            target_busy=blueprint.get('web.target_busy', 0.6),
+            max_listen=debian.somaxconn(),
+            min_workers=min_workers,
+            cheaper=bool(blueprint.get('web.cheaper_algo')))
+
     def configure_web(self):
         """
         Render and upload web.ini vassal to <project>.ini.
@@ -107,12 +164,12 @@ class UWSGIProvider(ManagedProvider):
                 # Upload default web vassal
                 info(indent('...using default web vassal'))
                 template = os.path.join('uwsgi', 'default', 'web.ini')
-                uploads = blueprint.upload(template, os.path.join(destination, ini), context=context)
+                uploads = manifest.upload(blueprint, template, os.path.join(destination, ini), context=context)
                 if uploads:
                     self.updates.extend(uploads)
 
             # Upload remaining (local) vassals
-            user_vassals = blueprint.upload('uwsgi/', destination, context=context)  # TODO: skip subdirs
+            user_vassals = manifest.upload(blueprint, 'uwsgi/', destination, context=context)  # TODO: skip subdirs
             if user_vassals:
                 self.updates.extend(user_vassals)
 
@@ -142,7 +199,7 @@ class UWSGIProvider(ManagedProvider):
             template = os.path.join('uwsgi', 'default', vassal)
             default_templates = uwsgi.blueprint.get_default_template_root()
             with settings(template_dirs=[default_templates]):
-                uploads = blueprint.upload(template, destination, context=context)
+                uploads = manifest.upload(blueprint, template, destination, context=context)
             self.updates.extend(uploads)
 
         return self.updates
@@ -208,15 +265,109 @@ class UWSGIProvider(ManagedProvider):
 
     def reload(self, vassals=None):
         """
-        Touch reload specified vassals
+        Reload specified vassals.
+
+        The web vassal is reloaded according to the web.reload strategy:
+        touch (full graceful reload), chain (one worker at a time) or zerg
+        (a temporary zerg instance serves while the vassal reloads). Other
+        vassals are always touch reloaded. A touch reload only waits for the
+        new workers with the web.reload_wait setting.
 
         :param vassals: Vassals to reload
         """
         from blues import uwsgi
 
+        strategy = blueprint.get('web.reload', 'touch')
+        wait = blueprint.get('web.reload_wait', False)
+        timeout = blueprint.get('web.reload_timeout', 120)
+        minimum = self.get_min_workers()
+        web_vassal = self.get_web_vassal()
+
         for vassal_ini in vassals or self.list_vassals():
             vassal_ini_path = os.path.join(self.get_config_path(), vassal_ini)
+            vassal_name = os.path.splitext(vassal_ini)[0]
+
+            if vassal_ini != web_vassal:
+                uwsgi.reload(vassal_ini_path)
+            elif strategy == 'chain':
+                uwsgi.chain_reload(vassal_name, timeout=timeout, minimum=minimum)
+            elif strategy == 'zerg':
+                self.zerg_reload(vassal_ini_path, timeout=timeout)
+            elif not wait or uwsgi.stats(vassal_name) is None:
+                # Custom vassals not extending vassal.ini have no stats socket
+                uwsgi.reload(vassal_ini_path)
+            else:
+                old_pids = uwsgi.worker_pids(vassal_name)
+                uwsgi.reload(vassal_ini_path)
+                uwsgi.wait_for_workers(vassal_name, old_pids, timeout=timeout,
+                                       minimum=minimum)
+
+    @staticmethod
+    def get_min_workers():
+        """
+        Get the number of workers a ready web vassal runs at least, the
+        cheaper setting when autoscaling workers.
+
+        :return int: Minimum number of running workers
+        """
+        from blues import uwsgi
+
+        cheaper_algo = blueprint.get('web.cheaper_algo')
+        if not cheaper_algo:
+            return 1
+
+        if blueprint.get('web.cheaper'):
+            return int(blueprint.get('web.cheaper'))
+
+        cpu_count = blueprint.get('web.max_cores', debian.nproc())
+        workers = blueprint.get('web.workers', default=uwsgi.get_worker_count(cpu_count))
+        cheaper = uwsgi.get_cheaper_context(cheaper_algo, cpu_count, 0, workers)
+        return cheaper.get('cheaper', 1)
+
+    def zerg_reload(self, vassal_ini_path, timeout=120):
+        """
+        Reload web vassal while a temporary zerg vassal, attached to its zerg
+        server, keeps serving requests on the same socket.
+
+        :param vassal_ini_path: Web vassal to reload
+        :param timeout: Seconds to wait for workers to get ready
+        """
+        from blues import uwsgi
+
+        vassal_name = os.path.splitext(os.path.basename(vassal_ini_path))[0]
+        zerg_name = '{}-zerg'.format(vassal_name)
+        zerg_ini_path = os.path.join(os.path.dirname(vassal_ini_path),
+                                     '{}.ini'.format(zerg_name))
+
+        if not uwsgi.worker_pids(vassal_name):
+            # Nothing to hand off from, i.e. first start
+            uwsgi.reload(vassal_ini_path)
+            return
+
+        context = self.get_context()
+        context['zerg'] = uwsgi.zerg_socket(vassal_name)
+
+        template = os.path.join('uwsgi', os.path.basename(vassal_ini_path))
+        default_templates = uwsgi.blueprint.get_default_template_root()
+        with settings(template_dirs=[default_templates]), sudo_project():
+            if template not in blueprint.get_template_loader().list_templates():
+                template = os.path.join('uwsgi', 'default', 'web.ini')
+            info('Spawning {} uWSGI vassal', zerg_name)
+            blueprint.upload(template, zerg_ini_path, context=context)
+
+        minimum = self.get_min_workers()
+        try:
+            if not uwsgi.wait_for_workers(zerg_name, timeout=timeout, minimum=minimum):
+                warn('Zerg vassal not ready, reloading {} anyway'.format(vassal_name))
+
+            old_pids = uwsgi.worker_pids(vassal_name)
             uwsgi.reload(vassal_ini_path)
+            uwsgi.wait_for_workers(vassal_name, old_pids, timeout=timeout,
+                                   minimum=minimum)
+        finally:
+            # Emperor gracefully stops vassals whose config is removed
+            with sudo_project():
+                debian.rm(zerg_ini_path)
 
     def status(self, vassal=None):
         from blues import uwsgi
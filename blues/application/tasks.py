@@ -1,13 +1,16 @@
 # coding=utf-8
+import math
 import os
 import re
+import time
 
 import yaml
 
 from fabric.context_managers import settings
-from fabric.decorators import task
+from fabric.decorators import task, parallel, runs_once
 from fabric.state import env
-from fabric.utils import indent, abort
+from fabric.tasks import execute
+from fabric.utils import indent, abort, warn
 from blues.application.deploy import maybe_install_requirements
 
 from refabric.utils import info
@@ -15,6 +18,9 @@ from refabric.contrib import blueprints
 
 
 from .. import git
+from .. import manifest
+from .. import slack
+from .. import trace
 
 blueprint = blueprints.get('blues.app')
 
@@ -55,12 +61,14 @@ def configure():
 
 
 @task
-def deploy(revision=None, auto_reload=True, force=False, update_pip=False):
+def deploy(revision=None, auto_reload=True, force=False, update_pip=False,
+           strict=False):
     """
     Reset source to configured branch and install requirements, if needed
 
     :param bool auto_reload: Reload application providers if source has changed
     :param bool force: Force install of requirements
+    :param bool strict: Abort if source could not be reset
     :return bool: Source code has changed?
     """
     from .deploy import update_source
@@ -68,10 +76,15 @@ def deploy(revision=None, auto_reload=True, force=False, update_pip=False):
     from ..debian import chmod
     from refabric.context_managers import silent
 
+    deploy_start = time.time()
+
     # Reset git repo
     previous_commit, current_commit = update_source(revision)
     code_changed = current_commit is not None and previous_commit != current_commit
 
+    if current_commit is None and strict:
+        abort('Failed to reset git repository to {}'.format(revision or 'HEAD'))
+
     if code_changed:
         info('Updated git repository from: {} to: {}', previous_commit, current_commit)
 
@@ -86,7 +99,7 @@ def deploy(revision=None, auto_reload=True, force=False, update_pip=False):
         'service_account_key': gcloudAccountKey,
         }
 
-        blueprint.upload('gcloud/gcloud-service-account.json',
+        manifest.upload(blueprint, 'gcloud/gcloud-service-account.json',
             os.path.join(project_home(), 'gcloud-service-account.json'),
             context,
             user=project_name())
@@ -108,9 +121,358 @@ def deploy(revision=None, auto_reload=True, force=False, update_pip=False):
         if auto_reload:
             reload()
 
+    trace.record('deploy', 'phase', deploy_start, time.time() - deploy_start)
+
     return (previous_commit, current_commit) if code_changed else False
 
 
+@task
+@runs_once
+def rolling_deploy(revision=None, batch_size=None, max_failures=None,
+                   auto_reload=True, force=False, update_pip=False):
+    """
+    Deploy to all hosts in rolling batches, running each batch in parallel
+
+    :param revision: Revision to deploy (Default: resolved once from remote head)
+    :param batch_size: Hosts per batch, count or percentage, ex 4 or 25% (Default: 25%)
+    :param max_failures: Failed hosts to tolerate before aborting, count or percentage (Default: 0)
+    :param bool auto_reload: Reload application providers if source has changed
+    :param bool force: Force install of requirements
+    :return dict: {host: deploy result, ...}
+    """
+    from .project import remote_head
+
+    hosts = list(env.hosts)
+    if not hosts:
+        abort('No hosts to deploy to')
+
+    if not revision:
+        # Resolve once, so that every host is reset to the same commit
+        _, revision = remote_head()
+
+    batch_size = blueprint.get('rolling.batch_size', '25%') \
+        if batch_size is None else batch_size
+    max_failures = blueprint.get('rolling.max_failures', 0) \
+        if max_failures is None else max_failures
+
+    batches = get_batches(hosts, batch_size)
+    failure_threshold = get_host_count(hosts, max_failures, minimum=0)
+
+    results = {}
+    failed = []
+
+    for i, batch in enumerate(batches, start=1):
+        info('Deploying {} to batch {}/{}: {}', revision, i, len(batches),
+             ', '.join(batch))
+
+        with slack.coalesced(u'Batch {}/{}:'.format(i, len(batches))), \
+                settings(parallel=True, pool_size=len(batch), warn_only=True):
+            batch_results = execute(deploy_or_fail, revision=revision,
+                                    auto_reload=auto_reload, force=force,
+                                    update_pip=update_pip, hosts=batch)
+
+        for host in batch:
+            result = batch_results.get(host)
+            results[host] = result
+            if isinstance(result, BaseException):
+                failed.append(host)
+
+        if len(failed) > failure_threshold:
+            print_deploy_results(results)
+            abort('Deploy failed on {} host(s), threshold is {}, aborting: {}'
+                  .format(len(failed), failure_threshold, ', '.join(failed)))
+
+    print_deploy_results(results)
+
+    return results
+
+
+@task
+@runs_once
+def deploy_artifact(revision=None, build_host=None, auto_reload=True):
+    """
+    Build once on a build host and ship the release to all hosts in parallel
+
+    :param revision: Revision to deploy (Default: resolved once from remote head)
+    :param build_host: Host to build on (Default: artifact.build_host setting or first host)
+    :param bool auto_reload: Reload application providers after activating release
+    :return str: Deployed release
+    """
+    from .artifact import build_artifact, install_artifact, activate_release, \
+        cleanup_releases
+    from .project import remote_head
+
+    hosts = list(env.hosts)
+    if not hosts:
+        abort('No hosts to deploy to')
+
+    build_host = build_host or blueprint.get('artifact.build_host') or hosts[0]
+
+    if not revision:
+        _, revision = remote_head()
+
+    info('Building artifact for {} on {}', revision, build_host)
+    release, local_artifact, digest = execute(build_artifact, revision,
+                                              hosts=[build_host])[build_host]
+
+    info('Shipping release {} ({}) to {} host(s)', release, digest[:12], len(hosts))
+    pool_size = blueprint.get('artifact.pool_size', len(hosts))
+
+    # Unpack everywhere before activating anywhere, to not end up on mixed releases
+    with settings(parallel=True, pool_size=pool_size, warn_only=True):
+        results = execute(install_artifact, local_artifact, digest, release,
+                          activate=False, hosts=hosts)
+    failed = [host for host in hosts if results.get(host) != release]
+    if failed:
+        abort('Failed to ship release {} to {}, no host activated'.format(
+            release, ', '.join(failed)))
+
+    with settings(parallel=True, pool_size=pool_size, warn_only=True):
+        results = execute(activate_release, release, hosts=hosts)
+    failed = [host for host in hosts if isinstance(results.get(host), BaseException)]
+    if failed:
+        abort('Failed to activate release {} on {}'.format(release, ', '.join(failed)))
+
+    with settings(parallel=True, pool_size=pool_size, warn_only=True):
+        execute(cleanup_releases, keep=blueprint.get('artifact.keep_releases', 5),
+                hosts=hosts)
+
+    if auto_reload:
+        execute(reload, hosts=hosts)
+
+    return release
+
+
+@task
+@runs_once
+def rolling_reload(configure=False, batch_size=None, max_failures=None, force=False):
+    """
+    Reload providers in rolling batches, each batch in parallel and out of the load balancer until healthy
+
+    :param bool configure: Render and upload provider config first, only reloading hosts with changes
+    :param batch_size: Hosts per batch, count or percentage, ex 4 or 25% (Default: 25%)
+    :param max_failures: Unhealthy hosts to tolerate before aborting, count or percentage (Default: 0)
+    :param bool force: Reload all hosts, even if config is unchanged
+    :return list: Hosts that did not get healthy, these are left out of the load balancer
+    """
+    from .balancer import drain, undrain
+
+    hosts = list(env.hosts)
+    if not hosts:
+        abort('No hosts to reload')
+
+    if configure:
+        with settings(parallel=True, warn_only=True):
+            updated = execute(configure_for_reload, hosts=hosts)
+
+        # Never reload a host with half uploaded config
+        failed = [host for host in hosts if isinstance(updated.get(host), BaseException)]
+        if failed:
+            abort('Failed to configure {}, aborting reload'.format(', '.join(failed)))
+
+        if not force:
+            hosts = [host for host in hosts if updated.get(host) is True]
+            if not hosts:
+                info('No provider config changed, nothing to reload')
+                return []
+
+    batch_size = blueprint.get('rolling.batch_size', '25%') \
+        if batch_size is None else batch_size
+    max_failures = blueprint.get('rolling.max_failures', 0) \
+        if max_failures is None else max_failures
+
+    batches = get_batches(hosts, batch_size)
+    failure_threshold = get_host_count(hosts, max_failures, minimum=0)
+    failed = []
+
+    for i, batch in enumerate(batches, start=1):
+        info('Reloading batch {}/{}: {}', i, len(batches), ', '.join(batch))
+
+        if not drain(batch):
+            undrain(batch)
+            abort('Failed to take batch out of the load balancer, aborting')
+
+        with settings(parallel=True, pool_size=len(batch), warn_only=True):
+            batch_results = execute(reload_until_healthy, hosts=batch)
+
+        healthy = [host for host in batch if batch_results.get(host) is True]
+        failed.extend(host for host in batch if host not in healthy)
+
+        # Unhealthy hosts stay out of rotation
+        if healthy and not undrain(healthy):
+            abort('Failed to put batch back into the load balancer, aborting')
+
+        if len(failed) > failure_threshold:
+            abort('Reload failed on {} host(s), threshold is {}, aborting: {}'
+                  .format(len(failed), failure_threshold, ', '.join(failed)))
+
+    if failed:
+        warn('Not healthy, left out of the load balancer: {}'.format(', '.join(failed)))
+
+    return failed
+
+
+def deploy_or_fail(**kwargs):
+    """
+    Deploy current host within a rolling deploy, where warn_only is set for
+    the batch, failing on any failed remote command or source reset
+
+    Deploy events are collected per batch into one slack summary.
+
+    :return: Result of deploy
+    """
+    from .deploy import notify_event
+
+    with settings(warn_only=False):
+        result = deploy(strict=True, **kwargs)
+
+    if slack.configured():
+        notify_event(commits=result or None)
+
+    return result
+
+
+def configure_for_reload():
+    """
+    Render and upload provider config without reloading
+
+    :return bool: True if any provider config was updated
+    """
+    providers = configure_providers(auto_reload=False)
+    return any(provider.updates for provider in set(providers.values()))
+
+
+def reload_until_healthy():
+    """
+    Reload providers and wait for current host to get healthy
+
+    :return bool: True if healthy
+    """
+    from .balancer import wait_until_healthy
+
+    # Fail the host, rather than warn, if any reload command fails
+    with settings(warn_only=False):
+        reload()
+
+    return wait_until_healthy()
+
+
+def get_upstream_weights(hosts):
+    """
+    Get nginx upstream weights, relative to each host's core count
+
+    :param hosts: Web hosts
+    :return dict: {host: weight, ...}, unreachable hosts are left out
+    """
+    from .. import debian
+
+    with settings(parallel=True, warn_only=True):
+        cores = execute(debian.nproc, hosts=hosts)
+
+    cores = {host: count for host, count in cores.items()
+             if isinstance(count, int) and count > 0}
+    if not cores:
+        return {}
+
+    fewest = min(cores.values())
+    return {host: max(1, int(round(count / float(fewest))))
+            for host, count in cores.items()}
+
+
+def get_host_count(hosts, value, minimum=1):
+    """
+    Resolve a host count setting given as a number or a percentage
+
+    :param hosts: List of hosts
+    :param value: Count or percentage, ex 4 or 25%
+    :param minimum: Lowest count to return
+    :return int: Number of hosts
+    """
+    value = str(value).strip()
+    if value.endswith('%'):
+        count = int(math.ceil(len(hosts) * float(value[:-1]) / 100))
+    else:
+        count = int(value)
+
+    return max(minimum, count)
+
+
+def get_batches(hosts, batch_size):
+    """
+    Split hosts into rolling batches
+
+    :param hosts: List of hosts
+    :param batch_size: Hosts per batch, count or percentage
+    :return list: [[host, ...], ...]
+    """
+    size = get_host_count(hosts, batch_size)
+    return [hosts[i:i + size] for i in range(0, len(hosts), size)]
+
+
+def print_deploy_results(results):
+    """
+    Print per-host summary of a rolling deploy
+    """
+    lines = []
+    for host, result in sorted(results.items()):
+        if isinstance(result, BaseException):
+            status = 'FAILED: {}'.format(result)
+        elif result:
+            status = 'updated {} -> {}'.format(*result)
+        else:
+            status = 'unchanged'
+        lines.append('{}: {}'.format(host, status))
+
+    info('Deploy results:\n{}', indent(lines))
+
+
+@task
+@runs_once
+def place_queues(redundancy=None, dry_run=False):
+    """
+    Place worker queues on worker hosts by their load, and save the placement
+
+    :param redundancy: Hosts per queue not pinned by its hosts setting (Default: worker.placement.redundancy or 1)
+    :param bool dry_run: Only print the placement
+    :return dict: {host: {queue: workers, ...}, ...}
+    """
+    from . import placement
+
+    # Given as a string from the command line, ex dry_run=false
+    dry_run = str(dry_run).lower() in ('1', 'true', 'yes', 'y')
+
+    queues = blueprint.get('worker.queues') or {}
+    if not queues:
+        abort('No worker queues to place')
+
+    hosts = placement.worker_hosts()
+    capacities = placement.get_capacities(hosts)
+    unreachable = [host for host in hosts if host not in capacities]
+    if unreachable:
+        warn('Not placing queues on unreachable hosts: {}'.format(', '.join(unreachable)))
+
+    redundancy = placement.placement_settings().get('redundancy', 1) \
+        if redundancy is None else redundancy
+    placed, utilization = placement.place_queues(
+        queues, capacities, redundancy=redundancy,
+        measured=placement.load_measurements())
+
+    lines = []
+    for host in sorted(placed):
+        lines.append('{}: {:.0%}{} {}'.format(
+            host, utilization[host],
+            ' (overcommitted)' if utilization[host] > 1 else '',
+            ', '.join('{}={}'.format(name, workers)
+                      for name, workers in sorted(placed[host].items())) or '-'))
+    info('Queue placement:\n{}', indent(lines))
+
+    if not dry_run:
+        placement.save_placement(placed)
+        info('Saved queue placement to {}', placement.placement_path())
+
+    return placed
+
+
 @task
 def install_requirements():
     """
@@ -126,6 +488,7 @@ def install_requirements():
 
 
 @task
+@parallel
 def deployed():
     """
     Show deployed and last origin commit
@@ -136,32 +499,29 @@ def deployed():
     params = []
 
     with sudo_project():
-        repository_path = git_repository_path()
-        git.fetch(repository_path)
+        state = git.describe_state(git_repository_path(), fetch=True)
 
-        head_tag, head_tag_delta = git.current_tag(repository_path)
-        if head_tag_delta > 0:
-            msg += 'Latest tag: {} distance: {}'
-            params += [head_tag, head_tag_delta]
-        else:
-            msg += 'Deployed tag: {}'
-            params += [head_tag]
+    if state['tag'] and state['distance'] > 0:
+        msg += 'Latest tag: {} distance: {}\n'
+        params += [state['tag'], state['distance']]
+    elif state['tag']:
+        msg += 'Deployed tag: {}\n'
+        params += [state['tag']]
 
-        head_commit, head_message = git.log(repository_path)[0]
-        msg += '\nRevision: {} comment: {}'
-        params += [head_commit, head_message]
+    msg += 'Revision: {} comment: {}'
+    params += [state['commit'], state['message'].encode('utf-8')]
 
-        origin = git.get_origin(repository_path)
-        origin_commit, origin_message = git.log(repository_path, refspec=origin)[0]
-        if head_commit != origin_commit:
-            msg += '\nRemote: {} revision: {} comment: {}'
-            params += [origin, origin_commit, origin_message]
+    if state['upstream'] and state['commit'] != state['upstream_commit']:
+        msg += '\nRemote: {} revision: {} comment: {}'
+        params += [state['upstream'], state['upstream_commit'],
+                   state['upstream_message'].encode('utf-8')]
 
-        info(msg, *params)
-        return head_commit, origin_commit
+    info(msg, *params)
+    return state['commit'], state['upstream_commit']
 
 
 @task
+@parallel
 def incoming(revision=None):
     """
     Show changes since the deployed revision
@@ -170,30 +530,28 @@ def incoming(revision=None):
 
     with sudo_project():
         repository_path = git_repository_path()
-        git.fetch(repository_path)
-
-        current_revision, head_message = git.log(repository_path)[0]
+        state = git.describe_state(repository_path, fetch=True)
 
+        current_revision = state['commit']
         if not revision:
-            origin = git.get_origin(repository_path)
-            revision, _ = git.log(repository_path, refspec=origin)[0]
+            revision = state['upstream_commit']
 
-        if current_revision == revision:
+        if not revision or current_revision == revision:
             info("No changes detected")
             return None
 
         refspec = '{0}..{1}'.format(current_revision, revision)
         git_log = git.log(repository_path, refspec=refspec, count=False, author=True)
 
-        if not git_log:
-            info("Unable to get changelog (possibly different branches)")
-            return None
+    if not git_log:
+        info("Unable to get changelog (possibly different branches)")
+        return None
 
-        # (Re)fabric isn't always unicode safe
-        summary = u'\n'.join([u' :: '.join(row) for row in git_log])
-        info('Changes since deploy:\n{}', summary.encode('utf-8'))
+    # (Re)fabric isn't always unicode safe
+    summary = u'\n'.join([u' :: '.join(row) for row in git_log])
+    info('Changes since deploy:\n{}', summary.encode('utf-8'))
 
-        return git_log
+    return git_log
 
 
 @task
@@ -223,7 +581,8 @@ def reload():
     """
     providers = get_providers(env.host_string)
     for provider in set(providers.values()):
-        provider.reload()
+        with trace.phase('reload {}'.format(provider.name)):
+            provider.reload()
 
 
 @task
@@ -237,11 +596,13 @@ def status():
 
 
 @task
-def configure_providers(force_reload=False):
+@trace.timed()
+def configure_providers(force_reload=False, auto_reload=True):
     """
     Render, upload and reload web & worker config
 
     :param bool force_reload: Force reload of providers, even if not updated
+    :param bool auto_reload: Reload updated providers, see rolling_reload to reload with health gating
     :return dict: Application providers for current host
     """
     from .project import sudo_project
@@ -256,9 +617,11 @@ def configure_providers(force_reload=False):
     # This may become a real provider in the future.
     configure_environment()
 
-    for provider in set(providers.values()):
-        if provider.updates or force_reload:
-            provider.reload()
+    if auto_reload:
+        for provider in set(providers.values()):
+            if provider.updates or force_reload:
+                with trace.phase('reload {}'.format(provider.name)):
+                    provider.reload()
 
     return providers
 
@@ -269,10 +632,10 @@ def configure_environment():
     from ..shell import configure_profile
 
     context = {"project_name": project_name()}
-    blueprint.upload('dotenv/dotenv',
-                     os.path.join(project_home(), '.env'),
-                     context=context,
-                     user=project_name())
+    manifest.upload(blueprint, 'dotenv/dotenv',
+                    os.path.join(project_home(), '.env'),
+                    context=context,
+                    user=project_name())
 
     # Exports dotenv to the app user's interactive sessions
     configure_profile(project_home(), dotenv=True)
@@ -280,10 +643,10 @@ def configure_environment():
     config = blueprint.get('config', None)
     if config:
         context.update(config=config)
-        blueprint.upload('dotenv/dotconf',
-                         os.path.join(git_repository_path(), '.env'),
-                         context=context,
-                         user=project_name())
+        manifest.upload(blueprint, 'dotenv/dotconf',
+                        os.path.join(git_repository_path(), '.env'),
+                        context=context,
+                        user=project_name())
 
 
 @task
@@ -292,19 +655,22 @@ def configure_beat_schedule():
 
     schedule = blueprint.get('schedule', None)
     if schedule:
-        blueprint.upload('beat/schedule',
-                         os.path.join(project_home(), '.schedule'),
-                         context={'schedule': yaml.dump(schedule)},
-                         user=project_name())
+        manifest.upload(blueprint, 'beat/schedule',
+                        os.path.join(project_home(), '.schedule'),
+                        context={'schedule': yaml.dump(schedule)},
+                        user=project_name())
 
 
 @task
+@runs_once
 def generate_nginx_conf(role='www'):
     """
     Genereate nginx site config for web daemon
 
     :param str role: Name of role (directory) to generate config to
     """
+    from .project import static_base
+
     name = blueprint.get('project')
     socket = blueprint.get('web.socket', default='0.0.0.0:3030')
     host, _, port = socket.partition(':')
@@ -318,12 +684,62 @@ def generate_nginx_conf(role='www'):
     else:
         sockets = ['unix:{}'.format(socket)]
 
+    upstream = blueprint.get('web.upstream', {}) or {}
+    http = blueprint.get('web.http') == 'true' or \
+        blueprint.get('web.provider') != 'uwsgi'
+
+    balance = upstream.get('balance', 'ip_hash' if blueprint.get('web.ip_hash') else None)
+    if balance not in (None, 'round_robin', 'least_conn', 'ip_hash', 'random_two'):
+        abort('Unknown upstream balance method: {}'.format(balance))
+
+    keepalive = upstream.get('keepalive')
+    if keepalive and not (blueprint.get('web.provider') == 'uwsgi' and
+                          blueprint.get('web.http') == 'true'):
+        # Only the uWSGI http site proxies over HTTP/1.1 without Connection: close
+        warn('Upstream keepalive needs the uWSGI web provider over http, ignoring')
+        keepalive = 0
+
+    weights = get_upstream_weights(env.hosts) \
+        if len(sockets) > 1 and upstream.get('weight') == 'cores' else {}
+
+    servers = [{'address': address,
+                'weight': weights.get(host, 1),
+                'max_fails': upstream.get('max_fails'),
+                'fail_timeout': upstream.get('fail_timeout')}
+               for host, address in zip(env.hosts or [None], sockets)]
+
+    cache = blueprint.get('web.cache') or {}
+    if cache:
+        cache = dict({
+            'path': '/var/cache/nginx/{}'.format(name),
+            'keys_zone': '10m',
+            'max_size': '1g',
+            'inactive': '10m',
+            'valid': '1s',
+            'lock_timeout': '5s',
+            'bypass_cookies': ['sessionid'],
+            'static_immutable': True,
+            'background_update': False,
+        }, **(cache if isinstance(cache, dict) else {}))
+
     context = {
         'name': name,
         'sockets': sockets,
+        'servers': servers,
         'domain': blueprint.get('web.domain', default='_'),
         'ssl': blueprint.get('web.ssl', False),
-        'ip_hash': blueprint.get('web.ip_hash', False)
+        'ip_hash': balance == 'ip_hash',
+        'balance': balance,
+        'keepalive': keepalive,
+        'http': http,
+        'buffer_size': upstream.get('buffer_size', '8k'),
+        'buffers': upstream.get('buffers', '8 16k'),
+        'busy_buffers_size': upstream.get('busy_buffers_size', '32k'),
+        'cache': cache,
+        'cache_prefix': 'proxy' if http else 'uwsgi',
+        # Zone and variable names can not contain hyphens, ex from project name
+        'cache_zone': '{}_cache'.format(re.sub(r'\W', '_', name)),
+        'static_base': static_base(),
     }
 
     template = blueprint.get('web.nginx_conf')
@@ -42,6 +42,7 @@ from refabric.context_managers import sudo, silent
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['setup', 'configure', 'start', 'stop', 'restart', 'status']
 
@@ -135,9 +136,9 @@ def configure():
                 'filebeat.inputs': input_configs
             })
 
-        uploads += blueprint.upload('filebeat.yml',
-                                    '/etc/filebeat/filebeat.yml',
-                                    context=context)
+        uploads += manifest.upload(blueprint, 'filebeat.yml',
+                                   '/etc/filebeat/filebeat.yml',
+                                   context=context)
 
         module_changes += update_modules('filebeat')
 
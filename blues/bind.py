@@ -38,6 +38,7 @@ from refabric.operations import run
 from refabric.utils import info
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'reload', 'setup', 'configure']
 
@@ -81,10 +82,10 @@ def configure(force_reload=False):
         uploads = []
 
         # Configure application
-        uploads.append(blueprint.upload('./named.conf.main',
-                                        os.path.join(config_dir, 'named.conf')))
-        uploads.append(blueprint.upload('./named.conf.default-zones',
-                                        config_dir))
+        uploads.append(manifest.upload(blueprint, './named.conf.main',
+                                       os.path.join(config_dir, 'named.conf')))
+        uploads.append(manifest.upload(blueprint, './named.conf.default-zones',
+                                       config_dir))
 
         options_ctx = {
             'listen': blueprint.get(
@@ -96,10 +97,10 @@ def configure(force_reload=False):
             'forwarders': blueprint.get(
                 'forwarders', ['8.8.8.8', '8.8.4.4'])
         }
-        uploads.append(blueprint.upload(
+        uploads.append(manifest.upload(blueprint,
             './named.conf.options', config_dir, options_ctx))
 
-        uploads.append(blueprint.upload(
+        uploads.append(manifest.upload(blueprint,
             './zones/', zones_dir))
 
         # Zones
@@ -112,7 +113,7 @@ def configure(force_reload=False):
             filename = 'db.{}'.format(zone)
             file_path = os.path.join(zones_dir, filename)
             local_zones[zone] = file_path
-            uploads.append(blueprint.upload(
+            uploads.append(manifest.upload(blueprint,
                 filename,
                 file_path,
                 {
@@ -122,11 +123,11 @@ def configure(force_reload=False):
                 }
             ))
 
-        uploads.append(blueprint.upload(
+        uploads.append(manifest.upload(blueprint,
             './named.conf.local', config_dir, {'zones': local_zones}))
 
         slave_zones = blueprint.get('slave', [])
-        uploads.append(blueprint.upload(
+        uploads.append(manifest.upload(blueprint,
             './named.conf.slave', config_dir, {'slave_zones': slave_zones}))
 
         if uploads or force_reload:
@@ -26,6 +26,7 @@ from refabric.operations import run
 from refabric.utils import info
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'reload', 'setup', 'configure','upload_plugins']
 
@@ -56,15 +57,15 @@ def install():
             'whitelist': blueprint.get('whitelist', '10.130.230.85')
         }
         uploads=[]
-        uploads.append(blueprint.upload('check_mk_agent.linux', '/usr/local/bin/check_mk_agent'))
-        uploads.append(blueprint.upload('check_mk_caching_agent.linux', '/usr/local/bin/check_mk_caching_agent'))
+        uploads.append(manifest.upload(blueprint, 'check_mk_agent.linux', '/usr/local/bin/check_mk_agent'))
+        uploads.append(manifest.upload(blueprint, 'check_mk_caching_agent.linux', '/usr/local/bin/check_mk_caching_agent'))
         test=run("ls -al /etc/|grep xinetd.d")
         if test:
-            uploads.append(blueprint.upload('check_mk_template', os.path.join(config_dir, 'check_mk'),context))
+            uploads.append(manifest.upload(blueprint, 'check_mk_template', os.path.join(config_dir, 'check_mk'),context))
         else:
             with sudo():
                 debian.apt_get('install', 'xinetd')    
-            uploads.append(blueprint.upload('check_mk_template', os.path.join(config_dir, 'check_mk'),context))
+            uploads.append(manifest.upload(blueprint, 'check_mk_template', os.path.join(config_dir, 'check_mk'),context))
         test=run("ls -al /usr/lib/ |grep check_mk_agent")
         if test:
             info("Catalog already exists")
@@ -82,17 +83,17 @@ def upload_plugins():
     Upload plugins to check_mk
     """
     uploads=[]
-    uploads.append(blueprint.upload('plugins/', '/usr/lib/check_mk_agent/plugins'))
+    uploads.append(manifest.upload(blueprint, 'plugins/', '/usr/lib/check_mk_agent/plugins'))
     if uploads:
         run("find /usr/lib/check_mk_agent/plugins -not -name '*.py' -exec chmod +x {} \\;")
     with settings(warn_only=True):
         test=run("ls -al /etc/|grep check_mk")
         uploads=[]
         if test:
-            uploads.append(blueprint.upload('check_mk/', '/etc/check_mk'))
+            uploads.append(manifest.upload(blueprint, 'check_mk/', '/etc/check_mk'))
         else:
             debian.mkdir("/etc/check_mk")
-            uploads.append(blueprint.upload('check_mk/', '/etc/check_mk'))
+            uploads.append(manifest.upload(blueprint, 'check_mk/', '/etc/check_mk'))
         if uploads:
             info("Uploads are completed")
 
@@ -106,7 +107,7 @@ def configure(force_reload=False):
     'whitelist': blueprint.get('whitelist', '10.130.230.85')
     }
     uploads=[]
-    uploads.append(blueprint.upload('check_mk_template', os.path.join(config_dir, 'check_mk'),context))
+    uploads.append(manifest.upload(blueprint, 'check_mk_template', os.path.join(config_dir, 'check_mk'),context))
     if uploads:
         info("configure")
     if force_reload:   
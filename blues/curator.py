@@ -33,6 +33,7 @@ from refabric.context_managers import sudo
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['setup', 'configure']
 
@@ -94,4 +95,4 @@ def configure():
     }
 
     debian.mkdir("/etc/curator/", owner='elasticsearch')
-    blueprint.upload('./', "/etc/curator/", context=context, user='elasticsearch')
+    manifest.upload(blueprint, './', "/etc/curator/", context=context, user='elasticsearch')
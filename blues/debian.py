@@ -5,8 +5,11 @@ Debian Utils
 Useful debian commands for other blueprints to use.
 """
 import base64
+import json
 import os
 import re
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from functools import partial
 
@@ -17,6 +20,7 @@ import fabric.contrib.project
 import fabric.context_managers
 from fabric.colors import magenta
 from fabric.decorators import task
+from fabric.state import env
 from fabric.utils import abort, puts, indent, warn
 
 from refabric.context_managers import silent, sudo
@@ -31,9 +35,68 @@ boot_options_16=['x-systemd.requires','x-systemd.before','x-systemd.after','x-sy
 boot_options_16_more=['requires','before','after','requires-mounts-for','idle-timeout','device-timeout','mount-timeout']
 
 
+_batch = None
+
+
+@contextmanager
+def batch():
+    """
+    Queue filesystem operations (chmod, chown, chgrp, rm, cp, mv, ln, mkdir)
+    and flush them as a single remote script when the context exits.
+
+    Queued operations run with the privileges and working directory of the
+    context the batch was opened in. Nested batches join the outer one.
+    """
+    global _batch
+
+    if _batch is not None:
+        yield _batch
+        return
+
+    steps = _batch = []
+    try:
+        yield steps
+    finally:
+        # Drop the queue even if the block raised, so that no commands leak
+        # into the next batch of this process
+        _batch = None
+
+    flush_batch(steps)
+
+
+def flush_batch(steps):
+    """
+    Run queued commands as one remote script, stopping at the first failure.
+
+    :param steps: List of shell commands
+    """
+    if not steps:
+        return
+
+    script = '\n'.join(
+        '( {} ) || {{ echo "batch step {} failed"; exit 1; }}'.format(command, i)
+        for i, command in enumerate(steps))
+
+    with silent():
+        output = run(script)
+
+    if output.return_code != 0:
+        match = re.search(r'batch step (\d+) failed', output.stdout)
+        failed = steps[int(match.group(1))] if match else script
+        raise Exception('Failed to run batched command: {}, {}'
+                        .format(failed, output.stdout))
+
+
+def _execute(command):
+    if _batch is not None:
+        _batch.append(command)
+    else:
+        run(command)
+
+
 def chmod(location, mode=None, owner=None, group=None, recursive=False):
     if mode:
-        run('chmod %s %s %s' % (recursive and '-R ' or '', mode,  location))
+        _execute('chmod %s %s %s' % (recursive and '-R ' or '', mode,  location))
     if owner:
         chown(location, owner=owner, group=group, recursive=recursive)
     elif group:
@@ -42,45 +105,53 @@ def chmod(location, mode=None, owner=None, group=None, recursive=False):
 
 def chown(location, owner, group=None, recursive=False):
     owner = '{}:{}'.format(owner, group if group else owner)
-    run('chown {} {} {}'.format(recursive and '-R ' or '', owner, location))
+    _execute('chown {} {} {}'.format(recursive and '-R ' or '', owner, location))
 
 
 def chgrp(location, group, recursive=False):
-    run('chgrp %s %s %s' % (recursive and '-R ' or '', group, location))
+    _execute('chgrp %s %s %s' % (recursive and '-R ' or '', group, location))
 
 
 def rm(location, recursive=False, force=True):
     force = '-f' if force else ''
     recursive = '-r' if recursive else ''
-    run('rm %s %s %s' % (force, recursive, location))
+    _execute('rm %s %s %s' % (force, recursive, location))
 
 
 def cp(source, destination, force=True, mode=None, owner=None, group=None):
     force = force and '-f' or ''
-    run('cp %s %s %s' % (force, source, destination))
+    _execute('cp %s %s %s' % (force, source, destination))
     chmod(destination, mode, owner, group)
 
 
 def mv(source, destination, force=True):
     force = force and '-f' or ''
-    run('mv %s %s %s' % (force, source, destination))
+    _execute('mv %s %s %s' % (force, source, destination))
 
 
 def ln(source, destination, symbolic=True, force=True, mode=None,
        owner=None, group=None):
     force = force and '-f' or ''
     symbolic = symbolic and '-sn' or ''
-    run('ln %s %s "%s" "%s"' % (symbolic, force, source, destination))
+    _execute('ln %s %s "%s" "%s"' % (symbolic, force, source, destination))
     chmod(destination, mode, owner, group)
 
 
 def mkdir(location, recursive=True, mode=None, owner=None, group=None):
+    command = ('test -d "%s" || mkdir %s %s "%s"'
+               % (location,
+                  mode and '-m %s' % mode or '',
+                  recursive and '-p' or '',
+                  location))
+
+    if _batch is not None:
+        _batch.append(command)
+        if owner or group:
+            chmod(location, owner=owner, group=group)
+        return
+
     with silent(), sudo():
-        result = run('test -d "%s" || mkdir %s %s "%s"'
-                     % (location,
-                        mode and '-m %s' % mode or '',
-                        recursive and '-p' or '',
-                        location))
+        result = run(command)
 
         if result.succeeded:
             if owner or group:
@@ -113,16 +184,133 @@ def temporary_dir(mode=None):
         rm(path, recursive=True)
 
 
+"""
+Host facts, gathered in one remote command and memoised per host.
+
+Set ``facts_cache`` in the fabric env to a local file path to persist facts
+between runs, and ``facts_cache_ttl`` to the number of seconds they stay valid
+(Default: 3600).
+"""
+fact_probes = OrderedDict([
+    ('lsb_release', 'lsb_release --release --short'),
+    ('lsb_codename', 'lsb_release --codename --short'),
+    ('hostname', 'hostname -A'),
+    ('nproc', 'nproc'),
+    ('total_memory', "grep MemTotal /proc/meminfo | awk '{print $2}'"),
+    ('page_size', 'getconf PAGE_SIZE'),
+    ('phys_pages', 'getconf _PHYS_PAGES'),
+    ('somaxconn', 'cat /proc/sys/net/core/somaxconn'),
+    ('file_max', 'cat /proc/sys/fs/file-max'),
+])
+
+_facts = {}
+
+
+def facts(refresh=False):
+    """
+    Get facts for current host, probing all of them in a single round trip.
+
+    :param refresh: Ignore memoised and persisted facts and probe again
+    :return dict: {fact: value, ...}
+    """
+    host = env.host_string
+
+    if not refresh:
+        if host in _facts:
+            return _facts[host]
+
+        persisted = _load_facts(host)
+        if persisted:
+            _facts[host] = persisted
+            return persisted
+
+    script = '; '.join('echo "{}=$({} 2>/dev/null)"'.format(name, probe)
+                       for name, probe in fact_probes.items())
+
+    with silent():
+        output = run(script, pty=False)
+
+    host_facts = {}
+    for line in output.stdout.splitlines():
+        name, _, value = line.strip().partition('=')
+        if name in fact_probes:
+            host_facts[name] = value.strip()
+
+    _facts[host] = host_facts
+    _save_facts(host, host_facts)
+
+    return host_facts
+
+
+def fact(name):
+    """
+    Get a single fact for current host.
+
+    :param name: Name of fact, see ``fact_probes``
+    :return str: Fact value
+    """
+    return facts().get(name, '')
+
+
+def clear_facts(host=None):
+    """
+    Forget memoised facts for given host, or for all hosts.
+    """
+    if host:
+        _facts.pop(host, None)
+    else:
+        _facts.clear()
+
+
+def _read_facts_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _load_facts(host):
+    path = env.get('facts_cache')
+    if not path:
+        return None
+
+    entry = _read_facts_cache(path).get(host)
+    if not entry:
+        return None
+
+    ttl = int(env.get('facts_cache_ttl', 3600))
+    if time.time() - entry.get('timestamp', 0) > ttl:
+        return None
+
+    return entry.get('facts')
+
+
+def _save_facts(host, host_facts):
+    path = env.get('facts_cache')
+    if not path:
+        return
+
+    cache = _read_facts_cache(path)
+    cache[host] = {'timestamp': time.time(), 'facts': host_facts}
+
+    try:
+        with open(path, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except IOError as e:
+        warn('Failed to persist host facts to {}: {}'.format(path, e))
+
+
 def lsb_release():
-    return run('lsb_release --release --short')
+    return fact('lsb_release')
 
 
 def lsb_codename():
-    return run('lsb_release --codename --short')
+    return fact('lsb_codename')
 
 
 def hostname():
-    return run('hostname -A').stdout.strip()
+    return fact('hostname')
 
 
 @task
@@ -444,7 +632,7 @@ def systemd_service(name, action='is-enabled'):
 
 
 def add_rc_service(name, priorities='defaults'):
-    if lsb_release() == '14.04' or lsb_release() == '12.04':
+    if lsb_release() in ('14.04', '12.04'):
         update_rc(name, priorities)
 
     else:
@@ -452,7 +640,7 @@ def add_rc_service(name, priorities='defaults'):
 
 
 def remove_rc_service(name):
-    if lsb_release() == '14.04' or lsb_release() == '12.04':
+    if lsb_release() in ('14.04', '12.04'):
         update_rc(name, priorities='remove', force=True)
 
     else:
@@ -479,40 +667,45 @@ def nproc():
     """
     Get the number of CPU cores.
     """
-    c = fabric.context_managers
-    with c.settings(c.hide('running', 'stdout')):
-        res = run('nproc').strip()
-        return int(res)
+    return int(fact('nproc'))
 
 
 def total_memory():
     """
     Get total memory in bytes
     """
-    c = fabric.context_managers
-    with c.settings(c.hide('running', 'stdout')):
-        memory = int(run("grep MemTotal /proc/meminfo | awk '{print $2}'"))
-        # Convert to bytes
-        memory *= 1024
-        return memory
+    memory = int(fact('total_memory'))
+    # Convert to bytes
+    memory *= 1024
+    return memory
 
 
 def page_size():
     """
     Get PAGE_SIZE
     """
-    c = fabric.context_managers
-    with c.settings(c.hide('running', 'stdout')):
-        return int(run('getconf PAGE_SIZE').strip())
+    return int(fact('page_size'))
 
 
 def phys_pages():
     """
     Get _PHYS_PAGES
     """
-    c = fabric.context_managers
-    with c.settings(c.hide('running', 'stdout')):
-        return int(run('getconf _PHYS_PAGES').strip())
+    return int(fact('phys_pages'))
+
+
+def somaxconn():
+    """
+    Get the kernel limit of listen backlogs
+    """
+    return int(fact('somaxconn') or 128)
+
+
+def file_max():
+    """
+    Get the kernel limit of open file descriptors
+    """
+    return int(fact('file_max') or 65536)
 
 
 def set_timezone(timezone):
@@ -667,7 +860,8 @@ def validate_boot_options(options):
     """
     Validate systemd boot options
     """
-    if lsb_release() == '14.04':
+    release = lsb_release()
+    if release == '14.04':
         none_boot_options_check=boot_options_16
     else:
         none_boot_options_check=boot_options_14
@@ -677,8 +871,8 @@ def validate_boot_options(options):
             option = option.split('=')[0]
             stript=1
         if option in none_boot_options_check:
-            warn(option +" is not a valid for "+lsb_release()+" check boot option in your yaml")
-            if lsb_release() == '14.04':
+            warn(option +" is not a valid for "+release+" check boot option in your yaml")
+            if release == '14.04':
                 info("Valid boot options is:"+str(boot_options_14))
             else:
                 info("Valid boot options is:"+str(boot_options_16))
@@ -45,6 +45,7 @@ from refabric.operations import run
 from refabric.utils import info,warn
 
 from . import debian
+from . import manifest
 
 __all__ = [ 'start', 'stop', 'restart', 'configure','setup']
 
@@ -76,11 +77,11 @@ def configure():
 
         # Configure application
         local_params=blueprint.get('interfaces',[])
-        uploads.append(blueprint.upload('./isc-dhcp-server',dhcp_default_dir,{"params" : local_params}))
+        uploads.append(manifest.upload(blueprint, './isc-dhcp-server',dhcp_default_dir,{"params" : local_params}))
         scopes=blueprint.get('scopes',[])
 
 
-        uploads.append(blueprint.upload('./dhcpd.conf', config_dir,{"scopes" : scopes}))
+        uploads.append(manifest.upload(blueprint, './dhcpd.conf', config_dir,{"scopes" : scopes}))
    
         warn("It it is importent that the interfaces are configure before you apply the settings.\nIn order for the new settings to work you need to reboot the system !!")
 
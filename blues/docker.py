@@ -27,6 +27,7 @@ from refabric.context_managers import sudo
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'reload', 'setup', 
           'configure', 'add_scheduled_prune','remove_scheduled_prune']
@@ -70,11 +71,11 @@ def install():
         debian.apt_get('install', package)
 
         if debian.lsb_release() == '14.04':
-            blueprint.upload('./docker.default', '/etc/default/docker')
+            manifest.upload(blueprint, './docker.default', '/etc/default/docker')
 
         else:
-            blueprint.upload('./docker.service',
-                             '/etc/systemd/system/docker.service')
+            manifest.upload(blueprint, './docker.service',
+                            '/etc/systemd/system/docker.service')
             debian.ln(
                 '/etc/systemd/system/docker.service',
                 '/etc/systemd/system/multi-user.target.wants/docker.service',
@@ -89,7 +90,7 @@ def configure():
     """
     daemon_json = json.dumps(blueprint.get('config', '') or {})
 
-    changes = blueprint.upload('./daemon.json', '/etc/docker/', context={"config": daemon_json})
+    changes = manifest.upload(blueprint, './daemon.json', '/etc/docker/', context={"config": daemon_json})
 
     if changes:
         restart()
@@ -107,7 +108,7 @@ def add_scheduled_prune(interval):
         target_location = "/etc/cron.{}/docker-system-prune".format(interval)
         with sudo():
             info('Add recurring purge of Docker containers, images and volumes')
-            blueprint.upload('./docker-system-prune', target_location)
+            manifest.upload(blueprint, './docker-system-prune', target_location)
             debian.chmod(target_location, mode="755")
     else:
         raise ValueError("Interval was '{}' but should be one of: 'hourly', 'daily', 'weekly' or 'monthly'".format(interval))
@@ -40,6 +40,7 @@ from refabric.context_managers import sudo, silent
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 from refabric.operations import run
 
 __all__ = ['start', 'stop', 'restart', 'reload', 'setup', 'configure',
@@ -147,17 +148,17 @@ def configure():
         'mlockall': mlockall
     }
 
-    changes += blueprint.upload('./elasticsearch.yml', '/etc/elasticsearch/',
-                                context=context, user='elasticsearch')
+    changes += manifest.upload(blueprint, './elasticsearch.yml', '/etc/elasticsearch/',
+                               context=context, user='elasticsearch')
 
-    changes += blueprint.upload('./jvm.options', '/etc/elasticsearch/',
-                                context=context, user='elasticsearch')
+    changes += manifest.upload(blueprint, './jvm.options', '/etc/elasticsearch/',
+                               context=context, user='elasticsearch')
 
-    changes += blueprint.upload('./default', '/etc/default/elasticsearch',
-                                context=context, user='elasticsearch')
+    changes += manifest.upload(blueprint, './default', '/etc/default/elasticsearch',
+                               context=context, user='elasticsearch')
 
-    changes += blueprint.upload('./log4j2.properties', '/etc/elasticsearch/',
-                                context=context, user='elasticsearch')
+    changes += manifest.upload(blueprint, './log4j2.properties', '/etc/elasticsearch/',
+                               context=context, user='elasticsearch')
 
     service_dir = "/etc/systemd/system/elasticsearch.service.d"
 
@@ -167,7 +168,7 @@ def configure():
     if disable_swap:
         debian.disable_swap()
 
-    changes += blueprint.upload('./override.conf', service_dir + '/override.conf', context)
+    changes += manifest.upload(blueprint, './override.conf', service_dir + '/override.conf', context)
 
     if changes:
         restart()
@@ -196,7 +197,7 @@ def add_gcs_credentials():
             bin_path = '/usr/share/elasticsearch/bin/'
 
 
-            blueprint.upload('./{}/elastic-snapshots-user-{}.json'.format(env.state, client),
+            manifest.upload(blueprint, './{}/elastic-snapshots-user-{}.json'.format(env.state, client),
                             cred_file, user='root', group='root')
 
             with sudo():
@@ -34,6 +34,7 @@ from refabric.contrib import blueprints
 from refabric.operations import run
 
 from . import debian
+from . import manifest
 
 
 
@@ -82,7 +83,7 @@ def activate_account():
         'service_account_key': blueprint.get('service-account-key', ''),
     }
 
-    blueprint.upload('gcloud-service-account.json', '/gcloud-service-account.json', context)
+    manifest.upload(blueprint, 'gcloud-service-account.json', '/gcloud-service-account.json', context)
     debian.chmod('/gcloud-service-account.json', mode=600, owner=blueprint.get('linux-user', 'root'), group=blueprint.get('linux-user', 'root'))
 
     with sudo(user=blueprint.get('linux-user', None)):
@@ -12,12 +12,17 @@ Installs git and contains useful git commands for other blueprints to use.
       - blues.git
 
 """
+import fcntl
+import json
 import os
 import re
+import tempfile
+import time
 
 from fabric.context_managers import cd
 from fabric.contrib import files
 from fabric.decorators import task
+from fabric.state import env
 from fabric.utils import warn
 from fabric.operations import local
 
@@ -47,13 +52,34 @@ def install():
         debian.apt_get('install', 'git')
 
 
-def clone(url, branch=None, repository_path=None, **kwargs):
+def version():
+    """
+    Get installed git version.
+
+    :return tuple: Version, ex (2, 7, 4), or () if not installed
+    """
+    with silent():
+        output = run('git --version')
+
+    match = re.search(r'git version (\d+(?:\.\d+)*)', output)
+    if output.failed or not match:
+        return ()
+
+    return tuple(map(int, match.group(1).split('.')))
+
+
+def clone(url, branch=None, repository_path=None, reference=None, depth=None,
+          filter=None, **kwargs):
     """
     Clone repository and branch.
 
     :param url: Git url to clone
     :param branch: Branch to checkout
     :param repository_path: Destination
+    :param reference: Path to a local reference repository to borrow objects from,
+        skipped if missing *(Optional)*
+    :param depth: Create a shallow clone with history truncated to depth commits *(Optional)*
+    :param filter: Partial clone filter, ex blob:none, needs git 2.19+ *(Optional)*
     :param kwargs: Not used but here for easier kwarg passing
     :return: (destination, got_cloned bool)
     """
@@ -72,13 +98,33 @@ def clone(url, branch=None, repository_path=None, **kwargs):
              repository_path)
 
         with silent('warnings'):
-            maybe_branch = ''
+            options = []
 
             if branch is not None:
-                maybe_branch = ' -b {branch}'.format(branch=branch)
-
-            cmd = 'git clone{maybe_branch} {remote} {name}'.format(
-                maybe_branch=maybe_branch,
+                options.append('-b {branch}'.format(branch=branch))
+
+            git_version = version() if reference or filter else ()
+
+            if reference:
+                if git_version >= (2, 11):
+                    options.append('--reference-if-able {}'.format(reference))
+                elif files.exists(reference):
+                    options.append('--reference {}'.format(reference))
+                else:
+                    warn('Reference repository {} not found, cloning without it'.format(
+                        reference))
+
+            if depth:
+                options.append('--depth {} --no-single-branch'.format(depth))
+
+            if filter:
+                if git_version >= (2, 19):
+                    options.append('--filter={}'.format(filter))
+                else:
+                    warn('Partial clone needs git 2.19 or later, doing a full clone')
+
+            cmd = 'git clone {options} {remote} {name}'.format(
+                options=' '.join(options),
                 remote=url,
                 name=name)
             output = run(cmd)
@@ -94,6 +140,65 @@ def clone(url, branch=None, repository_path=None, **kwargs):
     return repository_path, cloned
 
 
+def mirror(url, mirror_path, revision=None):
+    """
+    Create or update a bare mirror of a remote repository, to be used as
+    object reference (alternates) by other clones on the same host or share.
+
+    The mirror is never pruned or garbage collected, since clones borrowing
+    its objects would break if any of them were removed.
+
+    :param url: Git url to mirror
+    :param mirror_path: Mirror destination
+    :param revision: Commit hash to make sure the mirror has, skips fetching
+                     if already there *(Optional)*
+    :return bool: Mirror is up to date
+    """
+    git_dir = 'git --git-dir={}'.format(mirror_path)
+
+    with silent('warnings'):
+        if not files.exists(os.path.join(mirror_path, 'objects')):
+            info('Creating git reference repository: {}', mirror_path)
+            output = run('git clone --mirror {url} {path} && '
+                         '{git} config gc.auto 0 && '
+                         '{git} config remote.origin.prune false'.format(
+                             url=url, path=mirror_path, git=git_dir), pty=False)
+        elif revision and re.match(r'^[0-9a-f]{7,40}$', revision) and \
+                run('{} cat-file -e {}^{{commit}}'.format(git_dir, revision),
+                    pty=False).succeeded:
+            # Already fetched, ex by another host sharing the mirror
+            return True
+        else:
+            info('Updating git reference repository: {}', mirror_path)
+            output = run('{git} config gc.auto 0 && '
+                         '{git} config remote.origin.prune false && '
+                         '{git} remote update'.format(git=git_dir), pty=False)
+
+    if output.return_code != 0:
+        warn('Failed to update git reference repository "{}"'.format(mirror_path))
+        return False
+
+    return True
+
+
+def set_alternates(repository_path, reference):
+    """
+    Make an existing clone borrow objects from a reference repository.
+
+    :param repository_path: Repository path
+    :param reference: Path to reference repository
+    """
+    objects_path = os.path.join(reference, 'objects')
+    if not files.exists(objects_path):
+        # Bare repositories keep objects at the root, clones keep them in .git
+        objects_path = os.path.join(reference, '.git', 'objects')
+
+    alternates = os.path.join(repository_path, '.git', 'objects', 'info', 'alternates')
+    with silent():
+        run('grep -qxF {path} {alternates} || echo {path} >> {alternates}'.format(
+            path=objects_path, alternates=alternates))
+
+
 def fetch(repository_path=None):
     if not repository_path:
         repository_path = debian.pwd()
@@ -102,10 +207,22 @@ def fetch(repository_path=None):
         run('git fetch origin', pty=False)
 
 
-def lsremote(repo_url, reftype='branches'):
+"""
+Remote references, memoised per repository url for the whole run.
+
+Parallel subprocesses share the result through a file in ~/.cache/blues, so the
+origin is contacted once per run regardless of the number of hosts. Set
+``lsremote_cache_ttl`` in the fabric env to also reuse it between runs for
+that many seconds (Default: 0).
+"""
+_remote_refs = {}
+
+
+def lsremote(repo_url, reftype='branches', refresh=False):
     """
     Get references from a remote repository.
     :param reftype: the reference types to return: 'branches' or 'tags'
+    :param refresh: Contact remote even if already memoised
 
     :return dict: {reference: revision, ...}
     """
@@ -116,15 +233,106 @@ def lsremote(repo_url, reftype='branches'):
     }
     prefix = prefixes[reftype]
 
+    refs = remote_refs(repo_url, refresh=refresh)
+
+    return {label[len(prefix):]: revision
+            for label, revision in refs.items()
+            if label.startswith(prefix)}
+
+
+def remote_refs(repo_url, refresh=False):
+    """
+    Get all references from a remote repository, memoised per url.
+
+    :param repo_url: Repository url
+    :param refresh: Contact remote even if already memoised
+    :return dict: {refs/heads/master: revision, ...}
+    """
+    if not refresh and repo_url in _remote_refs:
+        return _remote_refs[repo_url]
+
+    with open(_remote_refs_cache_path() + '.lock', 'a') as lock:
+        # Serialize parallel subprocesses and concurrent runs, first one in
+        # does the ls-remote
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            cache = _read_remote_refs_cache()
+            entry = cache.get(repo_url)
+            if refresh or not _is_fresh(entry):
+                entry = {
+                    'run': os.environ['BLUES_RUN'],
+                    'timestamp': time.time(),
+                    'refs': _lsremote(repo_url),
+                }
+                # Failed ls-remote, try again next time
+                if entry['refs']:
+                    cache[repo_url] = entry
+                    _save_remote_refs_cache(cache)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    if entry['refs']:
+        _remote_refs[repo_url] = entry['refs']
+
+    return entry['refs']
+
+
+def _lsremote(repo_url):
     with silent():
         cmd = 'git -c color.ui=never --no-pager ls-remote {}'.format(repo_url)
         output = local(cmd, capture=True)
+        if output.failed:
+            warn('Failed to list remote references of {}'.format(repo_url))
+            return {}
         ls = output.strip().split('\n')
 
     pattern = r'(?P<hash>\w+)\s+(?P<label>[\w\.\-\/]+)'
-    return {match.group('label')[len(prefix):]: match.group('hash')
+    return {match.group('label'): match.group('hash')
             for match in map(lambda x: re.match(pattern, x), ls)
-            if match and match.group('label').startswith(prefix)}
+            if match}
+
+
+def _remote_refs_cache_path():
+    # Private to the local user, shared by all of the user's runs
+    path = os.path.join(os.path.expanduser('~'), '.cache', 'blues')
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path, 0o700)
+        except OSError:
+            pass  # Created by a parallel subprocess
+
+    return os.path.join(path, 'lsremote.json')
+
+
+def _is_fresh(entry):
+    if not entry or not entry.get('refs'):
+        return False
+
+    if entry.get('run') == os.environ['BLUES_RUN']:
+        return True
+
+    ttl = int(env.get('lsremote_cache_ttl', 0))
+    return time.time() - entry.get('timestamp', 0) <= ttl
+
+
+def _read_remote_refs_cache():
+    try:
+        with open(_remote_refs_cache_path()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_remote_refs_cache(cache):
+    path = _remote_refs_cache_path()
+    try:
+        # Written aside and renamed, readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        warn('Failed to persist remote references to {}: {}'.format(path, e))
 
 
 def show_file(repository_path, filename, revision='HEAD'):
@@ -147,20 +355,34 @@ def reset(revision, repository_path=None, **kwargs):
     """
     Fetch, reset, clean and checkout revision.
 
+    :param revision: Revision to reset to
+    :param repository_path: Repository path
+    :param kwargs: ignore: paths to keep when cleaning, depth: shallow fetch depth,
+                   reference: up to date reference repository to fetch from instead of origin
     :return str: commit short hash
     """
     if not repository_path:
         repository_path = debian.pwd()
 
     ignore = kwargs.pop('ignore', None) or []
+    depth = kwargs.pop('depth', None)
+    reference = kwargs.pop('reference', None)
+
+    if reference:
+        # Same refs as fetching origin, without contacting it again
+        remote = '{} +refs/heads/*:refs/remotes/origin/* +refs/tags/*:refs/tags/*'.format(
+            reference)
+    else:
+        remote = 'origin'
 
     with cd(repository_path):
         name = os.path.basename(repository_path)
         info('Resetting git repository: {}@{}', name, revision or 'HEAD')
 
         with silent('warnings'):
+            fetch_options = ' --depth {}'.format(depth) if depth else ''
             commands = [
-                'git fetch origin',  # Fetch branches and tags
+                'git fetch{} {}'.format(fetch_options, remote),  # Fetch branches and tags
                 'git reset --hard HEAD',  # Make hard reset to HEAD
                 # Remove untracked files pyc, xxx~ etc
                 'git clean {} -fdx'.format(' '.join(['-e {}'.format(ign)
@@ -342,6 +564,72 @@ def current_tag(repository_path=None):
         return tag, int(delta)
 
 
+def describe_state(repository_path=None, fetch=False):
+    """
+    Get HEAD, tag and upstream state of repository in one remote command.
+
+    :param repository_path: Repository path
+    :param fetch: Fetch origin first, warns and describes the last fetched
+        upstream state if origin is unreachable
+    :return dict: commit, message, tag, distance, upstream, upstream_commit,
+        upstream_message, ahead, behind. Upstream values are None if HEAD
+        has no tracking branch.
+    """
+    if not repository_path:
+        repository_path = debian.pwd()
+
+    log = 'git -c color.ui=never --no-pager log -1 --pretty=format:%h%x00%s'
+    nul = "printf '\\0'"
+
+    # One NUL delimited field per value, empty if not available
+    commands = [
+        '{} HEAD'.format(log),
+        'git describe --long --tags --always 2>/dev/null',
+        'git rev-parse --abbrev-ref --symbolic-full-name @{u} 2>/dev/null',
+        '{{ {} @{{u}} 2>/dev/null || {}; }}'.format(log, nul),
+        'git rev-list --left-right --count HEAD...@{u} 2>/dev/null || true',
+    ]
+    if fetch:
+        commands.insert(0, 'git fetch -q origin >/dev/null 2>&1 || printf failed')
+    script = '{{ {}; }}'.format('; {}; '.format(nul).join(commands))
+
+    with cd(repository_path), silent():
+        output = run(script, pty=False)
+
+    fields = [field.strip() for field in output.stdout.split('\0')]
+    if fetch and fields.pop(0) == 'failed':
+        warn('Failed to fetch origin of "{}", remote state may be stale'.format(
+            os.path.basename(repository_path)))
+    if output.return_code != 0 or len(fields) != 7 or not fields[0]:
+        raise ValueError('Unable to describe git repository state: {!r}'
+                         .format(output.stdout))
+
+    commit, message, description, upstream, upstream_commit, \
+        upstream_message, counts = fields
+
+    # 20141114.1-306-g72354ae or just the abbreviated commit if no tags
+    tag, distance = None, None
+    if description.count('-') >= 2:
+        tag, distance, _ = description.rsplit('-', 2)
+        distance = int(distance)
+
+    ahead, behind = None, None
+    if counts:
+        ahead, behind = map(int, counts.split())
+
+    return {
+        'commit': commit,
+        'message': message.decode('utf-8'),
+        'tag': tag,
+        'distance': distance,
+        'upstream': upstream or None,
+        'upstream_commit': upstream_commit or None,
+        'upstream_message': upstream_message.decode('utf-8') or None,
+        'ahead': ahead,
+        'behind': behind,
+    }
+
+
 def get_two_most_recent_tags(repository_path):
     """
     Get two most recent tags
@@ -1,8 +1,11 @@
 from fabric.decorators import task
 
+from refabric.api import run
+from refabric.context_managers import sudo, silent
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'status', 'setup', 'configure']
 
@@ -15,6 +18,8 @@ reload = debian.service_task('haproxy', 'reload')
 restart = debian.service_task('haproxy', 'restart')
 status = debian.service_task('haproxy', 'status')
 
+admin_socket = '/var/run/haproxy.sock'
+
 
 @task
 def setup():
@@ -32,7 +37,7 @@ def install():
 
     with sudo():
         add_apt_ppa('vbernat/haproxy-1.5', src=True)
-        apt_get('install', 'haproxy')
+        apt_get('install', 'haproxy', 'socat')
 
 
 @task
@@ -40,6 +45,27 @@ def configure():
     """
     Render and upload haproxy.cfg
     """
-    uploads = blueprint.upload('./', '/etc/haproxy/')
+    uploads = manifest.upload(blueprint, './', '/etc/haproxy/')
     if uploads:
         restart()
+
+
+def set_servers_enabled(backend, servers, enabled=True):
+    """
+    Enable or disable backend servers at runtime, over the admin socket.
+
+    Disabled servers get no new requests, requests in flight are finished.
+
+    :param backend: Backend name
+    :param servers: Server names within backend
+    :param enabled: Enable or disable
+    :return bool: True if successful
+    """
+    command = '; '.join('{} server {}/{}'.format('enable' if enabled else 'disable',
+                                                  backend, server)
+                        for server in servers)
+    with sudo(), silent():
+        output = run('echo "{}" | socat stdio {}'.format(command, admin_socket))
+
+    # Admin socket only answers on errors
+    return output.succeeded and not output.strip()
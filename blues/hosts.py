@@ -7,6 +7,8 @@ from fabric.decorators import task
 from refabric.context_managers import sudo
 from refabric.contrib import blueprints
 
+from . import manifest
+
 __all__ = ['configure']
 
 blueprint = blueprints.get(__name__)
@@ -18,4 +20,4 @@ def configure():
     Configure hosts file
     """
     with sudo():
-        blueprint.upload('hosts', '/etc/hosts')
+        manifest.upload(blueprint, 'hosts', '/etc/hosts')
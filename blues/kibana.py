@@ -32,6 +32,7 @@ from refabric.context_managers import sudo
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 from .elasticsearch import add_elastic_repo
 
 __all__ = ['start', 'stop', 'restart', 'setup', 'configure', 'install_plugin']
@@ -90,7 +91,7 @@ def configure():
         'default_app': blueprint.get('default_app', 'home')
     }
     context["rewritebasepath"] = "true" if context['basepath'] != '' else "false"
-    config = blueprint.upload('./kibana.yml', '/etc/kibana/', context)
+    config = manifest.upload(blueprint, './kibana.yml', '/etc/kibana/', context)
 
     if config:
         restart()
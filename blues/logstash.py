@@ -45,6 +45,7 @@ from refabric.context_managers import sudo, silent
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['setup', 'configure', 'install_plugin', 'start', 'stop', 'restart']
 
@@ -129,8 +130,8 @@ def configure():
         'metrics_host': blueprint.get('metrics_host', 'localhost'),
         'metrics_port': blueprint.get('metrics_port', 9600),
     }
-    uploads += blueprint.upload('./logstash.yml', logstash_root, service_context)
-    uploads += blueprint.upload('./patterns/', grokker_path)
+    uploads += manifest.upload(blueprint, './logstash.yml', logstash_root, service_context)
+    uploads += manifest.upload(blueprint, './patterns/', grokker_path)
 
     # Provision filters
     es_hosts = blueprint.get('es_hosts', 'localhost')
@@ -139,7 +140,7 @@ def configure():
         'es_hosts': es_hosts,
     }
 
-    uploads += blueprint.upload('./conf/', conf_available_path, config_context)
+    uploads += manifest.upload(blueprint, './conf/', conf_available_path, config_context)
     filter_changes = update_filters()
 
     if uploads or filter_changes:
@@ -0,0 +1,107 @@
+"""
+Manifest Uploads
+================
+
+Change detection for blueprint template uploads, for other blueprints to use.
+
+Templates are rendered and hashed locally and the remote hashes for the whole
+destination set are fetched in one remote call. The regular blueprint upload
+only runs if anything differs, so configure tasks without changes cost a
+single round trip instead of one or more per template.
+"""
+import hashlib
+import os
+
+from refabric.context_managers import silent
+from refabric.operations import run
+
+
+def upload(blueprint, template, destination, context=None, user=None, group=None):
+    """
+    Upload rendered template(s) to remote destination, if changed.
+
+    Same signature and return value as ``blueprint.upload()``, which it falls back
+    to whenever the template set can not be resolved locally.
+
+    :param blueprint: Blueprint to render templates with
+    :param template: Template file or dir (ending with /) to upload
+    :param destination: Remote file or dir (ending with /)
+    :param context: Template context
+    :param user: Remote owner of uploaded files
+    :param group: Remote group of uploaded files
+    :return list: Uploaded remote paths
+    """
+    local_hashes = render_manifest(blueprint, template, destination, context)
+
+    if local_hashes:
+        hashes = remote_hashes(local_hashes.keys())
+        if all(hashes.get(path) == md5 for path, md5 in local_hashes.items()):
+            return []
+
+    return blueprint.upload(template, destination, context=context, user=user,
+                            group=group)
+
+
+def render_manifest(blueprint, template, destination, context=None):
+    """
+    Render template(s) locally and hash them by remote destination path.
+
+    :return dict: {remote path: md5, ...} or None if not resolvable
+    """
+    name = template[2:] if template.startswith('./') else template
+    is_dir = not name or name == '.' or name.endswith('/')
+
+    try:
+        names = blueprint.get_template_loader().list_templates()
+    except Exception:
+        return None
+
+    if is_dir:
+        prefix = '' if name == '.' else name
+        targets = {n: os.path.join(destination, n[len(prefix):])
+                   for n in names if n.startswith(prefix)}
+    elif name in names:
+        if destination.endswith('/'):
+            targets = {name: os.path.join(destination, os.path.basename(name))}
+        else:
+            targets = {name: destination}
+    else:
+        return None
+
+    if not targets:
+        return None
+
+    hashes = {}
+    for name, path in targets.items():
+        try:
+            content = blueprint.render_template(name, context)
+        except Exception:
+            return None
+
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+
+        hashes[path] = hashlib.md5(content).hexdigest()
+
+    return hashes
+
+
+def remote_hashes(paths):
+    """
+    Get md5 hashes of remote files in one remote call, missing or unreadable
+    files are left out.
+
+    :param paths: Remote file paths
+    :return dict: {remote path: md5, ...}
+    """
+    with silent():
+        output = run('md5sum {} 2>/dev/null; true'.format(
+            ' '.join('"{}"'.format(path) for path in paths)), pty=False)
+
+    hashes = {}
+    for line in output.stdout.splitlines():
+        md5, _, path = line.strip().partition('  ')
+        if path:
+            hashes[path] = md5
+
+    return hashes
@@ -22,6 +22,7 @@ from refabric.context_managers import sudo, silent
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'status', 'setup', 'configure', 'flush']
 
@@ -57,7 +58,7 @@ def configure():
         'size': blueprint.get('size', 64),
         'bind': blueprint.get('bind', None)
     }
-    uploads = blueprint.upload('memcached', '/etc/', context)
+    uploads = manifest.upload(blueprint, 'memcached', '/etc/', context)
     if uploads:
         restart()
 
@@ -20,6 +20,7 @@ from refabric.context_managers import sudo
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'setup', 'configure']
 
@@ -53,6 +54,6 @@ def configure():
     context = {
         'bind': blueprint.get('bind', '127.0.0.1')
     }
-    uploads = blueprint.upload('mongodb.conf', '/etc/mongodb.conf', context)
+    uploads = manifest.upload(blueprint, 'mongodb.conf', '/etc/mongodb.conf', context)
     if uploads:
         restart()
@@ -29,6 +29,7 @@ from refabric.contrib import blueprints
 from refabric.operations import run
 
 from . import debian
+from . import manifest
 
 __all__ = [
     'start', 'stop', 'restart', 'status', 'force_reload',
@@ -111,7 +112,7 @@ def configure():
         'neo4j-server.properties',
         'neo4j-wrapper.properties',
     ]:
-        updated = bool(blueprint.upload(f, '/etc/neo4j/', context)) or updated
+        updated = bool(manifest.upload(blueprint, f, '/etc/neo4j/', context)) or updated
 
     if updated:
         restart()
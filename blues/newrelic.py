@@ -33,6 +33,7 @@ from refabric.context_managers import sudo
 from refabric.contrib import blueprints
 
 from . import debian, git, python, user
+from . import manifest
 
 from functools import partial
 import urllib2
@@ -126,12 +127,12 @@ def install_plugin_agent():
         python.pip('install', 'newrelic-plugin-agent')
 
         if debian.lsb_release() == '14.04':
-            blueprint.upload('newrelic-plugin-agent.init',
-                             '/etc/init.d/newrelic-plugin-agent')
+            manifest.upload(blueprint, 'newrelic-plugin-agent.init',
+                            '/etc/init.d/newrelic-plugin-agent')
             debian.chmod('/etc/init.d/newrelic-plugin-agent', '755')
         else:
-            blueprint.upload('newrelic-plugin-agent.service',
-                             '/etc/systemd/system/newrelic-plugin-agent.service')
+            manifest.upload(blueprint, 'newrelic-plugin-agent.service',
+                            '/etc/systemd/system/newrelic-plugin-agent.service')
             
 
 
@@ -154,9 +155,9 @@ def configure_infra():
     with sudo():
         info('Adding license key to config')
         context = {"newrelic_key": blueprint.get('newrelic_key', None)}
-        blueprint.upload('newrelic-infra.yml',
-                         '/etc/newrelic-infra.yml',
-                         context=context)
+        manifest.upload(blueprint, 'newrelic-infra.yml',
+                        '/etc/newrelic-infra.yml',
+                        context=context)
 
 
 def configure_agent():
@@ -175,9 +176,9 @@ def configure_plugin_agent():
             context = {p: True for p in enabled_plugins}
             context["newrelic_key"] = newrelic_key
 
-            blueprint.upload('newrelic-plugin-agent.cfg',
-                             '/etc/newrelic/newrelic-plugin-agent.cfg',
-                             context=context)
+            manifest.upload(blueprint, 'newrelic-plugin-agent.cfg',
+                            '/etc/newrelic/newrelic-plugin-agent.cfg',
+                            context=context)
 
 
 def deploy(revision, description, changes=None):
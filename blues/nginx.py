@@ -19,9 +19,27 @@ Nginx Blueprint
         # modules:                  # If present, nginx will be built and installed from source with these modules
         #   - rtmp
         #   - vod
+        # Tuning, derived from host cores, memory and fd limits unless set
+        # worker_processes: auto          # Worker processes (Default: cores)
+        # worker_connections: 16384       # Connections per worker (Default: worker_rlimit_nofile / 2)
+        # worker_rlimit_nofile: 32768     # Fds per worker (Default: fair share of fs.file-max, max 65536)
+        # open_file_cache_max: 10000      # Cached open files (Default: 10000 per GB, max 200000)
+        # sendfile: on                    # (Default: on)
+        # tcp_nopush: on                  # (Default: on)
+        # tcp_nodelay: off                # (Default: off)
+        # reuseport: true                 # Listen with SO_REUSEPORT in the default site (Default: more than one core and nginx 1.9.1+)
+        # gzip_comp_level: 5              # (Default: 4, 5 from 4 cores, 6 from 8 cores)
+        # brotli: true                    # Enable brotli, requires the brotli module (Default: false)
+        # brotli_comp_level: 5            # (Default: as gzip_comp_level)
+        # client_body_buffer_size: 16k    # (Default: 16k)
+        # client_header_buffer_size: 1k   # (Default: 1k)
+        # large_client_header_buffers: 4 8k  # (Default: 4 8k)
+        # proxy_buffer_size: 16k          # (Default: largest of 4k-32k with all buffers within 25% of memory)
+        # proxy_buffers: 8 16k            # (Default: 8 proxy_buffer_size)
 
 """
 import os
+import re
 
 from fabric.context_managers import cd
 from fabric.contrib import files
@@ -33,6 +51,7 @@ from refabric.context_managers import sudo, silent
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'reload', 'setup', 'configure',
            'enable', 'disable', 'tail']
@@ -169,10 +188,8 @@ def configure():
     """
     with sudo():
         # Upload templates
-        context = {
-            'num_cores': debian.nproc()
-        }
-        uploads = blueprint.upload('./', nginx_root, context)
+        context = get_tuning_context()
+        uploads = manifest.upload(blueprint, './', nginx_root, context)
 
         # Disable previously enabled sites not configured sites-enabled
         changes = []
@@ -197,6 +214,131 @@ def configure():
             reload()
 
 
+tuning_settings = (
+    'worker_processes', 'worker_connections', 'worker_rlimit_nofile',
+    'open_file_cache_max', 'sendfile', 'tcp_nopush', 'tcp_nodelay', 'reuseport',
+    'gzip_comp_level', 'brotli', 'brotli_comp_level',
+    'client_body_buffer_size', 'client_header_buffer_size',
+    'large_client_header_buffers', 'proxy_buffer_size', 'proxy_buffers',
+)
+
+
+def version():
+    """
+    Get installed nginx version.
+
+    :return tuple: Version, ex (1, 4, 6), or () if not installed
+    """
+    with silent():
+        output = run('nginx -v 2>&1')
+
+    match = re.search(r'nginx/(\d+(?:\.\d+)*)', output)
+    if output.failed or not match:
+        return ()
+
+    return tuple(map(int, match.group(1).split('.')))
+
+
+def get_tuning_context():
+    """
+    Get nginx.conf tuning derived from host cores, memory and fd limits,
+    any of which can be overridden by a setting with the same name.
+
+    :return dict: Template context
+    """
+    cores = debian.nproc()
+    gb_memory = max(1, int(round(debian.total_memory() / 1024.0 ** 3)))
+
+    context = {
+        'num_cores': cores,
+        'worker_processes': get_worker_processes(cores),
+        'sendfile': 'on',
+        'tcp_nopush': 'on',
+        'tcp_nodelay': 'off',
+        'reuseport': cores > 1 and version() >= (1, 9, 1),
+        'gzip_comp_level': get_comp_level(cores),
+        'brotli': False,
+        'brotli_comp_level': get_comp_level(cores),
+        'client_body_buffer_size': '16k',
+        'client_header_buffer_size': '1k',
+        'large_client_header_buffers': '4 8k',
+        'open_file_cache_max': get_open_file_cache_max(gb_memory),
+    }
+
+    workers = blueprint.get('worker_processes', context['worker_processes'])
+    workers = cores if workers == 'auto' else int(workers)
+    context['worker_rlimit_nofile'] = get_worker_rlimit_nofile(debian.file_max(), workers)
+    context['worker_connections'] = get_worker_connections(context['worker_rlimit_nofile'])
+    context.update(get_proxy_buffers(gb_memory, workers, context['worker_connections']))
+
+    for setting in tuning_settings:
+        context[setting] = blueprint.get(setting, context[setting])
+
+    # YAML reads on/off as booleans
+    for setting in ('sendfile', 'tcp_nopush', 'tcp_nodelay'):
+        if isinstance(context[setting], bool):
+            context[setting] = 'on' if context[setting] else 'off'
+
+    return context
+
+
+def get_worker_processes(cores):
+    """
+    Get number of workers depending on server core count
+    """
+    return cores
+
+
+def get_worker_rlimit_nofile(file_max, workers):
+    """
+    Get fd limit per worker, a fair share of the kernel limit
+    """
+    return max(1024, min(file_max // (workers * 2), 65536))
+
+
+def get_worker_connections(rlimit_nofile):
+    """
+    Get connections per worker, a proxied connection uses two fds
+    """
+    return max(512, rlimit_nofile // 2)
+
+
+def get_comp_level(cores):
+    """
+    Get gzip/brotli level, trading cpu for bandwidth on larger servers
+    """
+    if cores >= 8:
+        return 6
+    elif cores >= 4:
+        return 5
+    else:
+        return 4
+
+
+def get_open_file_cache_max(gb_memory):
+    """
+    Get open_file_cache max entries depending on server memory in GB
+    """
+    return min(gb_memory * 10000, 200000)
+
+
+def get_proxy_buffers(gb_memory, workers, connections):
+    """
+    Get the largest proxy buffers that keep buffers of all busy connections
+    within a quarter of server memory in GB
+    """
+    budget = gb_memory * 1024 ** 3 / 4.0 / (workers * connections)
+    size = 4
+    for kb in (8, 16, 32):
+        if 8 * kb * 1024 <= budget:
+            size = kb
+
+    return {
+        'proxy_buffer_size': '{}k'.format(size),
+        'proxy_buffers': '8 {}k'.format(size),
+    }
+
+
 @task
 def disable(site, do_reload=True):
     """
@@ -259,3 +401,41 @@ def tail(log_name='error'):
     run('tail -f {}'.format(
         os.path.join(log_dir,
                      '{}.log'.format(log_name))))
+
+
+def set_upstream_servers_down(site, servers, down=True):
+    """
+    Mark upstream servers in an enabled site as down, or back up, and reload.
+
+    :param site: Site (config) name in sites-available, without extension
+    :param servers: Upstream server addresses, ex 10.0.0.10:3030
+    :param down: Mark as down or up
+    :return bool: True if successful
+    """
+    path = os.path.join(sites_available_path, '{}.conf'.format(site))
+    addresses = [server.replace('.', r'\.') for server in servers]
+    expressions = []
+    for address in addresses:
+        match = r'/^\s*server\s+{}[ ;]/'.format(address)
+        if down:
+            expressions.append('{}{{/ down;/!s/;/ down;/}}'.format(match))
+        else:
+            expressions.append('{}s/ down;/;/'.format(match))
+
+    # Servers not found in the upstream, ex unix sockets, are not drained
+    marked = r'^\s*server\s+({})( .*)? down;'.format('|'.join(addresses))
+    expected = len(set(servers)) if down else 0
+
+    with sudo(), silent():
+        output = run("sed -i -E {expressions} {path} && "
+                     "test $(grep -cE '{marked}' {path}) -eq {expected} && "
+                     "nginx -t -q && service nginx reload".format(
+                         expressions=' '.join("-e '{}'".format(expression)
+                                              for expression in expressions),
+                         path=path, marked=marked, expected=expected))
+
+    if not output.succeeded:
+        warn('Failed to mark {} {} in nginx site {}'.format(
+            ', '.join(servers), 'down' if down else 'up', site))
+
+    return output.succeeded
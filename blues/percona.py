@@ -39,6 +39,7 @@ from refabric.contrib import blueprints
 from refabric.utils import info
 
 from blues import debian
+from blues import manifest
 
 
 blueprint = blueprints.get(__name__)
@@ -61,7 +62,7 @@ def install():
         root_conf_path = '/root/.my.cnf'
         if not fabric.contrib.files.exists(root_conf_path):
             root_pw = generate_password()
-            blueprint.upload('root_my.cnf', '/root/.my.cnf', {'password': root_pw})
+            manifest.upload(blueprint, 'root_my.cnf', '/root/.my.cnf', {'password': root_pw})
             debian.chmod('/root/.my.cnf', mode=600)
         else:
             # TODO: use fabric.operations.get instead of cat when up to date with upstream
@@ -140,7 +141,7 @@ def configure():
     Configure Percona
     """
     context = {'bind': blueprint.get('bind')}
-    uploads = blueprint.upload('my.cnf', '/etc/mysql/my.cnf', context=context)
+    uploads = manifest.upload(blueprint, 'my.cnf', '/etc/mysql/my.cnf', context=context)
     if uploads:
         warn('The mysql config has changed!')
         answer = prompt('Type "yes" to restart, or "no" to skip:',
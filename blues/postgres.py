@@ -35,6 +35,7 @@ from refabric.context_managers import sudo, silent
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'reload', 'setup', 'configure',
            'setup_schemas', 'dump', 'status']
@@ -115,15 +116,15 @@ def configure():
         'wal_keep_segments': blueprint.get('wal_keep_segments', 16),
     }
     updates = [
-        blueprint.upload(os.path.join('.', 'pg_hba.conf'),
-                         postgres_root(),
-                         context=context,
-                         user='postgres'),
-        blueprint.upload(os.path.join('.',
+        manifest.upload(blueprint, os.path.join('.', 'pg_hba.conf'),
+                        postgres_root(),
+                        context=context,
+                        user='postgres'),
+        manifest.upload(blueprint, os.path.join('.',
                                       'postgresql-{}.conf'.format(version())),
-                         postgres_root('postgresql.conf'),
-                         context=context,
-                         user='postgres')
+                        postgres_root('postgresql.conf'),
+                        context=context,
+                        user='postgres')
     ]
 
     if any(updates):
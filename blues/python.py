@@ -13,10 +13,11 @@ Contains pip helper for other blueprints to use.
       - blues.python
 
 """
+from fabric.context_managers import settings
 from fabric.decorators import task
 
 from refabric.api import run, info
-from refabric.context_managers import sudo
+from refabric.context_managers import sudo, silent
 from refabric.contrib import blueprints
 
 from . import debian
@@ -103,14 +104,51 @@ def pip(command, *options, **kwargs):
                      'pip3' if requested_version() >= (3,)
                      else 'pip2')
     quiet = kwargs.pop('quiet', False)
+    find_links = kwargs.pop('find_links', None)
     cmd = ('{pip} {command} {options} {verbosity} '
            '--exists-action=s --log={log_file} --log-file={log_file}')
 
-    run(cmd.format(pip=bin,
-                   command=command,
-                   options=' '.join(options),
-                   verbosity='-v' if not quiet else '-q',
-                   log_file=pip_log_file), pty=False)
+    if find_links:
+        # Install from local wheelhouse only
+        options += ('--no-index', '--find-links={}'.format(find_links))
+
+    return run(cmd.format(pip=bin,
+                          command=command,
+                          options=' '.join(options),
+                          verbosity='-v' if not quiet else '-q',
+                          log_file=pip_log_file), pty=False)
+
+
+def build_wheels(requirements, wheel_dir, quiet=True):
+    """
+    Build wheels for all requirements into wheel dir.
+
+    :param requirements: Requirements file
+    :param wheel_dir: Destination dir for built wheels
+    :return bool: Wheels got built
+    """
+    info('Building wheels for: {}', requirements)
+    with settings(warn_only=True):
+        output = pip('wheel', '-r', requirements, '--wheel-dir', wheel_dir,
+                     quiet=quiet)
+
+    return output.succeeded
+
+
+def abi_tag():
+    """
+    Get ABI tag of current python interpreter, ex cpython-36m-x86_64-linux-gnu
+
+    :return str: ABI tag
+    """
+    with silent():
+        output = run("python -c 'import sys, sysconfig, platform; "
+                     "print(sysconfig.get_config_var(\"SOABI\") or "
+                     "\"cp{}{}{}-{}\".format(sys.version_info[0], sys.version_info[1], "
+                     "\"mu\" if sys.maxunicode > 0xffff else \"m\", platform.machine()))'",
+                     pty=False)
+
+    return output.strip()
 
 
 def pip_sync(manifest, quiet=False):
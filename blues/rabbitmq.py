@@ -19,6 +19,7 @@ from refabric.contrib import blueprints
 from fabric.operations import prompt
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'reload', 'setup', 'setup_users','configure',
            'ctl', 'reset', 'useradd']
@@ -42,11 +43,11 @@ def setup():
     else:
         install_stable()
 
-    blueprint.upload('default/rabbitmq-server',
-                     '/etc/default/rabbitmq-server',
-                     context={
+    manifest.upload(blueprint, 'default/rabbitmq-server',
+                    '/etc/default/rabbitmq-server',
+                    context={
                         'ulimit': blueprint.get('ulimit', '102400')
-                     })
+                    })
 
     configure()
 
@@ -87,10 +88,10 @@ def configure():
     """
     Configure Rabbitmq
     """
-    uploads = blueprint.upload('rabbitmq/', '/etc/rabbitmq/')
-    uploads.extend(blueprint.upload('erlang.cookie',
-                                    '/var/lib/rabbitmq/.erlang.cookie',
-                                    user='rabbitmq')
+    uploads = manifest.upload(blueprint, 'rabbitmq/', '/etc/rabbitmq/')
+    uploads.extend(manifest.upload(blueprint, 'erlang.cookie',
+                                   '/var/lib/rabbitmq/.erlang.cookie',
+                                   user='rabbitmq')
                    or [])
     if uploads:
         restart()
@@ -25,6 +25,7 @@ from refabric.contrib import blueprints
 from refabric import api
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'setup', 'configure', 'info']
 
@@ -71,7 +72,7 @@ def configure():
 
         context['bgsave'] = bgsave
 
-    uploads = blueprint.upload('redis.conf', '/etc/redis/redis.conf', context)
+    uploads = manifest.upload(blueprint, 'redis.conf', '/etc/redis/redis.conf', context)
     debian.chmod('/etc/redis/redis.conf', mode=640, owner='redis', group='redis')
 
     if uploads:
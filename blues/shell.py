@@ -26,6 +26,7 @@ from refabric.context_managers import sudo, silent, hide_prefix
 from refabric.operations import run
 
 from blues import debian
+from blues import manifest
 
 __all__ = ['setup', 'configure', 'configure_profile', 'grep']
 
@@ -75,7 +76,7 @@ def configure():
 
 def configure_profile(home_dir, dotenv=False):
     info('Configuring profile {}', home_dir)
-    blueprint.upload('.', home_dir, {
+    manifest.upload(blueprint, '.', home_dir, {
         'host_color': get_host_color(),
         'dotenv': dotenv
     })
@@ -15,6 +15,9 @@ Slack Blueprint
           - "#deploy"
         username: deploybot
         icon_emoji: ":rocket"
+        # timeout: 5                          # Request timeout in seconds (Default: 5)
+        # retries: 3                          # Retries on failure, with exponential backoff (Default: 3)
+        # async: false                        # Send from a background thread (Default: true)
 
         # Multiple configs:
         # - endpoint: https://hooks.slack.com/...  # (Required)
@@ -25,15 +28,38 @@ Slack Blueprint
         # - ...
 
 """
+import atexit
+import httplib
+import json
+import os
+import tempfile
+import threading
+import time
+import Queue
+from contextlib import contextmanager
+from urlparse import urlparse
+
 from fabric.utils import warn
 from refabric.contrib import blueprints
-import urllib2
-import json
 
 blueprint = blueprints.get(__name__)
 
 
-def notify(msg, attachment=None, quiet=True):
+def notify(msg, attachment=None, quiet=True, coalesce=False):
+    """
+    Send message to all configured slack channels.
+
+    :param msg: Message text
+    :param attachment: Optional message attachment
+    :param quiet: Warn instead of raise on failure
+    :param coalesce: Collect message into one summary post, within a
+        coalesced() block (by rolling deploys)
+    """
+    if coalesce and coalesce_path():
+        with open(coalesce_path(), 'a') as f:
+            f.write(json.dumps(msg) + '\n')
+        return
+
     slack_config = blueprint.get('')
 
     if isinstance(slack_config, dict):
@@ -43,6 +69,64 @@ def notify(msg, attachment=None, quiet=True):
         notify_with_config(msg, attachment, config, quiet)
 
 
+def configured():
+    """
+    Check if any slack config is set.
+    """
+    return bool(blueprint.get('', None))
+
+
+def coalesce_path():
+    return os.environ.get('BLUES_SLACK_COALESCE')
+
+
+@contextmanager
+def coalesced(title=None, quiet=True):
+    """
+    Collect messages sent with coalesce within the block, also from Fabric's
+    forked parallel subprocesses, and post them as one summary message.
+
+    :param title: Optional first line of summary
+    """
+    if coalesce_path():
+        # Nested blocks join the outer summary
+        yield
+        return
+
+    # Private spool, inherited by forked subprocesses through the environment
+    fd, path = tempfile.mkstemp(prefix='blues-', suffix='.slack')
+    os.close(fd)
+    os.environ['BLUES_SLACK_COALESCE'] = path
+    try:
+        yield
+    finally:
+        del os.environ['BLUES_SLACK_COALESCE']
+        flush_coalesced(path, title=title, quiet=quiet)
+
+
+def flush_coalesced(path, title=None, quiet=True):
+    """
+    Post all messages in a coalesce spool as one summary message, and remove it.
+
+    :param path: Spool path
+    :param title: Optional first line of summary
+    :return int: Number of coalesced messages
+    """
+    try:
+        with open(path) as f:
+            messages = [json.loads(line) for line in f if line.strip()]
+        os.remove(path)
+    except (IOError, OSError):
+        return 0
+
+    if messages:
+        lines = [title] if title else []
+        lines.extend(messages)
+        notify(u'\n'.join(lines), quiet=quiet)
+
+    return len(messages)
+
+
 def notify_with_config(msg, attachment, config, quiet):
     channels = config.get('channels', [])
     channel = config.get('channel', None)
@@ -64,12 +148,24 @@ def notify_with_config(msg, attachment, config, quiet):
         warn('No slack API endpoint found, skipping notification')
         return False
 
+    options = {
+        'timeout': config.get('timeout', 5),
+        'retries': config.get('retries', 3),
+    }
+
     for channel in set(channels):
-        send_request(endpoint=endpoint, channel=channel, username=username,
-                     msg=msg, attachment=attachment, icon_emoji=icon_emoji, quiet=quiet)
+        data = build_request(channel=channel, username=username, msg=msg,
+                             attachment=attachment, icon_emoji=icon_emoji)
+
+        # Failures can only be raised to the caller when sent right away, and
+        # forked (parallel) processes exit without running atexit hooks
+        if config.get('async', True) and quiet and dispatcher.owns_process():
+            dispatcher.put(endpoint, data, **options)
+        else:
+            send_request(endpoint, data, quiet=quiet, **options)
 
 
-def send_request(endpoint, channel, username, msg, attachment, icon_emoji, quiet=True):
+def build_request(channel, username, msg, attachment, icon_emoji):
     data = {
         "channel": channel,
         "username": username,
@@ -80,12 +176,123 @@ def send_request(endpoint, channel, username, msg, attachment, icon_emoji, quiet
     if attachment:
         data["attachments"] = [attachment, ]
 
-    req = urllib2.Request(endpoint, json.dumps(data), {'Content-Type': 'application/json'})
+    return data
+
+
+_connections = {}
+# Shared by the dispatcher thread and synchronous sends
+_connections_lock = threading.Lock()
+
+
+def send_request(endpoint, data, quiet=True, timeout=5, retries=3):
+    """
+    Post data to endpoint, reusing one connection per endpoint and retrying
+    with exponential backoff.
+    """
+    url = urlparse(endpoint)
+    key = (url.scheme, url.netloc)
+    body = json.dumps(data)
+    path = url.path + ('?' + url.query if url.query else '')
+
+    for attempt in range(retries + 1):
+        try:
+            with _connections_lock:
+                status, reason = post(key, path, body, timeout)
+
+            if status < 300:
+                return True
+
+            error = 'Slack responded {} {}'.format(status, reason)
+            if status < 500 and status != 429:
+                # Not worth retrying
+                break
+
+        except Exception as e:
+            error = e
+
+        if attempt < retries:
+            time.sleep(0.5 * 2 ** attempt)
+
+    if quiet:
+        warn(error)
+        return False
+    else:
+        raise Exception(error)
+
+
+def post(key, path, body, timeout):
+    """
+    Post body over the cached connection for key, dropping the connection on
+    failure. Call with _connections_lock held.
+
+    :return tuple: (status, reason)
+    """
+    scheme, netloc = key
     try:
-        urllib2.urlopen(req).close()
+        connection = _connections.get(key)
+        if connection is None:
+            Connection = httplib.HTTPSConnection if scheme == 'https' \
+                else httplib.HTTPConnection
+            connection = _connections[key] = Connection(netloc, timeout=timeout)
 
-    except Exception as e:
-        if quiet:
-            warn(e)
-        else:
-            raise
+        connection.request('POST', path, body,
+                           {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        return response.status, response.reason
+
+    except Exception:
+        connection = _connections.pop(key, None)
+        if connection is not None:
+            connection.close()
+        raise
+
+
+class Dispatcher(object):
+    """
+    Sends queued notifications from a background thread, so slow or
+    unreachable endpoints do not block the deploy.
+    """
+    def __init__(self, maxsize=100):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def owns_process(self):
+        return os.getpid() == self.pid
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work,
+                                               name='slack-dispatcher')
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def put(self, endpoint, data, **options):
+        self.start()
+        try:
+            self.queue.put((endpoint, data, options), timeout=1)
+        except Queue.Full:
+            warn('Slack notification queue is full, skipping notification')
+
+    def work(self):
+        while True:
+            endpoint, data, options = self.queue.get()
+            try:
+                send_request(endpoint, data, quiet=True, **options)
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout=30):
+        """
+        Wait for queued notifications to be sent.
+        """
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+
+
+dispatcher = Dispatcher()
@@ -27,6 +27,7 @@ from refabric.contrib import blueprints
 
 from . import user
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'setup', 'configure', 'tail']
 
@@ -104,13 +105,13 @@ def configure():
     """
     Configure Solr
     """
-    updated_confs = blueprint.upload('solr_home/', '/etc/solr/', user='solr')
+    updated_confs = manifest.upload(blueprint, 'solr_home/', '/etc/solr/', user='solr')
 
     context = {'memory': blueprint.get('memory', '512m')}
     if debian.lsb_release() == '14.04':
-        updated_init = blueprint.upload('init/', '/etc/init/', context)
+        updated_init = manifest.upload(blueprint, 'init/', '/etc/init/', context)
     else:
-        updated_init = blueprint.upload('systemd/solr.service', '/etc/systemd/system/', context)
+        updated_init = manifest.upload(blueprint, 'systemd/solr.service', '/etc/systemd/system/', context)
         debian.systemd_daemon_reload()
         
 
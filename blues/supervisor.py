@@ -22,7 +22,11 @@ and enable them manually with the `programs` setting.
         # auto_disable_programs: true  # Auto disable programs not specified in `programs` setting (Default: true)
 
 """
+from collections import namedtuple
+from datetime import timedelta
 from functools import partial
+import base64
+import json
 import os
 
 from fabric.context_managers import cd
@@ -36,6 +40,7 @@ from refabric.contrib import blueprints
 
 from . import debian
 from . import python
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'reload', 'setup', 'configure',
            'enable', 'disable', 'ctl', 'status']
@@ -48,6 +53,7 @@ programs_available_path = os.path.join(supervisord_root, 'programs-available')
 programs_enabled_path = os.path.join(supervisord_root, 'programs-enabled')
 log_path = '/var/log/supervisord'
 tmpfs_path = '/run/supervisord'
+socket_path = os.path.join(tmpfs_path, 'supervisor.sock')
 
 
 @task
@@ -99,17 +105,17 @@ def configure():
     with sudo():
         # Upload service templates
         if debian.lsb_release() == '14.04':
-            uploads = blueprint.upload('init/supervisor.conf', '/etc/init/supervisor.conf')
-            blueprint.upload('init.d/supervisor','/etc/init.d/supervisor')
+            uploads = manifest.upload(blueprint, 'init/supervisor.conf', '/etc/init/supervisor.conf')
+            manifest.upload(blueprint, 'init.d/supervisor','/etc/init.d/supervisor')
             debian.chmod('/etc/init.d/supervisor',mode=755)
         else:
-            uploads = blueprint.upload('systemd/supervisor.service', '/etc/systemd/system/supervisor.service')
-            uploads = blueprint.upload('tmpfiles.d/supervisor.conf', '/etc/tmpfiles.d/supervisor.conf')
+            uploads = manifest.upload(blueprint, 'systemd/supervisor.service', '/etc/systemd/system/supervisor.service')
+            uploads = manifest.upload(blueprint, 'tmpfiles.d/supervisor.conf', '/etc/tmpfiles.d/supervisor.conf')
             debian.systemd_daemon_reload()
 
-        uploads.extend(blueprint.upload('supervisord.conf', '/etc/') or [])
-        uploads.extend(blueprint.upload('programs-available/',
-                                        programs_available_path + '/') or [])
+        uploads.extend(manifest.upload(blueprint, 'supervisord.conf', '/etc/') or [])
+        uploads.extend(manifest.upload(blueprint, 'programs-available/',
+                                       programs_available_path + '/') or [])
 
         # Disable previously enabled programs not configured programs-enabled
         changes = []
@@ -201,27 +207,198 @@ def supervisorctl(command, program=''):
         return run('supervisorctl {} {}'.format(command, program or ''))
 
 
-def service(command, program=None):
+"""
+XML-RPC control of supervisord.
+
+Calls are made by a small python script, run over the existing SSH
+connection with the interpreter supervisor is installed for, talking to the
+supervisord unix socket. All programs of a start/stop/restart are handled in
+one multicall per step and state transitions are awaited within the same
+remote command, so controlling any number of programs is a single round trip.
+"""
+rpc_script = """
+import fnmatch
+import json
+import time
+
+from supervisor import childutils
+
+rpc = childutils.getRPCInterface({'SUPERVISOR_SERVER_URL': SERVER_URL})
+
+ALREADY_STARTED, NOT_RUNNING = 60, 70
+ACTIVE = ('STARTING', 'RUNNING', 'BACKOFF')
+INACTIVE = ('STOPPED', 'EXITED', 'FATAL')
+
+
+def full_name(process):
+    if process['group'] == process['name']:
+        return process['name']
+    return '%s:%s' % (process['group'], process['name'])
+
+
+def select(patterns):
+    return [process for process in rpc.supervisor.getAllProcessInfo()
+            if any(pattern in ('all', process['group']) or
+                   fnmatch.fnmatch(full_name(process), pattern)
+                   for pattern in patterns)]
+
+
+def multicall(method, processes):
+    calls = [{'methodName': method,
+              'params': ['%s:%s' % (process['group'], process['name']), False]}
+             for process in processes]
+    results = rpc.system.multicall(calls) if calls else []
+    return ['%s: %s' % (full_name(process), result['faultString'])
+            for process, result in zip(processes, results)
+            if isinstance(result, dict) and
+            result.get('faultCode') not in (None, ALREADY_STARTED, NOT_RUNNING)]
+
+
+def wait(processes, states, timeout):
+    names = set(full_name(process) for process in processes)
+    deadline = time.time() + timeout
+    while True:
+        processes = [process for process in rpc.supervisor.getAllProcessInfo()
+                     if full_name(process) in names]
+        if all(process['statename'] in states for process in processes):
+            return processes, True
+        if 'FATAL' not in states and \\
+                any(process['statename'] == 'FATAL' for process in processes):
+            return processes, False
+        if time.time() > deadline:
+            return processes, False
+        time.sleep(0.5)
+
+
+def stop_timeout(processes, timeout):
+    # supervisord kills programs still running after their stopwaitsecs
+    try:
+        configs = rpc.supervisor.getAllConfigInfo()
+    except Exception:
+        return timeout
+    names = set(full_name(process) for process in processes)
+    waits = [config.get('stopwaitsecs', 0) for config in configs
+             if full_name(config) in names]
+    return max([timeout] + [wait + 5 for wait in waits])
+
+
+def timed_out(processes, states, step, timeout):
+    return ['%s: timed out after %ds waiting to %s, %s' % (
+                full_name(process), timeout, step, process['statename'])
+            for process in processes
+            if process['statename'] not in states + ('FATAL',)]
+
+
+def main(action, patterns, timeout):
+    processes = select(patterns)
+    errors, ok = [], True
+    if action in ('stop', 'restart'):
+        errors += multicall('supervisor.stopProcess',
+                            [process for process in processes
+                             if process['statename'] in ACTIVE])
+        wait_secs = stop_timeout(processes, timeout)
+        processes, ok = wait(processes, INACTIVE, wait_secs)
+        if not ok:
+            errors += timed_out(processes, INACTIVE, 'stop', wait_secs)
+    if action in ('start', 'restart'):
+        # Start whatever did stop, a restart never leaves programs down
+        processes_to_start = [process for process in processes
+                              if action == 'start' or process['statename'] in INACTIVE]
+        errors += multicall('supervisor.startProcess', processes_to_start)
+        processes, started = wait(processes, ('RUNNING',), timeout)
+        if not started:
+            errors += timed_out(processes, ('RUNNING',), 'start', timeout)
+        ok = ok and started
+    return {'processes': processes, 'errors': errors, 'ok': ok and not errors}
+"""
+
+ProcessStatus = namedtuple('ProcessStatus', ['name', 'group', 'state', 'pid',
+                                             'uptime', 'description'])
+
+
+def rpc(action, program='all', timeout=60):
+    """
+    Control or query programs over supervisord's XML-RPC interface.
+
+    :param action: start, stop, restart or status
+    :param program: Program name, group:name, pattern, group or all
+    :param timeout: Seconds to wait for programs to reach the new state, stopping
+        waits at least as long as the programs' stopwaitsecs
+    :return tuple: (ok, [ProcessStatus, ...], [error, ...])
+    """
+    patterns = [pattern.strip() for pattern in (program or 'all').split(',')]
+    script = '\n'.join([
+        'SERVER_URL = {!r}'.format('unix://{}'.format(socket_path)),
+        rpc_script,
+        'print(json.dumps(main({!r}, {!r}, {!r})))'.format(
+            action, patterns, float(timeout)),
+    ])
+
+    with sudo(), silent():
+        # Run with the interpreter supervisor is installed for
+        output = run('echo {} | base64 -d | '
+                     '$(head -1 $(command -v supervisorctl) | cut -c3-) -'.format(
+                         base64.b64encode(script)), pty=False)
+
+    if not output.succeeded:
+        return False, [], [output.stdout.strip() or 'supervisord is not reachable']
+
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    processes = [ProcessStatus(name=process['name'],
+                               group=process['group'],
+                               state=process['statename'],
+                               pid=process['pid'],
+                               uptime=process['now'] - process['start']
+                               if process['statename'] == 'RUNNING' else 0,
+                               description=process['description'])
+                 for process in result['processes']]
+
+    return result['ok'], processes, result['errors']
+
+
+def control(action, program, timeout=60):
+    """
+    Start, stop or restart programs and wait for them to get there.
+
+    :return bool: True if all programs reached the new state
+    """
+    ok, processes, errors = rpc(action, program, timeout=timeout)
+
+    for error in errors:
+        warn(error)
+
+    if not ok:
+        states = ', '.join('{}:{} {}'.format(process.group, process.name, process.state)
+                           for process in processes)
+        warn('Failed to {} {}: {}'.format(action, program, states))
+
+    return ok
+
+
+def service(command, program=None, timeout=60):
     if not program:
-        debian.service('supervisor', command)
+        return debian.service('supervisor', command)
+    elif command in ('start', 'stop', 'restart'):
+        return control(command, program, timeout=timeout)
     else:
-        supervisorctl(command, program)
+        return supervisorctl(command, program)
 
 
 @task
-def reload(program=None):
+def reload(program=None, timeout=60):
     """
     Reload supervisor or restart programs
 
     :param program: The program to start (all|exact|pattern). If not given,
         the supervisor service will reload.
+    :param timeout: Seconds to wait for restarted programs to get running
     """
     info('Reloading {}', program or 'supervisord')
     if not program:
-        service('reload')
+        return service('reload')
 
     else:
-        service('restart', program=program)
+        return service('restart', program=program, timeout=timeout)
 
 
 @task
@@ -242,11 +419,20 @@ def ctl(command, program=''):
 @task
 def status(program=''):
     """
-    Show program(s) status, shortcut to supervisorctl status
+    Show program(s) status
 
     :param program: Optional program to query status
+    :return list: [ProcessStatus, ...]
     """
-    ctl('status', program=program)
+    _, processes, errors = rpc('status', program)
+    for error in errors:
+        warn(error)
+
+    for process in processes:
+        info('{:<40} {:<10} pid {:<7} uptime {}', '{}:{}'.format(process.group, process.name),
+             process.state, process.pid, timedelta(seconds=process.uptime))
+
+    return processes
 
 
 start = task(partial(service, 'start'))
@@ -28,6 +28,7 @@ from refabric.operations import run
 from refabric.utils import info
 
 from . import debian
+from . import manifest
 
 __all__ = [ 'list', 'configure']
 
@@ -65,7 +66,7 @@ def configure():
 
         # Configure application
         local_params=blueprint.get('params',[])
-        uploads.append(blueprint.upload('./sysctl.conf',config_dir,{"params" : local_params}))
-        uploads.append(blueprint.upload('./sysctl.d/', sysctl_dir))
+        uploads.append(manifest.upload(blueprint, './sysctl.conf',config_dir,{"params" : local_params}))
+        uploads.append(manifest.upload(blueprint, './sysctl.d/', sysctl_dir))
 
         info("In order for the new settings to work you need to reboot the system.")
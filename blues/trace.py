@@ -0,0 +1,301 @@
+"""
+Trace
+=====
+
+Timing instrumentation for tasks, phases and remote commands.
+
+Enabled by setting ``trace`` in the fabric env to an output path prefix::
+
+    fab --set trace=deploy app.deploy
+
+Writes ``deploy.json`` with all recorded events and ``deploy.trace.json`` in
+the Chrome trace event format (open in chrome://tracing or Perfetto).
+
+Every remote command is attributed to the innermost blues function issuing it,
+ex ``debian.get_user``, and the top call sites per task are reported, the
+number of sites shown can be set with ``trace_top`` (Default: 10).
+
+Events are appended to a private temp file created once per run, so that
+phases timed in Fabric's parallel subprocesses end up in the same trace. The
+trace is exported and summarized once, when the run exits, and the temp file
+removed.
+"""
+import atexit
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import fabric.operations
+from fabric.state import env
+
+from refabric.utils import info
+
+__all__ = ['phase', 'timed', 'record', 'export', 'print_summary',
+           'print_hotspots']
+
+
+def enabled():
+    return bool(env.get('trace'))
+
+
+def begin():
+    """
+    Begin tracing current run, if enabled.
+
+    Creates the events file, inherited by later forked subprocesses through
+    the process environment, hooks remote commands and reports at exit.
+    """
+    if not enabled() or os.environ.get('BLUES_TRACE_EVENTS'):
+        return
+
+    fd, path = tempfile.mkstemp(prefix='blues-', suffix='.trace.events')
+    os.close(fd)
+    os.environ['BLUES_TRACE_EVENTS'] = path
+
+    install_command_hook()
+    atexit.register(finish, os.getpid())
+
+
+def finish(pid):
+    """
+    Export and summarize the trace, then remove the events file. Only in
+    the process that started the trace.
+    """
+    if os.getpid() != pid:
+        return
+
+    try:
+        export()
+        print_summary()
+        print_hotspots()
+    finally:
+        os.remove(events_path())
+
+
+def events_path():
+    return os.environ['BLUES_TRACE_EVENTS']
+
+
+def record(name, category, start, duration, **args):
+    """
+    Record a finished event for current host.
+
+    :param name: Event name
+    :param category: Event category, ex phase or command
+    :param start: Start timestamp in seconds
+    :param duration: Duration in seconds
+    :param args: Extra event details
+    """
+    if not enabled():
+        return
+
+    begin()
+    event = {
+        'name': name,
+        'cat': category,
+        'host': env.host_string or 'local',
+        'pid': os.getpid(),
+        'start': start,
+        'duration': duration,
+        'args': args,
+    }
+
+    # Single appending write per event, safe across processes
+    with open(events_path(), 'a') as f:
+        f.write(json.dumps(event) + '\n')
+
+
+@contextmanager
+def phase(name, **args):
+    """
+    Time the wrapped block as a named phase.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, 'phase', start, time.time() - start, **args)
+
+
+def timed(name=None):
+    """
+    Decorator timing each call of the function as a phase.
+
+    :param name: Phase name (Default: function name)
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_events():
+    if not os.environ.get('BLUES_TRACE_EVENTS'):
+        return []
+
+    try:
+        with open(events_path()) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except IOError:
+        return []
+
+
+def export(events=None):
+    """
+    Write recorded events as JSON and as a Chrome trace event file.
+
+    :return tuple: (json path, trace path)
+    """
+    if not enabled():
+        return None
+
+    events = load_events() if events is None else events
+    json_path = '{}.json'.format(env.trace)
+    trace_path = '{}.trace.json'.format(env.trace)
+
+    with open(json_path, 'w') as f:
+        json.dump(events, f, indent=2)
+
+    # One trace "process" per host, one "thread" per OS process
+    hosts = sorted(set(event['host'] for event in events))
+    trace_events = [{'ph': 'M', 'name': 'process_name', 'pid': i,
+                     'args': {'name': host}}
+                    for i, host in enumerate(hosts)]
+    trace_events += [{'ph': 'X',
+                      'name': event['name'],
+                      'cat': event['cat'],
+                      'pid': hosts.index(event['host']),
+                      'tid': event['pid'],
+                      'ts': int(event['start'] * 1e6),
+                      'dur': int(event['duration'] * 1e6),
+                      'args': event['args']}
+                     for event in events]
+
+    with open(trace_path, 'w') as f:
+        json.dump({'traceEvents': trace_events}, f)
+
+    return json_path, trace_path
+
+
+def print_summary(host=None, category='phase'):
+    """
+    Print a table of recorded durations per phase.
+
+    :param host: Only summarize events for host (Default: all hosts)
+    :param category: Event category to summarize
+    """
+    if not enabled():
+        return
+
+    totals = {}
+    for event in load_events():
+        if event['cat'] != category or (host and event['host'] != host):
+            continue
+        stats = totals.setdefault(event['name'], {'hosts': set(), 'calls': 0,
+                                                  'total': 0.0, 'max': 0.0})
+        stats['hosts'].add(event['host'])
+        stats['calls'] += 1
+        stats['total'] += event['duration']
+        stats['max'] = max(stats['max'], event['duration'])
+
+    if not totals:
+        return
+
+    rows = ['{:<32} {:>5} {:>5} {:>9} {:>9} {:>9}'.format(
+        category, 'hosts', 'calls', 'total', 'avg', 'max')]
+    for name, stats in sorted(totals.items(), key=lambda x: -x[1]['total']):
+        rows.append('{:<32} {:>5} {:>5} {:>8.2f}s {:>8.2f}s {:>8.2f}s'.format(
+            name[:32], len(stats['hosts']), stats['calls'], stats['total'],
+            stats['total'] / stats['calls'], stats['max']))
+
+    info('Timing summary{}:\n{}', ' for {}'.format(host) if host else '',
+         '\n'.join(rows))
+
+
+def print_hotspots(host=None, limit=None):
+    """
+    Print the blues functions issuing the most remote command time, per task.
+
+    :param host: Only count commands run on host (Default: all hosts)
+    :param limit: Call sites to show per task (Default: trace_top env or 10)
+    """
+    if not enabled():
+        return
+
+    limit = int(limit or env.get('trace_top', 10))
+
+    sites = {}
+    for event in load_events():
+        if event['cat'] != 'command' or (host and event['host'] != host):
+            continue
+        key = (event['args'].get('task') or '-', event['args'].get('site'))
+        stats = sites.setdefault(key, {'calls': 0, 'total': 0.0})
+        stats['calls'] += 1
+        stats['total'] += event['duration']
+
+    tasks = sorted(set(task for task, _ in sites))
+    for task in tasks:
+        rows = ['{:<48} {:>6} {:>9} {:>9}'.format('call site', 'calls',
+                                                  'total', 'avg')]
+        task_sites = [(site, stats) for (t, site), stats in sites.items()
+                      if t == task]
+        task_sites.sort(key=lambda x: -x[1]['total'])
+        for site, stats in task_sites[:limit]:
+            rows.append('{:<48} {:>6} {:>8.2f}s {:>8.2f}s'.format(
+                site[:48], stats['calls'], stats['total'],
+                stats['total'] / stats['calls']))
+
+        calls = sum(stats['calls'] for _, stats in task_sites)
+        info('Remote commands for task {} ({} round trips):\n{}',
+             task, calls, '\n'.join(rows))
+
+
+def call_site():
+    """
+    Get the innermost blues function on the call stack.
+
+    :return str: ex debian.get_user or application.deploy.update_source
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('blues.') and module != __name__:
+            return '{}.{}'.format(module[len('blues.'):], frame.f_code.co_name)
+        frame = frame.f_back
+
+    return 'unknown'
+
+
+def _trace_command(run_command):
+    @wraps(run_command)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return run_command(*args, **kwargs)
+
+        command = args[0] if args else kwargs.get('command')
+        site = call_site()
+        start = time.time()
+        try:
+            return run_command(*args, **kwargs)
+        finally:
+            record(command[:80], 'command', start, time.time() - start,
+                   command=command, site=site, task=env.get('command'))
+    return wrapper
+
+
+def install_command_hook():
+    # Every remote run/sudo, regardless of how it was imported, ends up here
+    if not hasattr(fabric.operations._run_command, '__wrapped_by_blues__'):
+        fabric.operations._run_command = _trace_command(fabric.operations._run_command)
+        fabric.operations._run_command.__wrapped_by_blues__ = True
+
+
+# Fabric applies --set before loading the fabfile, begin before any forks
+begin()
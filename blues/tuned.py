@@ -48,6 +48,7 @@ from refabric.operations import run
 from refabric.utils import info
 
 from . import debian
+from . import manifest
 
 __all__ = [ 'list','active','set', 'configure','setup']
 
@@ -107,8 +108,8 @@ def configure():
         vm=blueprint.get('vm',[])
         sysctl=blueprint.get('sysctl',[])
         bootloader=blueprint.get('bootloader',[])
-        uploads.append(blueprint.upload('./tuned/', tuned_dir))
-        uploads.append(blueprint.upload('./tuned.conf',sportamore_dynamic,{"vm" : vm,"sysctl" : sysctl,"bootloader" : bootloader}))
+        uploads.append(manifest.upload(blueprint, './tuned/', tuned_dir))
+        uploads.append(manifest.upload(blueprint, './tuned.conf',sportamore_dynamic,{"vm" : vm,"sysctl" : sysctl,"bootloader" : bootloader}))
 
         info("In order to active a profile run fab -E enviroment -R role tuned.set:value=profilename")
         info("You can list avalible profiles with fab -E enviroment -R role tuned.list ")
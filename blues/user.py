@@ -50,8 +50,9 @@ def create_service_user(name, groups=None, home=None):
 def create_ssh_path(username):
     user = debian.get_user(username)
     ssh_path = os.path.join(user['home'], '.ssh')
-    debian.mkdir(ssh_path, owner=username, group=username)
-    debian.chmod(ssh_path, mode=700)
+    with debian.batch():
+        debian.mkdir(ssh_path, owner=username, group=username)
+        debian.chmod(ssh_path, mode=700)
 
 
 def upload_ssh_keys(username, key_pair_path):
@@ -59,8 +60,9 @@ def upload_ssh_keys(username, key_pair_path):
     ssh_path = os.path.join(user['home'], '.ssh')
     templates.upload(key_pair_path, ssh_path, user=username)
     # Ensure security
-    debian.chmod(ssh_path, mode=600, owner=username, group=username, recursive=True)
-    debian.chmod(ssh_path, mode=700)
+    with debian.batch():
+        debian.chmod(ssh_path, mode=600, owner=username, group=username, recursive=True)
+        debian.chmod(ssh_path, mode=700)
 
 
 def set_strict_host_checking(username, host, check=False):
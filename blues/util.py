@@ -1,10 +1,17 @@
+import os
+import uuid
 from contextlib import contextmanager, nested
 
 
+# Identifies the current fab run, shared with Fabric's forked parallel
+# subprocesses, unique unlike pids which get reused
+os.environ.setdefault('BLUES_RUN', uuid.uuid4().hex)
+
+
 @contextmanager
 def maybe_managed(*context_managers):
     if any(map(lambda x: x is not None, context_managers)):
         with nested(*context_managers):
             yield
     else:
-        yield
\ No newline at end of file
+        yield
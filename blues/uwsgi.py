@@ -20,9 +20,13 @@ Currently only acts as a provider for the application blueprint and can not be u
 """
 import os
 import json
+import math
+import socket
+import time
 from datetime import datetime
 
 from fabric.decorators import task
+from fabric.state import env
 from fabric.utils import puts, warn
 
 from refabric.api import run, info
@@ -31,8 +35,10 @@ from refabric.contrib import blueprints
 
 from . import debian
 from . import python
+from . import manifest
 
-__all__ = ['start', 'stop', 'restart', 'reload', 'status', 'setup', 'configure', 'top', 'fifo']
+__all__ = ['start', 'stop', 'restart', 'reload', 'status', 'setup', 'configure', 'top', 'fifo',
+           'sizing', 'collect']
 
 
 blueprint = blueprints.get(__name__)
@@ -88,12 +94,12 @@ def configure():
     with sudo():
         # Upload service templates
         if debian.lsb_release() == '14.04':
-            blueprint.upload('init/uwsgi.conf', '/etc/init/uwsgi.conf')
-            blueprint.upload('init.d/uwsgi','/etc/init.d/uwsgi')
+            manifest.upload(blueprint, 'init/uwsgi.conf', '/etc/init/uwsgi.conf')
+            manifest.upload(blueprint, 'init.d/uwsgi','/etc/init.d/uwsgi')
             debian.chmod('/etc/init.d/uwsgi',mode=755)
         else:
-            blueprint.upload('systemd/uwsgi.service', '/etc/systemd/system/uwsgi.service')
-            blueprint.upload('tmpfiles.d/uwsgi.conf', '/etc/tmpfiles.d/uwsgi.conf')
+            manifest.upload(blueprint, 'systemd/uwsgi.service', '/etc/systemd/system/uwsgi.service')
+            manifest.upload(blueprint, 'tmpfiles.d/uwsgi.conf', '/etc/tmpfiles.d/uwsgi.conf')
             debian.systemd_daemon_reload()
             
 
@@ -149,22 +155,137 @@ def status(vassal_name=None):
     Get basic stats from UWSGI
     """
     # info("vassal: {}, project: {}", vassal_name, blueprint.get('project'))
+    vassal = vassal_name or blueprint.get('project')
+    puts('Reading from {}'.format(stats_socket(vassal)))
+    vassal_stats = stats(vassal)
+    if not vassal_stats:
+        warn('Unable to read UWSGI stats')
+        return
+
+    for worker_stats in vassal_stats['workers']:
+        start_time = datetime.fromtimestamp(worker_stats['last_spawn'])
+        uptime = datetime.now().replace(microsecond=0) - start_time
+        info('Worker {} status: {} uptime: {!s}',
+             worker_stats['pid'],
+             worker_stats['status'],
+             uptime)
+
+
+def stats_socket(vassal_name):
+    return os.path.join(tmpfs_path, '{}-stats.sock'.format(vassal_name))
+
+
+def zerg_socket(vassal_name):
+    return os.path.join(tmpfs_path, '{}-zerg.sock'.format(vassal_name))
+
+
+def stats(vassal_name):
+    """
+    Read the stats socket of a vassal.
+
+    :param vassal_name: The vassal to read stats for
+    :return dict: Parsed stats, or None if not readable
+    """
     with sudo(), silent():
-        vassal = vassal_name or blueprint.get('project')
-        stats_path = os.path.join(tmpfs_path, '{}-stats.sock'.format(vassal))
-        try:
-            puts('Reading from {}'.format(stats_path))
-            stats = json.loads(run('uwsgi --connect-and-read {}'.format(stats_path)))
-            for worker_stats in stats['workers']:
-                start_time = datetime.fromtimestamp(worker_stats['last_spawn'])
-                uptime = datetime.now().replace(microsecond=0) - start_time
-                info('Worker {} status: {} uptime: {!s}',
-                     worker_stats['pid'],
-                     worker_stats['status'],
-                     uptime)
+        output = run('uwsgi --connect-and-read {}'.format(
+            stats_socket(vassal_name)), pty=False)
 
-        except Exception:
-            warn('Unable to read UWSGI stats')
+    if output.return_code != 0:
+        return None
+
+    try:
+        return json.loads(output.stdout)
+    except ValueError:
+        return None
+
+
+def worker_pids(vassal_name):
+    """
+    Get pids of the running workers of a vassal.
+
+    :return set: Worker pids
+    """
+    vassal_stats = stats(vassal_name) or {}
+    return {worker['pid'] for worker in vassal_stats.get('workers', [])
+            if worker['pid']}
+
+
+def wait_for_workers(vassal_name, old_pids=(), timeout=120, interval=1,
+                     minimum=1):
+    """
+    Poll the stats socket until every running worker of a vassal is ready,
+    and none of them are a worker that was running before the reload.
+
+    :param vassal_name: The vassal to wait for
+    :param old_pids: Pids of workers that should have been replaced
+    :param timeout: Seconds to wait before giving up
+    :param interval: Seconds between polls
+    :param minimum: Workers that must be running, ex the cheaper setting
+    :return bool: True if all workers are ready
+    """
+    deadline = time.time() + timeout
+    while True:
+        vassal_stats = stats(vassal_name)
+        workers = vassal_stats['workers'] if vassal_stats else []
+        if workers_ready(workers, old_pids, minimum=minimum):
+            info('All {} running {} workers ready', len(running_workers(workers)),
+                 vassal_name)
+            return True
+
+        if time.time() > deadline:
+            warn('Timed out waiting for {} workers to get ready'.format(vassal_name))
+            return False
+
+        time.sleep(interval)
+
+
+def running_workers(workers):
+    """
+    Leave out worker slots without a process, i.e. cheap ones that the
+    cheaper subsystem has not spawned (yet).
+    """
+    return [worker for worker in workers
+            if worker['pid'] and worker['status'] != 'cheap']
+
+
+def workers_ready(workers, old_pids=(), minimum=1):
+    """
+    Check if at least minimum workers are running, and all of them are ready.
+
+    :param workers: Workers from stats()
+    :param old_pids: Pids of workers that should have been replaced
+    :param minimum: Workers that must be running
+    :return bool: True if ready
+    """
+    running = running_workers(workers)
+    return len(running) >= max(1, minimum) and \
+        all(is_worker_ready(worker, old_pids) for worker in running)
+
+
+def is_worker_ready(worker, old_pids=()):
+    # accepting is only reported by uWSGI >= 2.0
+    return (worker['pid'] and worker['pid'] not in old_pids and
+            worker['status'] in ('idle', 'busy') and
+            worker.get('accepting', 1))
+
+
+def chain_reload(vassal_name, timeout=120, minimum=1):
+    """
+    Chain reload a vassal, replacing one worker at a time.
+
+    Requires lazy-apps, the remaining workers keep serving while each new
+    worker loads the application.
+
+    :param vassal_name: The vassal to reload
+    :param timeout: Seconds to wait for the new workers to get ready
+    :param minimum: Workers that must be running, ex the cheaper setting
+    :return bool: True if all workers were replaced and ready in time
+    """
+    old_pids = worker_pids(vassal_name)
+    info('Chain reloading {} uWSGI vassal', vassal_name)
+    fifo(vassal_name, 'c')
+    return wait_for_workers(vassal_name, old_pids, timeout=timeout,
+                            minimum=minimum)
 
 
 def get_worker_count(cores):
@@ -214,3 +335,419 @@ def get_limit_as(gb_memory):
     Get limit_as setting depending on server memory in GB
     """
     return gb_memory * 512
+
+
+def get_cheaper_context(algo, cores, gb_memory, workers):
+    """
+    Get cheaper (worker autoscaling) settings depending on server core count
+    and memory in GB.
+
+    :param algo: Cheaper algorithm; spare, busyness or backlog
+    :param cores: Core count
+    :param gb_memory: Total memory in GB
+    :param workers: Max number of workers
+    :return dict: cheaper context
+    """
+    if algo not in ('spare', 'busyness', 'backlog'):
+        raise ValueError('Unknown uWSGI cheaper algorithm: {}'.format(algo))
+
+    if workers < 2:
+        # Nothing to scale
+        return {}
+
+    cheaper = max(1, min(workers - 1, cores // 2))
+    context = {
+        'cheaper_algo': algo,
+        'cheaper': cheaper,
+        'cheaper_initial': max(cheaper, workers // 2),
+        'cheaper_step': max(1, cores // 2),
+        # Stop spawning beyond 75% and start killing beyond 90% of memory
+        'cheaper_rss_limit_soft': int(gb_memory * 1024 ** 3 * 0.75),
+        'cheaper_rss_limit_hard': int(gb_memory * 1024 ** 3 * 0.9),
+    }
+
+    if algo == 'backlog':
+        # Queued requests before spawning, a few per core
+        context['cheaper_overload'] = cores * 4
+    else:
+        # Seconds between checks
+        context['cheaper_overload'] = 3
+
+    if algo == 'busyness':
+        context.update({
+            'cheaper_busyness_min': 25,
+            'cheaper_busyness_max': 50,
+            'cheaper_busyness_backlog_alert': cores * 4,
+            'cheaper_busyness_backlog_step': max(1, cores // 2),
+        })
+
+    return context
+
+
+def sample_stats(vassal_name, samples=5, interval=1):
+    """
+    Sample the stats socket of a vassal and summarize worker load.
+
+    :param vassal_name: The vassal to sample
+    :param samples: Number of stats reads
+    :param interval: Seconds between reads
+    :return dict: workers, avg_rss/peak_rss/min_rss (MB), avg_rt (ms), rps,
+        busy_ratio, listen_queue, requests_per_mb or None if not readable
+    """
+    readings = []
+    for i in range(samples):
+        if i:
+            time.sleep(interval)
+        vassal_stats = stats(vassal_name)
+        if vassal_stats and vassal_stats.get('workers'):
+            readings.append((time.time(), vassal_stats))
+
+    if not readings:
+        return None
+
+    _, last = readings[-1]
+    workers = [worker for worker in last['workers'] if worker['pid']]
+    if not workers:
+        return None
+
+    mb = 1024.0 * 1024.0
+    rss = [worker.get('rss', 0) / mb for worker in workers]
+    requests = sum(worker['requests'] for worker in workers)
+
+    # Requests per second between first and last read, respawns reset counters
+    rps = 0.0
+    (first_time, first), (last_time, _) = readings[0], readings[-1]
+    if last_time > first_time:
+        first_requests = sum(worker['requests'] for worker in first['workers'])
+        rps = max(0, requests - first_requests) / (last_time - first_time)
+
+    busy = [sum(1 for worker in reading['workers'] if worker['status'] == 'busy') /
+            float(len(reading['workers']))
+            for _, reading in readings]
+
+    avg_rt = [worker['avg_rt'] / 1000.0 for worker in workers if worker.get('avg_rt')]
+
+    # Memory growth since spawn, approximated from the leanest worker
+    growth = [(r - min(rss)) / worker['requests']
+              for r, worker in zip(rss, workers) if worker['requests']]
+
+    return {
+        'workers': len(workers),
+        'avg_rss': sum(rss) / len(rss),
+        'peak_rss': max(rss),
+        'min_rss': min(rss),
+        'avg_rt': sum(avg_rt) / len(avg_rt) if avg_rt else 0.0,
+        'rps': rps,
+        'busy_ratio': sum(busy) / len(busy),
+        'listen_queue': max(reading.get('listen_queue', 0) for _, reading in readings),
+        'mb_per_request': max(growth) if growth else 0.0,
+    }
+
+
+def quantize(value, step, up=True):
+    """
+    Round value to a multiple of step, up or down.
+    """
+    rounding = math.ceil if up else math.floor
+    return int(rounding(value / float(step)) * step)
+
+
+def get_adaptive_sizing(sample, cores, gb_memory, target_busy=0.6,
+                        memory_ratio=0.75, max_listen=None, min_workers=1,
+                        cheaper=False):
+    """
+    Get recommended web vassal sizing from sampled load.
+
+    Processes are sized for the measured concurrency (Little's law: rps *
+    response time) at target busy ratio, bounded by cores and by how many
+    workers fit in memory at their reload-on-rss threshold, but never below
+    min_workers.
+
+    Values are rounded to coarse steps, so that the vassal config, and with
+    it a reload, only changes when the load does significantly.
+
+    :param sample: Summary from sample_stats()
+    :param cores: Core count
+    :param gb_memory: Total memory in GB
+    :param target_busy: Busy ratio to size for
+    :param memory_ratio: Share of memory to give web workers
+    :param max_listen: Upper bound for listen backlog, i.e. somaxconn
+    :param min_workers: Floor for workers, ex the static worker count
+    :param cheaper: Also recommend cheaper (autoscaling) settings
+    :return dict: workers, reload_on_rss, max_requests, listen, and cheaper,
+        cheaper_initial, cheaper_step if cheaper is set
+    """
+    # Round reload-on-rss up to 64 MB, with headroom above the peak worker
+    reload_on_rss = max(sample['peak_rss'] * 1.25, sample['avg_rss'] * 1.5)
+    reload_on_rss = quantize(reload_on_rss, 64) or get_reload_on_rss(gb_memory)
+
+    memory_workers = int(gb_memory * 1024 * memory_ratio // reload_on_rss)
+
+    # Concurrency measured directly and through Little's law, use the largest
+    concurrency = max(sample['busy_ratio'] * sample['workers'],
+                      sample['rps'] * sample['avg_rt'] / 1000.0)
+    demand = int(math.ceil(concurrency / target_busy))
+    if sample['listen_queue']:
+        # Requests are already queueing, add room for the backlog
+        demand = max(demand, sample['workers']) + int(math.ceil(sample['listen_queue'] / 10.0))
+
+    step = 2 if demand <= 16 else 4
+    workers = min(quantize(max(2, demand), step), cores * 4)
+    workers = max(1, min(workers, quantize(memory_workers, step, up=False) or memory_workers))
+    workers = max(workers, min_workers)
+
+    if sample['mb_per_request'] > 0:
+        max_requests = (reload_on_rss - sample['min_rss']) / sample['mb_per_request']
+        max_requests = quantize(min(max(max_requests, 1000), 50000), 1000, up=False)
+    else:
+        max_requests = int(get_max_requests(gb_memory))
+
+    # Room for one second worth of requests, at least the uWSGI default,
+    # rounded up to a power of two
+    listen = max(100, int(math.ceil(sample['rps'])), sample['listen_queue'] * 4)
+    listen = 2 ** int(math.ceil(math.log(listen, 2)))
+    if max_listen:
+        listen = min(listen, max_listen)
+
+    sizing = {
+        'workers': workers,
+        'reload_on_rss': reload_on_rss,
+        'max_requests': max_requests,
+        'listen': listen,
+    }
+
+    if cheaper:
+        minimum = max(1, min(workers - 1, quantize(concurrency, 2))) if workers > 1 else 0
+        sizing.update({
+            'cheaper': minimum,
+            'cheaper_initial': max(minimum, int(math.ceil(workers / 2.0))) if minimum else 0,
+            'cheaper_step': max(1, workers // 4) if minimum else 0,
+        })
+
+    return sizing
+
+
+@task
+def sizing(vassal_name=None, samples=5):
+    """
+    Dry-run report of adaptive sizing for a vassal, from its live stats,
+    as app.configure would render it with web.adaptive enabled
+
+    :param vassal_name: The vassal to sample (Default: project setting)
+    :param samples: Number of stats reads, one second apart
+    """
+    from .app import blueprint as app_blueprint
+    from .application.providers.uwsgi import UWSGIProvider
+
+    vassal = vassal_name or blueprint.get('project')
+    sample = sample_stats(vassal, samples=int(samples))
+    if not sample:
+        warn('Unable to read UWSGI stats')
+        return None
+
+    provider = UWSGIProvider()
+    cores, gb_memory = provider.get_resources()
+    recommended = provider.get_adaptive_sizing(cores, gb_memory, sample=sample)
+
+    static = {
+        'workers': app_blueprint.get('web.workers', default=get_worker_count(cores)),
+        'reload_on_rss': int(get_reload_on_rss(gb_memory)),
+        'max_requests': int(get_max_requests(gb_memory)),
+        'listen': 100,
+    }
+    cheaper_algo = app_blueprint.get('web.cheaper_algo')
+    if cheaper_algo:
+        static.update(get_cheaper_context(cheaper_algo, cores, gb_memory,
+                                          static['workers']))
+
+    measured = ('workers: {workers}, rss avg/peak: {avg_rss:.0f}/{peak_rss:.0f} MB, '
+                'avg rt: {avg_rt:.1f} ms, rps: {rps:.1f}, busy: {busy_ratio:.0%}, '
+                'listen queue: {listen_queue}').format(**sample)
+    rows = ['{:<16} {:>10} {:>12}'.format('setting', 'static', 'recommended')]
+    for key in ('workers', 'reload_on_rss', 'max_requests', 'listen',
+                'cheaper', 'cheaper_initial', 'cheaper_step'):
+        rows.append('{:<16} {:>10} {:>12}'.format(key, static.get(key, 0),
+                                                  recommended.get(key, 0)))
+
+    info('Sizing for {} on {} core(s), {} GB memory\n{}\n{}',
+         vassal, cores, gb_memory, measured, '\n'.join(rows))
+
+    return recommended
+
+
+def read_all_stats():
+    """
+    Read the stats sockets of all vassals in one remote command.
+
+    :return dict: {vassal name: stats, ...}
+    """
+    script = ('for s in {}*-stats.sock; do [ -S "$s" ] || continue; '
+              "printf '%s\\0' \"$s\"; uwsgi --connect-and-read \"$s\" 2>/dev/null; "
+              "printf '\\0'; done").format(tmpfs_path)
+
+    with sudo(), silent():
+        output = run(script, pty=False)
+
+    fields = output.stdout.split('\0')
+    vassals = {}
+    for path, raw in zip(fields[0::2], fields[1::2]):
+        try:
+            vassal_stats = json.loads(raw)
+        except ValueError:
+            continue
+
+        # Skip the emperor stats socket, it has no workers
+        if 'workers' in vassal_stats:
+            name = os.path.basename(path.strip())[:-len('-stats.sock')]
+            vassals[name] = vassal_stats
+
+    return vassals
+
+
+def get_totals(vassal_stats):
+    """
+    Sum up counters and gauges over the workers of a vassal.
+    """
+    workers = [worker for worker in vassal_stats['workers'] if worker['pid']]
+    served = [worker for worker in workers if worker['requests'] and worker.get('avg_rt')]
+    return {
+        'requests': sum(worker['requests'] for worker in workers),
+        'exceptions': sum(worker.get('exceptions', 0) for worker in workers),
+        'harakiri': sum(worker.get('harakiri_count', 0) for worker in workers),
+        'respawns': sum(worker.get('respawn_count', 0) for worker in workers),
+        'workers': len(workers),
+        'busy_workers': sum(1 for worker in workers if worker['status'] == 'busy'),
+        'rss_bytes': sum(worker.get('rss', 0) for worker in workers),
+        'listen_queue': vassal_stats.get('listen_queue', 0),
+        'listen_queue_errors': vassal_stats.get('listen_queue_errors', 0),
+        # Weighted by requests, avg_rt is in microseconds
+        'avg_rt_seconds': (sum(worker['avg_rt'] * worker['requests'] for worker in served) /
+                           float(sum(worker['requests'] for worker in served)) / 1e6
+                           if served else 0.0),
+    }
+
+
+counters = ('requests', 'exceptions', 'harakiri', 'respawns', 'listen_queue_errors')
+
+
+def get_rates(previous, current, seconds):
+    """
+    Get per second rates of counters between two totals, a counter that went
+    backwards (vassal restarted) counts from zero.
+    """
+    rates = {}
+    for counter in counters:
+        delta = current[counter] - previous[counter]
+        if delta < 0:
+            delta = current[counter]
+        rates[counter] = delta / float(seconds) if seconds > 0 else 0.0
+    return rates
+
+
+def format_prometheus(host, metrics):
+    """
+    Format metrics in the Prometheus text exposition format.
+
+    :param host: Host label
+    :param metrics: {vassal: (totals, rates), ...}
+    :return str: Exposition text
+    """
+    series = {}
+    for vassal, (totals, rates) in sorted(metrics.items()):
+        labels = '{{host="{}",vassal="{}"}}'.format(host, vassal)
+        for name, value in totals.items():
+            kind = 'counter' if name in counters else 'gauge'
+            suffix = '_total' if kind == 'counter' else ''
+            series.setdefault(('uwsgi_{}{}'.format(name, suffix), kind), []).append(
+                '{}{} {}'.format('uwsgi_{}{}'.format(name, suffix), labels, value))
+        for name, value in rates.items():
+            key = 'uwsgi_{}_per_second'.format(name)
+            series.setdefault((key, 'gauge'), []).append(
+                '{}{} {:.3f}'.format(key, labels, value))
+
+    lines = []
+    for (name, kind), samples in sorted(series.items()):
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.extend(samples)
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_statsd(host, metrics, prefix='uwsgi'):
+    """
+    Format metrics as StatsD gauges.
+
+    :param host: Host, dots are replaced to keep the metric path intact
+    :param metrics: {vassal: (totals, rates), ...}
+    :param prefix: Metric path prefix
+    :return list: StatsD lines
+    """
+    host = host.split('@')[-1].split(':')[0].replace('.', '_')
+    lines = []
+    for vassal, (totals, rates) in sorted(metrics.items()):
+        path = '{}.{}.{}'.format(prefix, host, vassal)
+        for name in sorted(set(totals) - set(counters)):
+            lines.append('{}.{}:{}|g'.format(path, name, totals[name]))
+        for name, value in sorted(rates.items()):
+            lines.append('{}.{}_per_second:{:.3f}|g'.format(path, name, value))
+    return lines
+
+
+@task
+def collect(interval=10, count=0, exporter='prometheus', output=None,
+            statsd='127.0.0.1:8125', prefix='uwsgi'):
+    """
+    Poll all vassal stats sockets and export totals and per second rates
+
+    Run in parallel (-P) to collect from several hosts at once.
+
+    :param interval: Seconds between polls
+    :param count: Number of exports before stopping (Default: until interrupted)
+    :param exporter: prometheus or statsd
+    :param output: Prometheus: local file to (atomically) write, i.e. for the
+        node exporter textfile collector, may contain {host} (Default: print)
+    :param statsd: StatsD host:port to send lines to over UDP
+    :param prefix: StatsD metric path prefix
+    """
+    if exporter not in ('prometheus', 'statsd'):
+        raise ValueError('Unknown exporter: {}'.format(exporter))
+
+    interval, count = float(interval), int(count)
+    host = env.host_string
+
+    sock = None
+    if exporter == 'statsd':
+        statsd_host, _, statsd_port = statsd.partition(':')
+        statsd_address = (statsd_host, int(statsd_port or 8125))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    previous, previous_time = {}, None
+    exported = 0
+    while True:
+        now = time.time()
+        totals = {vassal: get_totals(vassal_stats)
+                  for vassal, vassal_stats in read_all_stats().items()}
+
+        if previous_time is not None:
+            metrics = {vassal: (totals[vassal],
+                                get_rates(previous[vassal], totals[vassal],
+                                          now - previous_time))
+                       for vassal in totals if vassal in previous}
+
+            if exporter == 'statsd':
+                for line in format_statsd(host, metrics, prefix=prefix):
+                    sock.sendto(line, statsd_address)
+            elif output:
+                path = output.format(host=host.replace(':', '_'))
+                with open(path + '.tmp', 'w') as f:
+                    f.write(format_prometheus(host, metrics))
+                os.rename(path + '.tmp', path)
+            else:
+                puts(format_prometheus(host, metrics), show_prefix=False)
+
+            exported += 1
+            if count and exported >= count:
+                break
+
+        previous, previous_time = totals, now
+        time.sleep(max(0, interval - (time.time() - now)))
@@ -23,6 +23,7 @@ from refabric.context_managers import sudo, silent
 from refabric.contrib import blueprints
 
 from . import debian
+from . import manifest
 
 __all__ = ['start', 'stop', 'restart', 'status', 'setup', 'configure', 'flush']
 
@@ -59,7 +60,7 @@ def configure():
         'bind': blueprint.get('bind', ':6081'),
         'backend': blueprint.get('backend', '127.0.0.1:8080')
     }
-    default = blueprint.upload('./default', '/etc/default/varnish', context)
+    default = manifest.upload(blueprint, './default', '/etc/default/varnish', context)
 
     if default:
         restart()